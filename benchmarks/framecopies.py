@@ -0,0 +1,106 @@
+"""
+Frame copy benchmark
+
+Measures with tracemalloc the peak memory allocated while a captured frame goes
+from the gphoto2 buffer to the HTTP response and to the JPEG frame store, and
+reports it as a multiple of the frame size. The download copies the frame once
+out of the camera file, the other paths must not copy it again. The previous
+base64 JSON path is measured too for comparison. Use --max-ratio to fail above a
+given multiple.
+
+    python benchmarks/framecopies.py --size 8 --max-ratio 1.5
+"""
+
+import argparse
+import base64
+import json
+import os
+import sys
+import tempfile
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+class StandInCameraFile:
+    """Owns the frame memory like a gphoto2 CameraFile, freeing it when collected"""
+
+    def __init__(self, size):
+        self.buffer = bytearray(os.urandom(size))
+
+    def get_data_and_size(self):
+        return memoryview(self.buffer)
+
+
+def measure(func):
+    """Return the peak memory allocated while running func"""
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--size", type=float, default=8, help="frame size in MB")
+    parser.add_argument(
+        "--max-ratio",
+        type=float,
+        default=None,
+        help="fail if a frame path allocates more than this multiple",
+    )
+    args = parser.parse_args()
+
+    os.environ["GALAXYDSLR_DATA_DIR"] = tempfile.mkdtemp(prefix="galaxydslr-")
+    from dslr import file_data
+    from flaskapp import app
+    from framestore import FrameStore
+
+    size = int(args.size * 1024 * 1024)
+    camera_file = StandInCameraFile(size)
+    download_peak = measure(lambda: file_data(camera_file))
+    # The frame outlives the camera file, as in DSLRManager.download_file
+    buffer = file_data(camera_file)
+    camera_file = None
+    frame = {"session": "bench", "index": 1, "frame_type": "light", "data": buffer}
+    app.control.session = "bench"
+    app.control.last_capture = 1
+    app.control.last_image = buffer
+    client = app.test_client()
+    store = FrameStore()
+
+    def base64_json():
+        data = bytes(buffer)
+        encoded = base64.b64encode(data).decode()
+        json.dumps({"status": True, "image_data": encoded}).encode()
+
+    def http_response():
+        response = client.get("/capture/last_image.jpg", buffered=False)
+        for _ in response.response:
+            pass
+        response.close()
+
+    results = [
+        ("base64 JSON (previous)", measure(base64_json), False),
+        ("camera download", download_peak, True),
+        ("HTTP response", measure(http_response), True),
+        ("frame store", measure(lambda: store.process(frame)), True),
+    ]
+
+    print("%-24s %10s %8s" % ("path", "peak MB", "ratio"))
+    failed = False
+    for name, peak, checked in results:
+        ratio = peak / size
+        print("%-24s %10.2f %8.2f" % (name, peak / 1024 / 1024, ratio))
+        if checked and args.max_ratio is not None and ratio > args.max_ratio:
+            failed = True
+    if failed:
+        print("FAIL: a frame path allocates more than %.2fx" % args.max_ratio)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+"""
+Guider benchmark
+
+Runs the PHD2 stand-in server (benchmarks/mockphd2.py) in a separate process
+and measures, for several GuideStep event rates, the CPU time the PHD2 client
+spends processing events, then the dither round trip: the time for the dither
+call to return and the time until settling is reported done.
+
+    python benchmarks/guider.py --rates 10,100,1000,5000 --dithers 20
+"""
+
+import argparse
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from thirdparty.phd2guider import Guider  # noqa: E402
+
+MOCK = os.path.join(ROOT, "benchmarks", "mockphd2.py")
+
+
+class CountingGuider(Guider):
+    events = 0
+
+    def _handle_event(self, ev):
+        self.events += 1
+        super()._handle_event(ev)
+
+
+def free_instance():
+    """Return a PHD2 instance number whose port (4400 + instance - 1) is free"""
+    for instance in range(1, 100):
+        with socket.socket() as sock:
+            try:
+                sock.bind(("127.0.0.1", 4400 + instance - 1))
+                return instance
+            except OSError:
+                continue
+    raise Exception("No free PHD2 port")
+
+
+def start_server(instance, *args):
+    port = 4400 + instance - 1
+    process = subprocess.Popen(
+        [sys.executable, MOCK, "--port", str(port)] + list(args),
+        stdout=subprocess.PIPE,
+    )
+    # Wait until the server reports it is listening
+    process.stdout.readline()
+    return process
+
+
+def connect(instance):
+    guider = CountingGuider("127.0.0.1", instance)
+    guider.Connect()
+    return guider
+
+
+def guide(guider):
+    guider.Guide(1.5, 0, 10)
+    while not guider.CheckSettling().Done:
+        time.sleep(0.01)
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+def bench_events(instance, rate, seconds):
+    server = start_server(instance, "--guide-rate", str(rate), "--settle-seconds", "0")
+    try:
+        guider = connect(instance)
+        guide(guider)
+        events = guider.events
+        cpu = time.process_time()
+        started = time.monotonic()
+        time.sleep(seconds)
+        cpu = time.process_time() - cpu
+        elapsed = time.monotonic() - started
+        events = guider.events - events
+        guider.Disconnect()
+    finally:
+        server.terminate()
+        server.wait()
+    return events / elapsed, cpu / elapsed, cpu / max(events, 1)
+
+
+def bench_dither(instance, dithers, settle_seconds):
+    server = start_server(
+        instance,
+        "--guide-rate",
+        "10",
+        "--settle-seconds",
+        str(settle_seconds),
+        "--settle-rate",
+        "100",
+    )
+    calls = []
+    settles = []
+    try:
+        guider = connect(instance)
+        guide(guider)
+        for _ in range(dithers):
+            started = time.perf_counter()
+            guider.Dither(3, 1.5, 0, 10)
+            calls.append(time.perf_counter() - started)
+            while not guider.CheckSettling().Done:
+                time.sleep(0.001)
+            settles.append(time.perf_counter() - started - settle_seconds)
+        guider.Disconnect()
+    finally:
+        server.terminate()
+        server.wait()
+    return calls, settles
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--rates", default="10,100,1000,5000", help="GuideStep events per second"
+    )
+    parser.add_argument("--seconds", type=float, default=3, help="seconds per rate")
+    parser.add_argument("--dithers", type=int, default=20, help="dithers to time")
+    parser.add_argument(
+        "--settle-seconds", type=float, default=0.2, help="mock settling time"
+    )
+    args = parser.parse_args()
+    instance = free_instance()
+
+    print("%-10s %12s %10s %12s" % ("rate", "events/s", "CPU %", "CPU us/event"))
+    for rate in [float(rate) for rate in args.rates.split(",")]:
+        received, cpu, per_event = bench_events(instance, rate, args.seconds)
+        print(
+            "%-10g %12.0f %10.1f %12.1f"
+            % (rate, received, cpu * 100, per_event * 1000000)
+        )
+
+    calls, settles = bench_dither(instance, args.dithers, args.settle_seconds)
+    print()
+    print("%-24s %8s %8s %8s" % ("dither (ms)", "p50", "p95", "max"))
+    for name, values in (("call round trip", calls), ("settle overhead", settles)):
+        print(
+            "%-24s %8.2f %8.2f %8.2f"
+            % (
+                name,
+                statistics.median(values) * 1000,
+                percentile(values, 95) * 1000,
+                max(values) * 1000,
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,358 @@
+"""
+API load test
+
+Serves flaskapp.app with the simulated camera (GALAXYDSLR_SIMULATOR) and the PHD2
+stand-in (benchmarks/mockphd2.py), runs a capture sequence without clients as
+baseline and then again while many simulated browser clients poll the API from
+separate processes. Reports throughput, latency percentiles and error rates per
+route and how much the capture timeline was disturbed: the camera dead time
+between exposures and the capture call overrun over the exposure time.
+
+Clients follow one of these profiles, mixed with --mix:
+
+    browser: main.js while capturing, capture status every second and the last
+        image every time a new capture is reported
+    dashboard: incremental status, stack, quality and catalog views
+    controller: reads the camera configuration and posts quality settings
+
+    python benchmarks/loadtest.py --clients 30 --mix browser:6,dashboard:3,controller:1
+"""
+
+import argparse
+import http.client
+import json
+import logging
+import multiprocessing
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Client profiles: (method, path, data, interval seconds)
+PROFILES = {
+    "browser": [("GET", "/capture/status/", None, 1.0)],
+    "dashboard": [
+        ("GET", "/status/", None, 2.0),
+        ("GET", "/stack/status/", None, 5.0),
+        ("GET", "/quality/status/", None, 5.0),
+        ("GET", "/catalog/frames/?per_page=20", None, 10.0),
+    ],
+    "controller": [
+        ("GET", "/camera/config/", None, 5.0),
+        ("POST", "/quality/config/", {"enabled": "true"}, 10.0),
+    ],
+}
+
+REQUEST_TIMEOUT = 30
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+def request(port, method, path, data=None):
+    """Issue a request returning (latency, ok, body)"""
+    started = time.perf_counter()
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=REQUEST_TIMEOUT)
+    try:
+        body = None
+        headers = {}
+        if data is not None:
+            body = "&".join("%s=%s" % item for item in data.items())
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+        conn.request(method, path, body, headers)
+        response = conn.getresponse()
+        body = response.read()
+        ok = response.status == 200
+        if ok and response.getheader("Content-Type") == "application/json":
+            body = json.loads(body)
+            ok = body.get("status", False)
+        return time.perf_counter() - started, ok, body
+    except Exception:
+        return time.perf_counter() - started, False, None
+    finally:
+        conn.close()
+
+
+class Client(threading.Thread):
+    """Simulated browser client following a profile"""
+
+    def __init__(self, port, profile, stop, samples, seed):
+        super().__init__(daemon=True)
+        self.port = port
+        self.profile = profile
+        self.stop = stop
+        self.samples = samples
+        self.random = random.Random(seed)
+        self.seq = None
+        self.last_capture = None
+
+    def call(self, method, path, data=None):
+        started = time.monotonic()
+        latency, ok, body = request(self.port, method, path, data)
+        route = path.split("?")[0]
+        if route.endswith(".jpg"):
+            route = route.rsplit("/", 1)[0] + "/*.jpg"
+        self.samples.append((route, started, latency, ok))
+        return body if ok else None
+
+    def follow(self, path, response):
+        """React to responses the way main.js does"""
+        if response is None:
+            return
+        if path == "/status/":
+            self.seq = response.get("seq", self.seq)
+        elif path == "/capture/status/":
+            last_capture = response["capture_status"]["last_capture"]
+            if last_capture != self.last_capture:
+                self.last_capture = last_capture
+                image = self.call("GET", "/capture/last_image/")
+                if image and image.get("image_url"):
+                    self.call("GET", image["image_url"])
+
+    def run(self):
+        # Initial page load, then start polling at random phases
+        self.follow("/status/", self.call("GET", "/status/"))
+        now = time.monotonic()
+        due = [now + self.random.uniform(0, task[3]) for task in self.profile]
+        while not self.stop.is_set():
+            n = min(range(len(due)), key=due.__getitem__)
+            if self.stop.wait(max(0, due[n] - time.monotonic())):
+                break
+            method, path, data, interval = self.profile[n]
+            url = path
+            if path == "/status/" and self.seq is not None:
+                url = "/status/?since=%d" % self.seq
+            self.follow(path, self.call(method, url, data))
+            due[n] += interval
+
+
+def run_clients(port, profiles, stop, results, seed):
+    """Run client threads in a worker process until stop is set"""
+    samples = []
+    clients = [
+        Client(port, PROFILES[name], stop, samples, seed * 1000 + n)
+        for n, name in enumerate(profiles)
+    ]
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    results.put(samples)
+
+
+def parse_mix(mix, clients):
+    """Return the profile of each client from weights as browser:6,dashboard:3"""
+    weights = []
+    for item in mix.split(","):
+        name, _, weight = item.partition(":")
+        if name not in PROFILES:
+            raise SystemExit("Unknown client profile: %s" % name)
+        weights.append((name, float(weight or 1)))
+    total = sum(weight for _, weight in weights)
+    profiles = []
+    for name, weight in weights:
+        profiles += [name] * round(clients * weight / total)
+    return (profiles + [weights[0][0]] * clients)[:clients]
+
+
+def timeline(frames, exposure):
+    """Return camera dead time between frames and capture overruns"""
+    frames = sorted(frames, key=lambda frame: frame["started"])
+    gaps = [b["started"] - a["finished"] for a, b in zip(frames, frames[1:])]
+    overruns = [frame["finished"] - frame["started"] - exposure for frame in frames]
+    return gaps, overruns
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--clients", type=int, default=30, help="simulated clients")
+    parser.add_argument(
+        "--processes", type=int, default=2, help="client worker processes"
+    )
+    parser.add_argument(
+        "--mix",
+        default="browser:6,dashboard:3,controller:1",
+        help="client profile weights",
+    )
+    parser.add_argument("--frames", type=int, default=10, help="frames per run")
+    parser.add_argument("--exposure", type=float, default=1.0, help="seconds")
+    parser.add_argument(
+        "--dither-n", type=int, default=0, help="dither every N frames (0 disables)"
+    )
+    parser.add_argument(
+        "--usb-latency", type=float, default=None, help="simulated camera call seconds"
+    )
+    args = parser.parse_args()
+
+    os.environ["GALAXYDSLR_SIMULATOR"] = "1"
+    os.environ.setdefault("GALAXYDSLR_DATA_DIR", tempfile.mkdtemp(prefix="galaxydslr-"))
+    from mockphd2 import MockPHD2
+    from werkzeug.serving import make_server
+
+    from flaskapp import app
+    from guiding import SeriesGuider
+
+    phd2 = MockPHD2(port=0, guide_rate=2, settle_seconds=0.5).start()
+    # Request logging would dominate the server output and CPU
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    port = server.server_port
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    app.warmup()
+    if args.usb_latency is not None:
+        app.dslr.USB_LATENCY = args.usb_latency
+    threading.Thread(target=app.control.run, name="control", daemon=True).start()
+    app.guider.guider_factory = lambda host: SeriesGuider(host, phd2.port - 4400 + 1)
+    for path, data in (
+        ("/camera/connect/", {"port": "usb:001,001"}),
+        ("/guider/connect/", {"host": "127.0.0.1"}),
+    ):
+        _, ok, body = request(port, "POST", path, data)
+        if not ok:
+            raise SystemExit("Failed setting up %s: %s" % (path, body))
+
+    block = {"exposure": args.exposure, "captures": args.frames}
+    if args.dither_n:
+        block.update(dither="true", dither_n=args.dither_n, settle_time=0)
+    frames = []
+    app.control.add_frame_handler(frames.append)
+
+    def sequence():
+        body = json.dumps({"blocks": [block]})
+        headers = {"Content-Type": "application/json"}
+        conn = http.client.HTTPConnection("127.0.0.1", port)
+        conn.request("POST", "/capture/sequence/", body, headers)
+        response = json.loads(conn.getresponse().read())
+        conn.close()
+        if not response["status"]:
+            raise SystemExit("Failed starting capture: %s" % response["error"])
+        while app.control.current_status == app.control.STATUS_IDLE:
+            time.sleep(0.01)
+        while app.control.current_status != app.control.STATUS_IDLE:
+            time.sleep(0.05)
+
+    def count_operations(since):
+        return {
+            name: count - since.get(name, 0)
+            for name, count in app.dslr.operations.items()
+        }
+
+    # Baseline, no clients
+    setup_operations = dict(app.dslr.operations)
+    started = time.monotonic()
+    sequence()
+    runs = {"baseline": (time.monotonic() - started, timeline(frames, args.exposure))}
+    operations = {"baseline": count_operations(setup_operations)}
+    baseline_operations = dict(app.dslr.operations)
+    del frames[:]
+
+    # Loaded
+    context = multiprocessing.get_context("spawn")
+    stop = context.Event()
+    results = context.Queue()
+    profiles = parse_mix(args.mix, args.clients)
+    workers = [
+        context.Process(
+            target=run_clients,
+            args=(port, profiles[n :: args.processes], stop, results, n),
+            daemon=True,
+        )
+        for n in range(args.processes)
+    ]
+    for worker in workers:
+        worker.start()
+    time.sleep(2)
+    loaded_started = time.monotonic()
+    sequence()
+    loaded_elapsed = time.monotonic() - loaded_started
+    runs["loaded"] = (loaded_elapsed, timeline(frames, args.exposure))
+    operations["loaded"] = count_operations(baseline_operations)
+    stop.set()
+    samples = []
+    for _ in workers:
+        samples += results.get()
+    for worker in workers:
+        worker.join()
+    phd2.stop()
+
+    # Requests issued while the loaded sequence was running
+    loaded_ended = loaded_started + loaded_elapsed
+    samples = [s for s in samples if loaded_started <= s[1] <= loaded_ended]
+    routes = {}
+    for route, _, latency, ok in samples:
+        routes.setdefault(route, []).append((latency, ok))
+    print(
+        "%d clients (%s), %d processes, %d frames of %gs"
+        % (args.clients, args.mix, args.processes, args.frames, args.exposure)
+    )
+    print()
+    print(
+        "%-28s %8s %8s %8s %8s %8s %8s"
+        % ("route", "requests", "req/s", "p50 ms", "p95 ms", "p99 ms", "errors")
+    )
+    for route, route_values in sorted(routes.items()) + [
+        ("total", [value for values in routes.values() for value in values])
+    ]:
+        latencies = [latency for latency, _ in route_values]
+        errors = sum(1 for _, ok in route_values if not ok)
+        print(
+            "%-28s %8d %8.1f %8.1f %8.1f %8.1f %7.1f%%"
+            % (
+                route,
+                len(route_values),
+                len(route_values) / loaded_elapsed,
+                percentile(latencies, 50) * 1000,
+                percentile(latencies, 95) * 1000,
+                percentile(latencies, 99) * 1000,
+                errors * 100 / len(route_values),
+            )
+        )
+
+    print()
+    print(
+        "%-10s %10s %14s %14s %14s %14s"
+        % (
+            "capture",
+            "seconds",
+            "gap p50 ms",
+            "gap max ms",
+            "overrun p50",
+            "overrun max",
+        )
+    )
+    for name, (elapsed, (gaps, overruns)) in runs.items():
+        print(
+            "%-10s %10.2f %14.1f %14.1f %14.1f %14.1f"
+            % (
+                name,
+                elapsed,
+                statistics.median(gaps) * 1000 if gaps else 0,
+                max(gaps) * 1000 if gaps else 0,
+                statistics.median(overruns) * 1000,
+                max(overruns) * 1000,
+            )
+        )
+    print()
+    print("%-14s %10s %10s" % ("camera calls", "baseline", "loaded"))
+    for name in sorted(operations["loaded"]):
+        print(
+            "%-14s %10d %10d"
+            % (name, operations["baseline"].get(name, 0), operations["loaded"][name])
+        )
+    reads = app.dslr.reads.get_status()
+    print(
+        "camera reads executed %d, shared %d (max age %gs)"
+        % (reads["executed"], reads["shared"], reads["max_age"])
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,365 @@
+"""
+PHD2 stand-in server
+
+Implements the PHD2 JSON-RPC event server protocol closely enough for
+GuiderHelper and thirdparty.phd2guider.Guider: guide, dither, loop,
+stop_capture, get_app_state, get_settling and friends. While guiding it emits
+GuideStep events at a configurable rate (thousands per second are fine) and
+settles dithers emitting Settling events, with outcomes taken in turn from a
+script of "ok", "fail" and "timeout".
+
+    python benchmarks/mockphd2.py --port 4400 --guide-rate 1000 --settle ok,fail
+"""
+
+import argparse
+import json
+import random
+import socket
+import threading
+import time
+
+DEFAULT_PORT = 4400
+
+SETTLE_ERRORS = {
+    "fail": "Settling failed",
+    "timeout": "timed-out waiting for guider to settle",
+}
+
+
+class MockPHD2:
+    """
+    PHD2 stand-in
+
+    Events are sent to every connected client. Event times are computed from a
+    fixed schedule and all the events due are sent together, so high rates do
+    not depend on the sleep resolution.
+    """
+
+    VERSION = "2.6.11"
+
+    def __init__(
+        self,
+        host="127.0.0.1",
+        port=DEFAULT_PORT,
+        guide_rate=1.0,
+        settle_rate=10.0,
+        settle_seconds=1.0,
+        settle_script=("ok",),
+        guide_rms=0.5,
+        seed=None,
+    ):
+        self.guide_rate = guide_rate
+        self.settle_rate = settle_rate
+        self.settle_seconds = settle_seconds
+        self.settle_script = list(settle_script)
+        self.guide_rms = guide_rms
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        # Responses and events share the sockets, lines must not interleave
+        self.send_lock = threading.Lock()
+        self.clients = []
+        self.state = "Stopped"
+        self.paused = False
+        self.settle = None
+        self.settle_count = 0
+        self.frame = 0
+        self.events_sent = 0
+        self.running = True
+        self.sock = socket.socket()
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, port))
+        self.sock.listen()
+        self.port = self.sock.getsockname()[1]
+        self.threads = [
+            threading.Thread(target=self._accept, name="phd2-accept", daemon=True),
+            threading.Thread(target=self._emit, name="phd2-events", daemon=True),
+        ]
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+        return self
+
+    def stop(self):
+        self.running = False
+        self.sock.close()
+        with self.lock:
+            for client in self.clients:
+                client.close()
+            self.clients = []
+
+    # Connections
+
+    def _send(self, client, data):
+        try:
+            with self.send_lock:
+                client.sendall(data)
+            return True
+        except OSError:
+            with self.lock:
+                if client in self.clients:
+                    self.clients.remove(client)
+            return False
+
+    def _event(self, name, **fields):
+        fields["Event"] = name
+        fields.update(Timestamp=time.time(), Host="mock", Inst=1)
+        return json.dumps(fields, separators=(",", ":")) + "\r\n"
+
+    def broadcast(self, events):
+        if not events:
+            return
+        data = "".join(events).encode()
+        with self.lock:
+            clients = list(self.clients)
+            self.events_sent += len(events)
+        for client in clients:
+            self._send(client, data)
+
+    def _accept(self):
+        while self.running:
+            try:
+                client, _ = self.sock.accept()
+            except OSError:
+                return
+            client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            greeting = self._event(
+                "Version", PHDVersion=self.VERSION, PHDSubver="", MsgVersion=1
+            ) + self._event("AppState", State=self.state)
+            self._send(client, greeting.encode())
+            with self.lock:
+                self.clients.append(client)
+            threading.Thread(
+                target=self._serve, args=(client,), name="phd2-client", daemon=True
+            ).start()
+
+    def _serve(self, client):
+        buf = b""
+        while self.running:
+            try:
+                data = client.recv(4096)
+            except OSError:
+                break
+            if not data:
+                break
+            buf += data
+            *lines, buf = buf.replace(b"\r", b"\n").split(b"\n")
+            for line in lines:
+                if line.strip():
+                    self._send(client, self._handle_request(line).encode())
+        with self.lock:
+            if client in self.clients:
+                self.clients.remove(client)
+        client.close()
+
+    # JSON-RPC methods
+
+    def _handle_request(self, line):
+        try:
+            request = json.loads(line)
+            method = getattr(self, "rpc_" + request["method"], None)
+            if method is None:
+                error = {"code": -32601, "message": "method not found"}
+                response = {"error": error}
+            else:
+                response = {"result": method(*request.get("params", []))}
+        except Exception as e:
+            request = {}
+            response = {"error": {"code": 1, "message": str(e)}}
+        response.update(jsonrpc="2.0", id=request.get("id"))
+        return json.dumps(response, separators=(",", ":")) + "\r\n"
+
+    def _set_state(self, state, event=None):
+        self.state = state
+        events = [self._event("AppState", State=state)]
+        if event:
+            events.insert(0, self._event(event))
+        self.broadcast(events)
+
+    def _start_settle(self, distance, settle):
+        outcome = "ok"
+        if self.settle_script:
+            outcome = self.settle_script[self.settle_count % len(self.settle_script)]
+        self.settle_count += 1
+        seconds = self.settle_seconds
+        if outcome == "timeout":
+            seconds = settle.get("timeout", seconds)
+        with self.lock:
+            self.settle = {
+                "started": time.monotonic(),
+                "seconds": seconds,
+                "distance": distance,
+                "settle_time": settle.get("time", 0),
+                "outcome": outcome,
+            }
+        self.broadcast([self._event("SettleBegin")])
+
+    def rpc_get_app_state(self):
+        return self.state
+
+    def rpc_get_connected(self):
+        return True
+
+    def rpc_set_connected(self, connected):
+        return 0
+
+    def rpc_get_exposure(self):
+        return 1
+
+    def rpc_get_pixel_scale(self):
+        return 1.5
+
+    def rpc_get_profile(self):
+        return {"id": 1, "name": "Mock"}
+
+    def rpc_get_profiles(self):
+        return [{"id": 1, "name": "Mock"}]
+
+    def rpc_set_profile(self, profile_id):
+        return 0
+
+    def rpc_get_paused(self):
+        return self.paused
+
+    def rpc_set_paused(self, paused, *args):
+        self.paused = paused
+        self._set_state("Paused" if paused else "Guiding")
+        return 0
+
+    def rpc_get_settling(self):
+        return self.settle is not None
+
+    def rpc_loop(self):
+        self._set_state("Looping", "LoopingExposures")
+        return 0
+
+    def rpc_stop_capture(self):
+        with self.lock:
+            self.settle = None
+        self._set_state("Stopped", "GuidingStopped")
+        return 0
+
+    def rpc_guide(self, settle, recalibrate=False, *args):
+        self._set_state("Guiding", "StartGuiding")
+        self._start_settle(0.0, settle)
+        return 0
+
+    def rpc_dither(self, amount, ra_only=False, settle=None, *args):
+        if self.state != "Guiding":
+            raise Exception("cannot dither if not guiding")
+        self.broadcast([self._event("GuidingDithered", dx=amount, dy=amount)])
+        self._start_settle(float(amount), settle or {})
+        return 0
+
+    def rpc_save_image(self):
+        return {"filename": "/tmp/mock_phd2.fits"}
+
+    # Events
+
+    def _guide_step(self):
+        self.frame += 1
+        ra = self.random.gauss(0, self.guide_rms)
+        dec = self.random.gauss(0, self.guide_rms)
+        return self._event(
+            "GuideStep",
+            Frame=self.frame,
+            Time=self.frame / max(self.guide_rate, 1e-9),
+            Mount="Mock",
+            dx=ra,
+            dy=dec,
+            RADistanceRaw=ra,
+            DECDistanceRaw=dec,
+            RADistanceGuide=ra,
+            DECDistanceGuide=dec,
+            StarMass=10000,
+            SNR=50.0,
+            HFD=2.5,
+            AvgDist=abs(ra) + abs(dec),
+        )
+
+    def _settle_events(self, now):
+        """Return the settling events due, finishing the settle when it is time"""
+        settle = self.settle
+        elapsed = now - settle["started"]
+        if elapsed >= settle["seconds"]:
+            with self.lock:
+                self.settle = None
+            outcome = settle["outcome"]
+            fields = {"Status": 0 if outcome == "ok" else 1}
+            if outcome in SETTLE_ERRORS:
+                fields["Error"] = SETTLE_ERRORS[outcome]
+            return [self._event("SettleDone", TotalFrames=self.frame, **fields)]
+        remaining = 1 - elapsed / settle["seconds"]
+        return [
+            self._event(
+                "Settling",
+                Distance=settle["distance"] * remaining,
+                Time=elapsed,
+                SettleTime=settle["settle_time"],
+                StarLocked=True,
+            )
+        ]
+
+    def _emit(self):
+        next_guide = next_settle = time.monotonic()
+        while self.running:
+            now = time.monotonic()
+            events = []
+            if self.state == "Guiding" and not self.paused and self.guide_rate > 0:
+                while next_guide <= now:
+                    events.append(self._guide_step())
+                    next_guide += 1 / self.guide_rate
+            else:
+                next_guide = now
+            if self.settle is not None:
+                if next_settle <= now:
+                    events.extend(self._settle_events(now))
+                    next_settle = now + 1 / self.settle_rate
+            else:
+                next_settle = now
+            self.broadcast(events)
+            time.sleep(0.001)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument(
+        "--guide-rate", type=float, default=1.0, help="GuideStep events per second"
+    )
+    parser.add_argument(
+        "--settle-rate", type=float, default=10.0, help="Settling events per second"
+    )
+    parser.add_argument(
+        "--settle-seconds", type=float, default=1.0, help="seconds to settle"
+    )
+    parser.add_argument(
+        "--settle",
+        default="ok",
+        help="comma separated settle outcomes used in turn (ok, fail, timeout)",
+    )
+    parser.add_argument("--guide-rms", type=float, default=0.5, help="pixels")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    server = MockPHD2(
+        args.host,
+        args.port,
+        guide_rate=args.guide_rate,
+        settle_rate=args.settle_rate,
+        settle_seconds=args.settle_seconds,
+        settle_script=args.settle.split(","),
+        guide_rms=args.guide_rms,
+        seed=args.seed,
+    ).start()
+    print("Mock PHD2 listening on %s:%d" % (args.host, server.port), flush=True)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""
+RAW decoding benchmark
+
+Times decoding CR2 files into their CFA mosaic with cr2.read_cr2, fully and as a
+central crop, and the super-pixel debayer of the result, reporting the best of
+--repeat runs per file. Use files downloaded from the camera card (CardSync).
+
+    python benchmarks/rawdecode.py IMG_0001.CR2 --center 0.25 --binning 2
+"""
+
+import argparse
+import mmap
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def best_time(func, repeat):
+    """Return the shortest run time of func and its last result"""
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - started)
+    return min(times), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("files", nargs="+", help="CR2 files")
+    parser.add_argument(
+        "--center", type=float, default=0.25, help="central crop fraction"
+    )
+    parser.add_argument("--binning", type=int, default=1, help="debayer binning")
+    parser.add_argument("--pattern", default="RGGB", help="CFA pattern")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per file")
+    args = parser.parse_args()
+
+    from cr2 import read_cr2
+    from imaging import superpixel
+
+    print(
+        "%-24s %12s %10s %12s %10s %10s"
+        % ("file", "mosaic", "full s", "crop", "crop s", "debayer s")
+    )
+    for path in args.files:
+        with open(path, "rb") as f, mmap.mmap(
+            f.fileno(), 0, access=mmap.ACCESS_READ
+        ) as data:
+            full, mosaic = best_time(lambda: read_cr2(data), args.repeat)
+            crop_time, crop = best_time(
+                lambda: read_cr2(data, args.center), args.repeat
+            )
+        debayer, _ = best_time(
+            lambda mosaic=mosaic: superpixel(mosaic, args.pattern, args.binning),
+            args.repeat,
+        )
+        print(
+            "%-24s %12s %10.2f %12s %10.2f %10.2f"
+            % (
+                os.path.basename(path)[:24],
+                "%dx%d" % mosaic.shape[::-1],
+                full,
+                "%dx%d" % crop.shape[::-1],
+                crop_time,
+                debayer,
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
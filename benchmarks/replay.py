@@ -0,0 +1,70 @@
+"""
+Session replay benchmark
+
+Replays a session recorded with GALAXYDSLR_RECORD=<file> without camera nor
+PHD2, driving Control with the recorded capture commands, camera results and
+guider events, and reports how long the replay took and the frame rate
+compared to the recorded session.
+
+    python benchmarks/replay.py session.rec --speed 10
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("path", help="recorded session file")
+    parser.add_argument("--speed", type=float, default=1.0, help="replay speed")
+    parser.add_argument(
+        "--timeout", type=float, default=3600, help="maximum replay seconds"
+    )
+    args = parser.parse_args()
+
+    os.environ["GALAXYDSLR_REPLAY"] = os.path.abspath(args.path)
+    os.environ["GALAXYDSLR_REPLAY_SPEED"] = str(args.speed)
+    os.environ.setdefault("GALAXYDSLR_DATA_DIR", tempfile.mkdtemp(prefix="galaxydslr-"))
+    from flaskapp import app
+
+    recorded = [
+        record["t"] + record["duration"]
+        for record in app.player.records["dslr"]
+        if record["call"] == "capture_image_bulb"
+    ]
+    frames = []
+    started = time.monotonic()
+    control = app.control
+    control.add_frame_handler(lambda frame: frames.append(time.monotonic() - started))
+    threading.Thread(target=control.run, name="control", daemon=True).start()
+
+    # Wait for the last command to be issued and the capture to finish
+    deadline = started + args.timeout
+    app.player.finished.wait(args.timeout)
+    while control.current_status != control.STATUS_IDLE:
+        if time.monotonic() > deadline:
+            print("FAIL: replay did not finish in %.0fs" % args.timeout)
+            sys.exit(1)
+        time.sleep(0.1)
+    elapsed = time.monotonic() - started
+    # Replayed times in recording seconds
+    replayed = [t * args.speed for t in frames]
+
+    print("%-20s %10s %10s" % ("", "recorded", "replayed"))
+    print("%-20s %10d %10d" % ("frames", len(recorded), len(replayed)))
+    for name, times in (("recorded", recorded), ("replayed", replayed)):
+        if len(times) > 1:
+            interval = (times[-1] - times[0]) / (len(times) - 1)
+            print("%-20s %10.3f" % ("s/frame " + name, interval))
+    print("%-20s %10.2f" % ("wall seconds", elapsed))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,198 @@
+"""
+Multi-rig controller benchmark
+
+Runs many stand-in rig agents (rigs.RigAgent with synthetic capture status and
+frames instead of an application) in worker processes and a RigController
+connected to all of them. Reports how long connecting all agents and the
+coordinated sequence start and stop took, the status latency from agent to
+controller, the traffic received and the controller CPU use.
+
+    python benchmarks/rigs.py --agents 40 --processes 4 --seconds 20
+"""
+
+import argparse
+import io
+import logging
+import multiprocessing
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from rigs import RigAgent, RigController  # noqa: E402
+
+
+def make_jpeg(width, height):
+    """Return JPEG data of a noise image, roughly as hard to thumbnail as a frame"""
+    from PIL import Image
+
+    buf = io.BytesIO()
+    Image.effect_noise((width, height), 64).convert("RGB").save(buf, "JPEG")
+    return buf.getvalue()
+
+
+class StandInAgent(RigAgent):
+    """Agent capturing synthetic frames while a sequence runs"""
+
+    def __init__(self, rig_name, frame_interval, image):
+        super().__init__(None, 0, rig_name, logging.getLogger("agent"))
+        self.frame_interval = frame_interval
+        self.image = image
+        self.sequence = None
+        self.current_capture = 0
+        self.next_frame = 0
+
+    def collect_status(self):
+        now = time.time()
+        if self.sequence is not None and now >= self.next_frame:
+            self.next_frame = now + self.frame_interval
+            self.current_capture += 1
+            frame = {
+                "session": "bench",
+                "index": self.current_capture,
+                "captures": self.sequence["captures"],
+                "frame_type": "light",
+                "exposure": self.frame_interval,
+                "started": now,
+                "data": self.image,
+            }
+            self.submit(frame)
+        return {
+            "rig": {"camera_connected": True, "guider_connected": True},
+            "capture": {
+                "current_status": 0 if self.sequence is None else 1,
+                "current_capture": self.current_capture,
+                "updated": now,
+            },
+        }
+
+    def run_command(self, message):
+        if message["command"] == "capture_sequence":
+            self.sequence = message["blocks"][0]
+            self.current_capture = 0
+            return {"blocks": len(message["blocks"])}
+        if message["command"] == "capture_stop":
+            self.sequence = None
+            return {}
+        raise ValueError("Unknown command: %s" % message["command"])
+
+
+def run_agents(count, first, frame_interval, ports, stop):
+    """Serve count stand-in agents until stop is set"""
+    image = make_jpeg(1600, 1066)
+    agents = []
+    for n in range(count):
+        agent = StandInAgent("rig%d" % (first + n), frame_interval, image)
+        agent.serve()
+        agents.append(agent)
+    ports.put([agent.port for agent in agents])
+    stop.wait()
+
+
+class MeasuredController(RigController):
+    """Controller recording the age of the capture status received"""
+
+    def __init__(self, logger):
+        super().__init__(logger)
+        self.latencies = []
+
+    def handle(self, link, message, payload):
+        capture = (message.get("sections") or {}).get("capture")
+        if capture is not None:
+            self.latencies.append(time.time() - capture["updated"])
+        super().handle(link, message, payload)
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--agents", type=int, default=40, help="rig agents")
+    parser.add_argument(
+        "--processes", type=int, default=4, help="agent worker processes"
+    )
+    parser.add_argument("--seconds", type=float, default=20, help="capture seconds")
+    parser.add_argument(
+        "--frame-interval", type=float, default=2, help="seconds between frames"
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+
+    context = multiprocessing.get_context("spawn")
+    ports = context.Queue()
+    stop = context.Event()
+    workers = []
+    first = 0
+    for n in range(args.processes):
+        count = args.agents // args.processes + (n < args.agents % args.processes)
+        workers.append(
+            context.Process(
+                target=run_agents,
+                args=(count, first, args.frame_interval, ports, stop),
+                daemon=True,
+            )
+        )
+        first += count
+    for worker in workers:
+        worker.start()
+    addresses = [
+        "127.0.0.1:%d" % port for _ in workers for port in ports.get(timeout=60)
+    ]
+
+    controller = MeasuredController(logging.getLogger("rigs"))
+    started = time.monotonic()
+    for address in addresses:
+        controller.add_rig(address)
+    while controller.get_status()["connected"] < len(addresses):
+        if time.monotonic() - started > 30:
+            raise SystemExit("Agents did not connect")
+        time.sleep(0.01)
+    connect_time = time.monotonic() - started
+
+    started = time.monotonic()
+    controller.start_sequence([{"exposure": args.frame_interval, "captures": 1000}])
+    start_time = time.monotonic() - started
+    del controller.latencies[:]
+    before = controller.get_status()
+    cpu = time.process_time()
+    time.sleep(args.seconds)
+    cpu = time.process_time() - cpu
+    after = controller.get_status()
+    started = time.monotonic()
+    controller.stop_sequence()
+    stop_time = time.monotonic() - started
+    stop.set()
+    for worker in workers:
+        worker.join()
+
+    latencies = controller.latencies
+    print("%d agents in %d processes" % (len(addresses), args.processes))
+    print("connect all       %8.1f ms" % (connect_time * 1000))
+    print("sequence start    %8.1f ms" % (start_time * 1000))
+    print("sequence stop     %8.1f ms" % (stop_time * 1000))
+    print(
+        "status latency    %8.1f ms p50 %8.1f ms p95 %8.1f ms max"
+        % (
+            percentile(latencies, 50) * 1000,
+            percentile(latencies, 95) * 1000,
+            max(latencies) * 1000,
+        )
+    )
+    print(
+        "received          %8.1f msg/s %6.1f frames/s %8.1f KB/s"
+        % (
+            (after["messages"] - before["messages"]) / args.seconds,
+            (after["frames"] - before["frames"]) / args.seconds,
+            (after["bytes_in"] - before["bytes_in"]) / args.seconds / 1024,
+        )
+    )
+    print("controller CPU    %8.1f %%" % (cpu * 100 / args.seconds))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""
+Startup time benchmark
+
+Measures, in fresh interpreters, how long it takes to import the web application,
+to bind the HTTP server and to load each backend component. Use --max-bind to make
+the benchmark fail when binding the server gets slower than the given seconds.
+
+    python benchmarks/startup.py --runs 5 --max-bind 1.0
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PROBE = """
+import json, time
+t0 = time.perf_counter()
+timings = {}
+import flask
+timings["import flask"] = time.perf_counter() - t0
+t = time.perf_counter()
+from flaskapp import app
+timings["import flaskapp"] = time.perf_counter() - t
+t = time.perf_counter()
+from werkzeug.serving import make_server
+server = make_server("127.0.0.1", 0, app)
+timings["bind server"] = time.perf_counter() - t
+timings["ready to serve"] = time.perf_counter() - t0
+app._warmup()
+for name, elapsed in app.load_times.items():
+    timings["load " + name] = elapsed
+timings["all components loaded"] = time.perf_counter() - t0
+server.server_close()
+print(json.dumps(timings))
+"""
+
+
+def run_probe():
+    output = subprocess.check_output([sys.executable, "-c", PROBE], cwd=ROOT)
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--runs", type=int, default=3, help="number of cold starts")
+    parser.add_argument(
+        "--max-bind",
+        type=float,
+        default=None,
+        help="fail if the time until the server is bound exceeds this (seconds)",
+    )
+    args = parser.parse_args()
+
+    results = {}
+    for _ in range(args.runs):
+        for phase, elapsed in run_probe().items():
+            results.setdefault(phase, []).append(elapsed)
+
+    print("%-28s %10s %10s" % ("phase", "median ms", "max ms"))
+    for phase, values in results.items():
+        print(
+            "%-28s %10.1f %10.1f"
+            % (phase, statistics.median(values) * 1000, max(values) * 1000)
+        )
+
+    if args.max_bind is not None:
+        ready = statistics.median(results["ready to serve"])
+        if ready > args.max_bind:
+            print("FAIL: server ready after %.3fs (max %.3fs)" % (ready, args.max_bind))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
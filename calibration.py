@@ -0,0 +1,246 @@
+"""Calibration frames management"""
+
+import glob
+import os
+import shutil
+import threading
+import time
+
+import numpy as np
+
+from imaging import decode_jpeg
+from pipeline import FrameStage
+from settings import data_path
+
+
+def combine(stack, method="sigma", kappa=3.0, iterations=2):
+    """Combine a (frames, ...) stack along the first axis"""
+    if method == "median":
+        return np.median(stack, axis=0)
+    data = np.asarray(stack, dtype=np.float32)
+    for _ in range(iterations):
+        center = np.nanmedian(data, axis=0)
+        sigma = np.nanstd(data, axis=0)
+        with np.errstate(invalid="ignore"):
+            data[np.abs(data - center) > kappa * sigma] = np.nan
+    return np.nanmean(data, axis=0)
+
+
+class CalibrationLibrary(FrameStage):
+    """
+    Calibration masters builder
+
+    Dark, flat and bias frames are stored on disk as they arrive. When their
+    capture session ends (or on request) they are combined into a master frame in
+    the stage thread, after the frames queued before. Combination is done in tiles
+    of rows over memory mapped frames, so memory usage is bounded by TILE_BYTES
+    regardless of the number of frames. Build errors are kept in the status.
+
+    Masters are applied to light frames in the live analysis path with apply().
+    """
+
+    name = "calibration"
+
+    FRAME_TYPES = ["dark", "flat", "bias"]
+
+    # Calibration frames must never be dropped
+    QUEUE_SIZE = 0
+
+    # Frames are binned like in the live stack so masters match analysed frames
+    BINNING = 2
+    # Combination method ("median" or "sigma") and sigma clipping parameters
+    METHOD = "sigma"
+    KAPPA = 3.0
+    ITERATIONS = 2
+    # Maximum memory used by a combination tile
+    TILE_BYTES = 32 * 1024 * 1024
+    # Keep individual frames after building a master
+    KEEP_FRAMES = False
+
+    def __init__(self, logger=None):
+        super().__init__(logger)
+        self.lock = threading.Lock()
+        self.build_lock = threading.Lock()
+        self.base_path = os.path.dirname(data_path("calibration", "masters"))
+        self.masters = {}
+        self.building = None
+        self.error = None
+        self.load_masters()
+
+    def _master_path(self, frame_type):
+        return os.path.join(self.base_path, "master_%s.npy" % frame_type)
+
+    def _frames_path(self, session, frame_type):
+        return os.path.join(self.base_path, "frames", session, frame_type)
+
+    def load_masters(self):
+        for frame_type in self.FRAME_TYPES:
+            path = self._master_path(frame_type)
+            if os.path.exists(path):
+                with self.lock:
+                    self.masters[frame_type] = np.load(path, mmap_mode="r")
+
+    def get_status(self):
+        pending = []
+        pattern = os.path.join(self.base_path, "frames", "*", "*")
+        for path in sorted(glob.glob(pattern)):
+            session, frame_type = path.split(os.sep)[-2:]
+            pending.append(
+                {
+                    "session": session,
+                    "frame_type": frame_type,
+                    "frames": len(glob.glob(os.path.join(path, "*.npy"))),
+                }
+            )
+        masters = {}
+        with self.lock:
+            for frame_type, master in self.masters.items():
+                masters[frame_type] = {
+                    "shape": master.shape,
+                    "built": os.path.getmtime(self._master_path(frame_type)),
+                }
+        return {
+            "masters": masters,
+            "pending": pending,
+            "building": self.building,
+            "error": self.error,
+        }
+
+    def process(self, frame):
+        if frame.get("build"):
+            self._build(frame["session"], frame["frame_type"], frame["method"])
+            return
+        frame_type = frame.get("frame_type", "light")
+        if frame_type not in self.FRAME_TYPES:
+            return
+        path = self._frames_path(frame["session"], frame_type)
+        os.makedirs(path, exist_ok=True)
+        image = decode_jpeg(frame["data"], self.BINNING, dtype=np.uint8)
+        np.save(os.path.join(path, "%05d.npy" % frame["index"]), image)
+
+    def session_ended(self, session, frame_type):
+        """Build the master of a calibration session once its frames are stored"""
+        if frame_type in self.FRAME_TYPES:
+            self._queue_build(session, frame_type)
+
+    def request_build(self, session, frame_type, method=None):
+        """Queue building a master after the frames waiting to be stored"""
+        if frame_type not in self.FRAME_TYPES:
+            raise ValueError("Invalid calibration frame type: %s" % frame_type)
+        if self.queue.empty() and not self._frame_files(session, frame_type):
+            raise ValueError(
+                "No %s frames found for session %s" % (frame_type, session)
+            )
+        self._queue_build(session, frame_type, method)
+
+    def _queue_build(self, session, frame_type, method=None):
+        self.start()
+        self.queue.put(
+            {
+                "build": True,
+                "session": session,
+                "frame_type": frame_type,
+                "method": method,
+            }
+        )
+
+    def _build(self, session, frame_type, method):
+        try:
+            self.build(session, frame_type, method)
+            self.error = None
+        except Exception as e:
+            self.error = "Failed building %s master of session %s: %s" % (
+                frame_type,
+                session,
+                e,
+            )
+            self.logger.error("calibration: %s", self.error)
+
+    def _frame_files(self, session, frame_type):
+        path = self._frames_path(session, frame_type)
+        return sorted(glob.glob(os.path.join(path, "*.npy")))
+
+    def build(self, session, frame_type, method=None):
+        """Build a master frame from the frames stored for a session"""
+        if frame_type not in self.FRAME_TYPES:
+            raise ValueError("Invalid calibration frame type: %s" % frame_type)
+        method = method or self.METHOD
+        path = self._frames_path(session, frame_type)
+        files = self._frame_files(session, frame_type)
+        if not files:
+            raise ValueError(
+                "No %s frames found for session %s" % (frame_type, session)
+            )
+        with self.build_lock:
+            self.building = {"session": session, "frame_type": frame_type}
+            try:
+                started = time.time()
+                tmp_path = self._master_path(frame_type) + ".tmp.npy"
+                self._combine_files(files, frame_type, method, tmp_path)
+                os.replace(tmp_path, self._master_path(frame_type))
+                with self.lock:
+                    self.masters[frame_type] = np.load(
+                        self._master_path(frame_type), mmap_mode="r"
+                    )
+                self.logger.info(
+                    "calibration: Built master %s from %s frames in %.1fs",
+                    frame_type,
+                    len(files),
+                    time.time() - started,
+                )
+            finally:
+                self.building = None
+        if not self.KEEP_FRAMES:
+            shutil.rmtree(path, ignore_errors=True)
+            try:
+                os.rmdir(os.path.dirname(path))
+            except OSError:
+                pass
+
+    def _combine_files(self, files, frame_type, method, output_path):
+        frames = [np.load(f, mmap_mode="r") for f in files]
+        shape = frames[0].shape
+        for frame in frames:
+            if frame.shape != shape:
+                raise ValueError("Calibration frames have different sizes")
+        row_bytes = len(frames) * frames[0][0].size * 4
+        rows = max(1, self.TILE_BYTES // row_bytes)
+        master = np.lib.format.open_memmap(
+            output_path, mode="w+", dtype=np.float32, shape=shape
+        )
+        # Flats are corrected with the available bias or dark master before combining
+        offset = None
+        if frame_type == "flat":
+            offset = self.masters.get("bias", self.masters.get("dark"))
+            if offset is not None and offset.shape != shape:
+                offset = None
+        for start in range(0, shape[0], rows):
+            end = min(start + rows, shape[0])
+            tile = np.stack([frame[start:end] for frame in frames]).astype(np.float32)
+            if offset is not None:
+                tile -= offset[start:end]
+            master[start:end] = combine(tile, method, self.KAPPA, self.ITERATIONS)
+        if frame_type == "flat":
+            # Normalize each channel to a median of 1
+            for channel in range(shape[2]):
+                plane = master[..., channel]
+                plane /= max(float(np.median(plane[::4, ::4])), 1e-6)
+        master.flush()
+
+    def clear(self, frame_type):
+        with self.lock:
+            self.masters.pop(frame_type, None)
+        path = self._master_path(frame_type)
+        if os.path.exists(path):
+            os.remove(path)
+
+    def apply(self, image):
+        """Calibrate a light frame with the available masters"""
+        with self.lock:
+            dark = self.masters.get("dark", self.masters.get("bias"))
+            flat = self.masters.get("flat")
+        if dark is not None and dark.shape == image.shape:
+            image = image - dark
+        if flat is not None and flat.shape == image.shape:
+            image = image / np.maximum(flat, 1e-3)
+        return image
@@ -3,7 +3,6 @@
 # Python modules
 import base64
 import logging
-import tempfile
 import time
 
 # GPhoto2 module
@@ -11,9 +10,6 @@ import gphoto2 as gp
 
 
 class DSLRManager:
-
-    TEMP_FILES_PREFIX = "astrocamweb"
-
     DEFAULT_CONFIG_ELEMS = [
         "iso",
         "aperture",
@@ -144,14 +140,8 @@ class DSLRManager:
     def load_image_from_camera(self, path):
         logging.info("Loading image from camera: %s %s", path.folder, path.name)
         camera_file = self.cam.file_get(path.folder, path.name, gp.GP_FILE_TYPE_NORMAL)
-        fd, tmp_path = tempfile.mkstemp(prefix=self.TEMP_FILES_PREFIX)
-        camera_file.save(tmp_path)
-
-        with open(tmp_path, "rb") as fd:
-            data = fd.read()
-            fd.close()
-
-        return data
+        # The data view is only valid while the camera file is alive
+        return bytearray(camera_file.get_data_and_size())
 
     def quit(self):
         logging.info("Exiting")
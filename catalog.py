@@ -0,0 +1,217 @@
+"""Frame catalog"""
+
+import json
+import sqlite3
+import threading
+
+from pipeline import FrameStage
+from settings import data_path
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS frames (
+    id INTEGER PRIMARY KEY,
+    session TEXT NOT NULL,
+    idx INTEGER NOT NULL,
+    frame_type TEXT,
+    started REAL,
+    finished REAL,
+    exposure REAL,
+    exposure_measured REAL,
+    iso TEXT,
+    camera_path TEXT,
+    jpeg_path TEXT,
+    fits_path TEXT,
+    guide_rms REAL,
+    guide_rms_ra REAL,
+    guide_rms_dec REAL,
+    metrics TEXT,
+    UNIQUE (session, idx)
+);
+CREATE INDEX IF NOT EXISTS frames_started ON frames (started);
+CREATE INDEX IF NOT EXISTS frames_type_started ON frames (frame_type, started);
+CREATE INDEX IF NOT EXISTS frames_guide_rms ON frames (guide_rms);
+"""
+
+
+class FrameCatalog(FrameStage):
+    """
+    SQLite catalog of captured frames
+
+    Every frame produced by Control is recorded with its session, index, timing,
+    exposure, ISO, file paths, guiding RMS and analysis metrics. Other stages add
+    their results later with record() and update_metrics(), keyed by session and
+    frame index, so the order in which stages finish does not matter.
+    """
+
+    name = "catalog"
+
+    QUEUE_SIZE = 0
+    NEEDS_DATA = False
+
+    COLUMNS = [
+        "frame_type",
+        "started",
+        "finished",
+        "exposure",
+        "exposure_measured",
+        "iso",
+        "camera_path",
+        "jpeg_path",
+        "fits_path",
+        "guide_rms",
+        "guide_rms_ra",
+        "guide_rms_dec",
+    ]
+
+    # Sortable columns for queries
+    ORDER_COLUMNS = ["started", "session", "idx", "guide_rms", "exposure"]
+
+    MAX_PAGE_SIZE = 500
+
+    def __init__(self, logger=None, path=None):
+        super().__init__(logger)
+        self.path = path or data_path("catalog.sqlite3")
+        self.local = threading.local()
+        self.metrics_lock = threading.Lock()
+        with self.connection() as conn:
+            conn.executescript(SCHEMA)
+
+    def connection(self):
+        """Return the connection of the current thread"""
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+        return conn
+
+    def process(self, frame):
+        fields = {
+            "frame_type": frame.get("frame_type", "light"),
+            "started": frame["started"],
+            "finished": frame["finished"],
+            "exposure": frame["exposure"],
+            "iso": frame.get("iso"),
+            "camera_path": frame.get("camera_path"),
+        }
+        # Time the shutter was open
+        opened, closed = frame.get("shutter_opened"), frame.get("shutter_closed")
+        if opened is not None and closed is not None:
+            fields["exposure_measured"] = closed - opened
+        stats = frame.get("guide_stats")
+        if stats:
+            fields["guide_rms"] = stats["rms_tot"]
+            fields["guide_rms_ra"] = stats["rms_ra"]
+            fields["guide_rms_dec"] = stats["rms_dec"]
+        self.record(frame["session"], frame["index"], **fields)
+
+    def record(self, session, index, **fields):
+        """Insert or update the given fields of a frame"""
+        for name in fields:
+            if name not in self.COLUMNS:
+                raise ValueError("Unknown catalog field: %s" % name)
+        names = list(fields)
+        sql = "INSERT INTO frames (session, idx%s) VALUES (?, ?%s)" % (
+            "".join(", " + name for name in names),
+            ", ?" * len(names),
+        )
+        if names:
+            sql += " ON CONFLICT (session, idx) DO UPDATE SET %s" % ", ".join(
+                "%s = excluded.%s" % (name, name) for name in names
+            )
+        else:
+            sql += " ON CONFLICT (session, idx) DO NOTHING"
+        with self.connection() as conn:
+            conn.execute(sql, [session, index] + [fields[name] for name in names])
+
+    def update_metrics(self, session, index, metrics):
+        """Merge analysis metrics into the metrics of a frame"""
+        with self.metrics_lock, self.connection() as conn:
+            row = conn.execute(
+                "SELECT metrics FROM frames WHERE session = ? AND idx = ?",
+                (session, index),
+            ).fetchone()
+            current = json.loads(row["metrics"]) if row and row["metrics"] else {}
+            current.update(metrics)
+            conn.execute(
+                "INSERT INTO frames (session, idx, metrics) VALUES (?, ?, ?) "
+                "ON CONFLICT (session, idx) DO UPDATE SET metrics = excluded.metrics",
+                (session, index, json.dumps(current)),
+            )
+
+    @staticmethod
+    def _row(row):
+        frame = dict(row)
+        frame["metrics"] = json.loads(frame["metrics"]) if frame["metrics"] else {}
+        return frame
+
+    def query(
+        self,
+        session=None,
+        frame_type=None,
+        since=None,
+        until=None,
+        max_guide_rms=None,
+        order="started",
+        descending=False,
+        page=1,
+        per_page=50,
+    ):
+        """Return a page of frames matching the given filters"""
+        if order not in self.ORDER_COLUMNS:
+            raise ValueError("Invalid order column: %s" % order)
+        per_page = max(1, min(per_page, self.MAX_PAGE_SIZE))
+        page = max(1, page)
+        where = []
+        parms = []
+        for clause, value in [
+            ("session = ?", session),
+            ("frame_type = ?", frame_type),
+            ("started >= ?", since),
+            ("started < ?", until),
+            ("guide_rms <= ?", max_guide_rms),
+        ]:
+            if value is not None:
+                where.append(clause)
+                parms.append(value)
+        where_sql = " WHERE " + " AND ".join(where) if where else ""
+        conn = self.connection()
+        total = conn.execute("SELECT COUNT(*) FROM frames" + where_sql, parms)
+        total = total.fetchone()[0]
+        rows = conn.execute(
+            "SELECT * FROM frames%s ORDER BY %s %s, id LIMIT ? OFFSET ?"
+            % (where_sql, order, "DESC" if descending else "ASC"),
+            parms + [per_page, (page - 1) * per_page],
+        ).fetchall()
+        return {
+            "frames": [self._row(row) for row in rows],
+            "total": total,
+            "page": page,
+            "per_page": per_page,
+        }
+
+    def get_frame(self, session, index):
+        row = self.connection().execute(
+            "SELECT * FROM frames WHERE session = ? AND idx = ?", (session, index)
+        )
+        row = row.fetchone()
+        return self._row(row) if row else None
+
+    def stored_camera_paths(self):
+        """Return the saved JPEG paths of the catalogued frames by camera path"""
+        rows = self.connection().execute(
+            "SELECT camera_path, jpeg_path FROM frames "
+            "WHERE camera_path IS NOT NULL AND jpeg_path IS NOT NULL"
+        )
+        return dict(tuple(row) for row in rows)
+
+    def sessions(self):
+        """Return captured sessions with their frame counts"""
+        rows = self.connection().execute(
+            "SELECT session, COUNT(*) AS frames, MIN(started) AS started, "
+            "MAX(finished) AS finished FROM frames "
+            "GROUP BY session ORDER BY started DESC"
+        )
+        return [dict(row) for row in rows]
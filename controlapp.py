@@ -1,7 +1,11 @@
 """Control application"""
 
+import threading
 import time
 
+from logsetup import get_logger
+from sequence import build_block
+
 
 class Control:
     """
@@ -16,51 +20,236 @@ class Control:
 
     # Loop delay in seconds
     LOOP_DELAY = 0.5
+    # Intervalometer: seconds a slot may be missed by before it is skipped, and
+    # before a shutter opening is reported as late
+    SLOT_TOLERANCE = 1.0
+    LATE_THRESHOLD = 0.05
+    # Seconds of the exposure kept free when downloading the previous frame
+    DOWNLOAD_MARGIN = 1.0
 
     cached_camera_list = None
     cached_camera_config = None
+    # Session recorder receiving capture commands (see recording.Recorder)
+    recorder = None
 
     def __init__(self, webapp):
         self.webapp = webapp
+        self.logger = get_logger("control")
         self.current_status = self.STATUS_IDLE
         self.current_capture = 0
         self.last_image = None
         self.last_capture = 0
         self.capture_parms = None
         self.dither_status = None
+        self.session = None
+        self.frame_handlers = []
+        self.session_handlers = []
+        # Whether the session handlers are still to be told the session ended
+        self.session_open = False
+        self.sequence_id = None
+        self.blocks = []
+        self.current_block = 0
+        self.prefetched_block = None
+        # Frames captured by block index and block index by session
+        self.block_captures = {}
+        self.block_sessions = {}
+        # Replacement exposures by block index, queued by the quality gate
+        # thread and taken by the control loop, and their totals
+        self.reshoot_lock = threading.Lock()
+        self.queued_reshoots = {}
+        self.reshoots = {}
+        self.scores_deadline = None
+        self.last_guide_stats = None
+        self.interval_status = None
+        self.slot_origin = None
+        self.offset_squares = 0.0
+        self.pending_frame = None
+        # Set by capture_stop to interrupt intervalometer waits
+        self.stopped = threading.Event()
+        # Measured seconds from calling capture to the shutter opening and of
+        # the last deferred download
+        self.press_latency = 0.0
+        self.download_seconds = 0.0
+
+    def add_frame_handler(self, handler):
+        """Register a callable receiving every captured frame. It must not block"""
+        self.frame_handlers.append(handler)
+
+    def dispatch_frame(self, frame):
+        for handler in self.frame_handlers:
+            try:
+                handler(frame)
+            except Exception as e:
+                self.logger.error("Control: Frame handler failed: %s", e)
+
+    def add_session_handler(self, handler):
+        """
+        Register a callable receiving the session and frame type of every capture
+        session once it ended, after all its frames. It must not block
+        """
+        self.session_handlers.append(handler)
+
+    def end_session(self):
+        if not self.session_open:
+            return
+        self.session_open = False
+        for handler in self.session_handlers:
+            try:
+                handler(self.session, self.capture_parms["frame_type"])
+            except Exception as e:
+                self.logger.error("Control: Session handler failed: %s", e)
 
     def run(self):
         while True:
             self.loop_iteration()
-            time.sleep(self.LOOP_DELAY)
+            # Frames and sequence blocks are captured back to back
+            if self.current_status != self.STATUS_CAPTURING:
+                time.sleep(self.LOOP_DELAY)
 
     def loop_iteration(self):
-        self.webapp.logger.debug("Control: Looping")
+        self.logger.debug("Control: Looping")
         # Control loop
         if self.current_status == self.STATUS_CAPTURING:
+            self.capture_parms["captures"] += self.take_reshoots(self.current_block)
+            if (
+                self.prefetched_block is not None
+                and self.current_capture < self.capture_parms["captures"]
+            ):
+                # Replacements were queued after the next block config was applied
+                self.prefetched_block = None
+                self.apply_block_config(self.current_block)
             if self.current_capture == self.capture_parms["captures"]:
-                print("Finished capturing process")
-                self.current_status = self.STATUS_STOPPING
-            else:
+                index = self.next_block()
+                if index is None and self.waiting_scores():
+                    return
+                if index is not None:
+                    try:
+                        if index != self.current_block:
+                            self.end_session()
+                        self.start_block(index)
+                    except Exception as e:
+                        self.logger.error(
+                            "Control: Failed starting sequence block: %s", e
+                        )
+                        self.current_status = self.STATUS_STOPPING
+                else:
+                    self.logger.info("Control: Finished capturing process")
+                    self.current_status = self.STATUS_STOPPING
+            interval = 0
+            if self.current_status == self.STATUS_CAPTURING:
+                interval = self.capture_parms.get("interval") or 0
+                if interval:
+                    # Captures stopped during the wait skip the frame
+                    deadline = self.wait_slot(interval)
+            if self.current_status == self.STATUS_CAPTURING:
                 self.current_capture += 1
-                print(
-                    "Stared capturing image {}/{}".format(
-                        self.current_capture, self.capture_parms["captures"]
-                    )
+                self.block_captures[self.current_block] = self.current_capture
+                self.logger.info(
+                    "Control: Started capturing image %d/%d",
+                    self.current_capture,
+                    self.capture_parms["captures"],
                 )
+                exposure = self.capture_parms["exposure"]
                 # Capture image
-                self.last_image = self.webapp.dslr.capture_image_bulb(
-                    self.capture_parms["exposure"]
-                )
-                self.last_capture = self.current_capture
-                time.sleep(self.capture_parms["exposure"])
-                print(
-                    "Finished capturing image {}/{}".format(
-                        self.current_capture, self.capture_parms["captures"]
+                iso = self.get_cached_config_value("iso")
+                started = time.time()
+                started_monotonic = time.monotonic()
+                last_frame = self.current_capture == self.capture_parms["captures"]
+                # The next block is configured before downloading the last frame
+                prefetch = self.next_block() if last_frame else None
+                if prefetch == self.current_block:
+                    prefetch = None
+                pending = self.pending_frame
+                self.pending_frame = None
+                # Monotonic times of the shutter opening and closing, and their
+                # wall clock times
+                opened = []
+                released = []
+                opened_at = []
+                closed = []
+
+                def after_press():
+                    opened_at.append(time.time())
+                    opened.append(time.monotonic())
+                    if pending is not None:
+                        # The previous frame downloads during this exposure
+                        self.download_frame(pending)
+
+                def after_release():
+                    closed.append(time.time())
+                    released.append(time.monotonic())
+
+                if interval:
+                    # Downloads are deferred to the next exposure if they fit
+                    defer = (
+                        not last_frame
+                        and self.download_seconds + self.DOWNLOAD_MARGIN < exposure
+                    )
+                    pressed = time.monotonic()
+                    image_data = self.webapp.dslr.capture_image_bulb(
+                        exposure,
+                        after_release,
+                        after_press,
+                        not defer and prefetch is None,
                     )
+                    self.slot_opened(deadline, pressed, opened)
+                else:
+                    defer = False
+                    image_data = self.webapp.dslr.capture_image_bulb(
+                        exposure, after_release, after_press, prefetch is None
+                    )
+                if pending is not None and not opened:
+                    self.download_frame(pending)
+                if prefetch is not None:
+                    # The camera wrote the last frame, configure the next block
+                    # before downloading it
+                    self.prefetch_block(prefetch)
+                finished = time.time()
+                try:
+                    # Guiding while the shutter was open
+                    guide_stats = self.webapp.guider.get_exposure_stats(
+                        opened[0] if opened else started_monotonic,
+                        released[0] if released else time.monotonic(),
+                    )
+                    self.last_guide_stats = guide_stats
+                except Exception as e:
+                    self.logger.error("Control: Failed reading guide stats: %s", e)
+                    guide_stats = None
+                frame = {
+                    "session": self.session,
+                    "index": self.current_capture,
+                    "captures": self.capture_parms["captures"],
+                    "frame_type": self.capture_parms["frame_type"],
+                    "exposure": exposure,
+                    "started": started,
+                    "finished": finished,
+                    "shutter_opened": opened_at[0] if opened_at else None,
+                    "shutter_closed": closed[0] if closed else None,
+                    "iso": iso,
+                    "guide_stats": guide_stats,
+                    "camera_path": self.webapp.dslr.last_file,
+                    "data": image_data,
+                }
+                camera_path = frame["camera_path"] or ""
+                if defer and camera_path.lower().endswith("jpg"):
+                    self.pending_frame = frame
+                elif prefetch is not None and camera_path.lower().endswith("jpg"):
+                    self.download_frame(frame)
+                else:
+                    if image_data is not None:
+                        self.last_image = image_data
+                    self.dispatch_frame(frame)
+                    self.last_capture = self.current_capture
+                self.logger.info(
+                    "Control: Finished capturing image %d/%d",
+                    self.current_capture,
+                    self.capture_parms["captures"],
                 )
                 # Check dithering
-                if self.current_capture < self.capture_parms["captures"]:
+                if (
+                    self.capture_parms["dither"]
+                    and self.current_capture < self.capture_parms["captures"]
+                ):
                     if self.current_capture % self.capture_parms["dither_n"] == 0:
                         self.current_status = self.STATUS_DITHERING
                         try:
@@ -71,9 +260,11 @@ class Control:
                                 settle_timeout=self.capture_parms["settle_timeout"],
                             )
                         except Exception as e:
-                            print("Error starting dithering: ", e)
+                            self.logger.error(
+                                "Control: Error starting dithering: %s", e
+                            )
         if self.current_status == self.STATUS_DITHERING:
-            print("Dithering")
+            self.logger.debug("Control: Dithering")
             try:
                 settled, settling = self.webapp.guider.check_settled()
                 if settled:
@@ -87,17 +278,22 @@ class Control:
                         "time": settling.Time,
                         "settle_time": settling.SettleTime,
                     }
-                    print("Dithering status: %s" % self.dither_status)
+                    self.logger.info(
+                        "Control: Dithering status: %s", self.dither_status
+                    )
             except Exception as e:
                 # TODO: Status error and error messages
-                print("Dithering error: ", e)
+                self.logger.error("Control: Dithering error: %s", e)
         if self.current_status == self.STATUS_STOPPING:
-            print("Stopping captures")
+            if self.pending_frame is not None:
+                frame, self.pending_frame = self.pending_frame, None
+                self.download_frame(frame)
+            self.end_session()
             self.current_status = self.STATUS_IDLE
-            print("Stopped captures")
+            self.logger.info("Control: Stopped captures")
 
     def process_message(self, message):
-        self.webapp.logger.debug("Control: Message received: %s", message)
+        self.logger.debug("Control: Message received: %s", message)
 
     def capture_start(
         self,
@@ -109,30 +305,257 @@ class Control:
         settle_px,
         settle_time,
         settle_timeout,
+        frame_type="light",
+        interval=0,
     ):
+        block = build_block(
+            {
+                "exposure": exposure,
+                "captures": captures,
+                "dither": dither,
+                "dither_n": dither_n,
+                "dither_px": dither_px,
+                "settle_px": settle_px,
+                "settle_time": settle_time,
+                "settle_timeout": settle_timeout,
+                "frame_type": frame_type,
+                "interval": interval,
+            }
+        )
+        self.capture_sequence([block])
+
+    def capture_sequence(self, blocks):
+        """
+        Start capturing an ordered list of blocks (see sequence.build_block)
+
+        Each block applies its camera configuration changes and captures its
+        frames in its own session. Multi block sequences name sessions after the
+        sequence start time and the block number.
+        """
+        if self.recorder is not None:
+            self.recorder.record("control", call="capture_sequence", args=[blocks])
         # Cache camera list and current camera config
         self.cached_camera_list = self.webapp.dslr.get_camera_list()
         self.cached_camera_config = self.webapp.dslr.get_config()
 
-        # Initialize capture configuration parameters
-        self.capture_parms = {
-            "exposure": exposure,
-            "captures": captures,
-            "dither": dither,
-            "dither_n": dither_n,
-            "dither_px": dither_px,
-            "settle_px": settle_px,
-            "settle_time": settle_time,
-            "settle_timeout": settle_timeout,
-        }
         # Initialize capture status parameters
-        self.current_capture = 0
+        self.sequence_id = time.strftime("%Y%m%d-%H%M%S")
+        self.stopped.clear()
+        self.blocks = blocks
+        self.prefetched_block = None
+        self.block_captures = {}
+        self.scores_deadline = None
+        with self.reshoot_lock:
+            self.block_sessions = {}
+            self.queued_reshoots = {}
+            self.reshoots = {}
         self.last_image = None
         self.last_capture = 0
+        self.last_guide_stats = None
+        self.start_block(0)
         self.current_status = self.STATUS_CAPTURING
 
+    def apply_block_config(self, index):
+        changes = self.webapp.dslr.apply_config(self.blocks[index]["config"])
+        self.update_cached_config(changes)
+        return changes
+
+    def prefetch_block(self, index):
+        """Apply the camera configuration of the next block ahead of time"""
+        if index is None or index == self.current_block:
+            return
+        try:
+            self.apply_block_config(index)
+            self.prefetched_block = index
+        except Exception as e:
+            self.logger.error(
+                "Control: Failed prefetching block %d config: %s", index + 1, e
+            )
+
+    def wait_slot(self, interval):
+        """
+        Wait for the next intervalometer slot returning its monotonic deadline
+
+        Slots are fixed deadlines counted from the first frame of the block, so
+        delays never accumulate, and the shutter is pressed ahead by the measured
+        press latency. Slots already missed by more than SLOT_TOLERANCE seconds
+        are skipped and counted. The wait ends early when captures are stopped.
+        """
+        status = self.interval_status
+        now = time.monotonic()
+        if self.slot_origin is None:
+            self.slot_origin = now + self.press_latency
+            status["slot"] = 0
+        else:
+            status["slot"] += 1
+        deadline = self.slot_origin + status["slot"] * interval
+        if now + self.press_latency > deadline + self.SLOT_TOLERANCE:
+            slot = int((now + self.press_latency - self.slot_origin) // interval) + 1
+            status["missed"] += slot - status["slot"]
+            self.logger.warning(
+                "Control: Missed %d intervalometer slots", slot - status["slot"]
+            )
+            status["slot"] = slot
+            deadline = self.slot_origin + slot * interval
+        delay = deadline - self.press_latency - time.monotonic()
+        if delay > 0:
+            self.stopped.wait(delay)
+        return deadline
+
+    def slot_opened(self, deadline, pressed, opened):
+        """Record how far from its slot deadline the shutter opened"""
+        if not opened:
+            return
+        self.press_latency = opened[0] - pressed
+        offset = opened[0] - deadline
+        status = self.interval_status
+        status["frames"] += 1
+        status["last_offset"] = offset
+        status["max_offset"] = max(status["max_offset"], abs(offset))
+        self.offset_squares += offset * offset
+        status["offset_rms"] = (self.offset_squares / status["frames"]) ** 0.5
+        if offset > self.LATE_THRESHOLD:
+            status["late"] += 1
+            self.logger.warning("Control: Shutter opened %.3fs late", offset)
+
+    def download_frame(self, frame):
+        """Download and dispatch a frame left on the camera by its capture"""
+        started = time.monotonic()
+        try:
+            frame["data"] = self.webapp.dslr.download_file(frame["camera_path"])
+        except Exception as e:
+            self.logger.error(
+                "Control: Failed downloading frame %d: %s", frame["index"], e
+            )
+        self.download_seconds = time.monotonic() - started
+        if frame["data"] is not None:
+            self.last_image = frame["data"]
+        self.dispatch_frame(frame)
+        self.last_capture = frame["index"]
+
+    def next_block(self):
+        """
+        Return the index of the next block to capture, None when finished
+
+        Blocks run in order, then those with replacements queued after they
+        finished run again to capture them.
+        """
+        if self.current_block + 1 < len(self.blocks) and (
+            self.current_block + 1 not in self.block_captures
+        ):
+            return self.current_block + 1
+        with self.reshoot_lock:
+            queued = sorted(index for index, n in self.queued_reshoots.items() if n)
+        return queued[0] if queued else None
+
+    def take_reshoots(self, index):
+        """Return and clear the replacements queued for a block"""
+        with self.reshoot_lock:
+            return self.queued_reshoots.pop(index, 0)
+
+    def waiting_scores(self):
+        """
+        Return whether sequence frames are still being scored at its end
+
+        Their rejections may queue replacements, so the sequence only finishes
+        once they are scored or after the quality gate WAIT_TIMEOUT. Each call
+        waits at most LOOP_DELAY seconds so stop commands are not delayed.
+        """
+        quality = self.webapp.quality
+        if not quality.enabled or not quality.settings["reshoot"]:
+            return False
+        if self.scores_deadline is None:
+            self.scores_deadline = time.monotonic() + quality.WAIT_TIMEOUT
+        elif time.monotonic() > self.scores_deadline:
+            self.logger.warning("Control: Not waiting longer for frame scores")
+            return False
+        return not quality.wait(list(self.block_sessions), self.LOOP_DELAY)
+
+    def frame_scored(self, frame, result):
+        """Queue a replacement exposure for frames rejected by the quality gate"""
+        quality = self.webapp.quality
+        if (
+            result["accepted"]
+            or not quality.settings["reshoot"]
+            or self.current_status not in (self.STATUS_CAPTURING, self.STATUS_DITHERING)
+        ):
+            return
+        with self.reshoot_lock:
+            index = self.block_sessions.get(frame["session"])
+            if index is None:
+                return
+            if self.reshoots.get(index, 0) >= quality.settings["max_reshoots"]:
+                self.logger.warning(
+                    "Control: Frame %s rejected, no reshoots left", frame["index"]
+                )
+                return
+            self.reshoots[index] = self.reshoots.get(index, 0) + 1
+            self.queued_reshoots[index] = self.queued_reshoots.get(index, 0) + 1
+        self.logger.info(
+            "Control: Frame %s rejected (%s), capturing a replacement",
+            frame["index"],
+            ", ".join(result["reasons"]),
+        )
+
+    def start_block(self, index):
+        if self.prefetched_block != index:
+            self.apply_block_config(index)
+        self.prefetched_block = None
+        self.current_block = index
+        # Blocks run again continue their frame numbering to capture replacements
+        captured = self.block_captures.get(index, 0)
+        self.block_captures[index] = captured
+        self.capture_parms = dict(self.blocks[index]["sequence"])
+        if captured:
+            self.capture_parms["captures"] = captured
+        self.scores_deadline = None
+        self.slot_origin = None
+        self.offset_squares = 0.0
+        self.interval_status = None
+        if self.capture_parms.get("interval"):
+            self.interval_status = {
+                "interval": self.capture_parms["interval"],
+                "slot": 0,
+                "frames": 0,
+                "missed": 0,
+                "late": 0,
+                "last_offset": None,
+                "max_offset": 0.0,
+                "offset_rms": 0.0,
+            }
+        if len(self.blocks) > 1:
+            self.session = "%s-%d" % (self.sequence_id, index + 1)
+        else:
+            self.session = self.sequence_id
+        with self.reshoot_lock:
+            self.block_sessions[self.session] = index
+        self.session_open = True
+        self.current_capture = captured
+        self.logger.info(
+            "Control: Started sequence block %d/%d", index + 1, len(self.blocks)
+        )
+
+    def get_cached_config_value(self, name):
+        if self.cached_camera_config and name in self.cached_camera_config:
+            return self.cached_camera_config[name]["current"]
+        return None
+
+    def update_cached_config(self, changes):
+        """Update current values of the cached camera config after applying changes"""
+        if self.cached_camera_config is None:
+            return
+        # The cached config may be a shared read result, so it is copied
+        config = dict(self.cached_camera_config)
+        for key, value in changes.items():
+            if key in config:
+                config[key] = dict(config[key], current=value)
+        self.cached_camera_config = config
+
     def capture_stop(self):
+        if self.recorder is not None:
+            self.recorder.record("control", call="capture_stop", args=[])
         self.current_status = self.STATUS_STOPPING
+        self.stopped.set()
 
     def get_capture_status(self):
         return {
@@ -141,6 +564,11 @@ class Control:
             "last_capture": self.last_capture,
             "capture_parms": self.capture_parms,
             "dither_status": self.dither_status,
+            "current_block": self.current_block + 1,
+            "reshoots": self.reshoots.get(self.current_block, 0),
+            "guide_stats": self.last_guide_stats,
+            "interval_status": self.interval_status,
+            "blocks": [block["sequence"] for block in self.blocks],
         }
 
     def get_capture_image(self):
@@ -0,0 +1,413 @@
+"""Canon CR2 raw decoding"""
+
+import struct
+
+import numpy as np
+
+# Raw IFD tags
+TAG_STRIP_OFFSETS = 0x111
+TAG_SLICES = 0xC640
+
+# Size of TIFF field types in bytes
+TIFF_TYPE_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 7: 1}
+
+# Start of frame markers of other JPEG processes
+OTHER_SOF_MARKERS = {0xFFC0, 0xFFC1, 0xFFC2, 0xFFC5, 0xFFC6, 0xFFC7}
+
+U32_MASK = np.uint64(0xFFFFFFFF)
+
+
+class LosslessJPEG:
+    """
+    Lossless JPEG (ITU T.81 process 14) decoder for camera raw data
+
+    Huffman decoding is sequential by nature, so it is vectorized over many
+    chunks of the scan decoded in parallel. Every chunk is first decoded from
+    SYNC_BITS bits before its start, once per component phase: prefix codes
+    synchronize quickly, so one of those speculative decodings usually crosses
+    the chunk start at the same bit and component as the real code stream and
+    gives where the chunk ends without decoding it from the previous one. Chunks
+    are then chained from the start of the scan, decoding again from their real
+    entries the rare ones that did not synchronize, and finally decoded in
+    parallel from their known entry points writing the sample differences.
+    """
+
+    CHUNK_BITS = 4096
+    SYNC_BITS = 512
+    # Chunks decoded at once, bounding memory use
+    SEGMENT_CHUNKS = 4096
+
+    def __init__(self, data, offset=0):
+        self.tables = {}
+        pos = offset
+        if bytes(data[pos : pos + 2]) != b"\xff\xd8":
+            raise ValueError("Missing JPEG start of image")
+        pos += 2
+        while True:
+            marker, length = struct.unpack_from(">HH", data, pos)
+            segment = bytes(data[pos + 4 : pos + 2 + length])
+            pos += 2 + length
+            if marker == 0xFFC4:
+                self._read_tables(segment)
+            elif marker == 0xFFC3:
+                self._read_frame(segment)
+            elif marker in OTHER_SOF_MARKERS:
+                raise ValueError("Not a lossless JPEG")
+            elif marker == 0xFFDD and struct.unpack(">H", segment)[0]:
+                raise ValueError("JPEG restart intervals are not supported")
+            elif marker == 0xFFDA:
+                self._read_scan(segment)
+                break
+        self.words, self.bits = self._scan_words(np.frombuffer(data, np.uint8)[pos:])
+        self._build_lookup()
+
+    def _read_tables(self, segment):
+        pos = 0
+        while pos < len(segment):
+            counts = segment[pos + 1 : pos + 17]
+            symbols = segment[pos + 17 : pos + 17 + sum(counts)]
+            self.tables[segment[pos] & 0x0F] = (counts, symbols)
+            pos += 17 + sum(counts)
+
+    def _read_frame(self, segment):
+        self.precision, self.height, self.width, self.components = struct.unpack(
+            ">BHHB", segment[:6]
+        )
+        self.component_ids = []
+        for n in range(self.components):
+            component_id, sampling, _ = segment[6 + 3 * n : 9 + 3 * n]
+            if sampling != 0x11:
+                raise ValueError("Subsampled (sRAW) data is not supported")
+            self.component_ids.append(component_id)
+
+    def _read_scan(self, segment):
+        if segment[0] != self.components:
+            raise ValueError("Non interleaved scans are not supported")
+        table_of = dict(
+            (segment[1 + 2 * n], segment[2 + 2 * n] >> 4)
+            for n in range(self.components)
+        )
+        self.component_tables = [table_of[cid] for cid in self.component_ids]
+        self.predictor = segment[1 + 2 * self.components]
+        self.point_transform = segment[3 + 2 * self.components] & 0x0F
+        if self.predictor != 1:
+            raise ValueError("Unsupported predictor %d" % self.predictor)
+
+    @staticmethod
+    def _scan_words(data):
+        """Return the unstuffed entropy coded data as big endian 64 bit words"""
+        markers = np.flatnonzero((data[:-1] == 0xFF) & (data[1:] != 0))
+        if len(markers):
+            data = data[: markers[0]]
+        stuffed = np.flatnonzero((data[:-1] == 0xFF) & (data[1:] == 0)) + 1
+        data = np.delete(data, stuffed)
+        # Whole words plus two more so any position can read 64 bits ahead
+        padded = np.zeros((len(data) // 8 + 3) * 8, np.uint8)
+        padded[: len(data)] = data
+        return padded.view(">u8").astype(np.uint64), len(data) * 8
+
+    def _build_lookup(self):
+        """
+        Build tables indexed by the component phase and the next 16 bits
+
+        Phases are components modulo the cycle of their tables, so with the
+        same table for all components they are not told apart.
+        """
+        tables = self.component_tables
+        luts = [self._table_lut(*self.tables[t]) for t in tables]
+        if all(np.array_equal(lut, luts[0]) for lut in luts):
+            tables = tables[:1]
+        # Shortest repeating cycle of component tables, I.E. 0, 1 for 0, 1, 0, 1
+        self.phases = min(
+            period
+            for period in range(1, len(tables) + 1)
+            if len(tables) % period == 0
+            and tables == tables[:period] * (len(tables) // period)
+        )
+        luts = luts[: self.phases]
+        lengths, sizes = np.concatenate(luts, axis=1)
+        self.valid = lengths > 0
+        # Corrupt codes skip 16 bits so speculative decodings always advance
+        read = np.where(sizes < 16, sizes, 0)
+        self.advance = np.where(self.valid, lengths + read, 16)
+        self.lengths = lengths.astype(np.uint64)
+        self.shifts = (32 - read).astype(np.uint64)
+        self.half = np.where(read > 0, 1 << np.maximum(read - 1, 0), 0)
+        self.full = (1 << read) - 1
+        self.offset = np.where(sizes == 16, 32768, 0)
+
+    @staticmethod
+    def _table_lut(counts, symbols):
+        """Return code lengths and difference sizes indexed by the next 16 bits"""
+        lut = np.zeros((2, 65536), np.int64)
+        code = 0
+        n = 0
+        for length, count in enumerate(counts, 1):
+            for _ in range(count):
+                first = code << (16 - length)
+                lut[:, first : first + (1 << (16 - length))] = [[length], [symbols[n]]]
+                code += 1
+                n += 1
+            code <<= 1
+        return lut
+
+    def _peek(self, pos):
+        """Return the 32 bits starting at each bit position"""
+        shift = (pos & 63).astype(np.uint64)
+        words = pos >> 6
+        high = self.words[words] << shift
+        low = (self.words[words + 1] >> np.uint64(1)) >> (np.uint64(63) - shift)
+        return (high | low) >> np.uint64(32)
+
+    def _run(self, pos, phase, end, out=None, base=None, limit=0):
+        """
+        Decode lanes from bit positions pos and component phases until end
+
+        Returns the positions and phases reached and the symbols decoded. With
+        out, symbol differences are written to out[base + n] below limit.
+        """
+        pos = np.array(pos, np.int64)
+        phase = np.array(phase, np.int64)
+        end = np.array(end, np.int64)
+        count = np.zeros(len(pos), np.int64)
+        lanes = np.arange(len(pos))
+        result = (np.empty_like(pos), np.empty_like(phase), np.empty_like(count))
+        while len(lanes):
+            done = pos >= end
+            if done.any():
+                for values, state in zip(result, (pos, phase, count)):
+                    values[lanes[done]] = state[done]
+                keep = ~done
+                lanes, pos, phase, end, count = (
+                    lanes[keep],
+                    pos[keep],
+                    phase[keep],
+                    end[keep],
+                    count[keep],
+                )
+                if out is not None:
+                    base = base[keep]
+                continue
+            bits = self._peek(pos)
+            index = (phase << 16) + (bits >> np.uint64(16)).astype(np.int64)
+            if out is not None:
+                # Symbols past limit may be decoded from the final padding bits
+                target = base + count
+                inside = target < limit
+                if not self.valid[index[inside]].all():
+                    raise ValueError("Corrupt lossless JPEG data")
+                extra = (
+                    ((bits << self.lengths[index]) & U32_MASK) >> self.shifts[index]
+                ).astype(np.int64)
+                extra -= np.where(extra < self.half[index], self.full[index], 0)
+                extra += self.offset[index]
+                out[target[inside]] = extra[inside]
+            pos += self.advance[index]
+            count += 1
+            if self.phases > 1:
+                phase += 1
+                phase %= self.phases
+        return result
+
+    def _chunk_exits(self, start, chunks):
+        """
+        Speculatively decode chunks from SYNC_BITS before their start
+
+        Returns for every chunk and phase where the decoding crossed the chunk
+        start and where it left the chunk with the symbols decoded in between.
+        """
+        starts = np.arange(start, start + chunks) * self.CHUNK_BITS
+        ends = np.minimum(starts + self.CHUNK_BITS, self.bits)
+        entries = self._run(
+            np.tile(np.maximum(starts - self.SYNC_BITS, 0), self.phases),
+            np.repeat(np.arange(self.phases), chunks),
+            np.tile(starts, self.phases),
+        )
+        # Phases synchronizing at the chunk start are decoded through it once
+        keys = np.stack((np.tile(np.arange(chunks), self.phases),) + entries[:2])
+        keys, inverse = np.unique(keys, axis=1, return_inverse=True)
+        exits = self._run(keys[1], keys[2], ends[keys[0]])
+        return [
+            [values.reshape(self.phases, chunks).T.tolist() for values in state]
+            for state in (entries[:2], [values[inverse] for values in exits])
+        ]
+
+    def _chain(self, first, entry, speculative, exact, limit):
+        """
+        Chain chunks from the entry of the first one until limit symbols
+
+        Chunk exits come from exact decodings or synchronized speculative ones,
+        otherwise they are guessed from the first phase. Returns the chunk
+        entries, symbol counts and the chunks guessed.
+        """
+        (entry_pos, entry_phase), (exit_pos, exit_phase, exit_count) = speculative
+        entries = []
+        counts = []
+        guessed = []
+        total = 0
+        for n in range(len(entry_pos)):
+            if total >= limit:
+                break
+            entries.append(entry)
+            if (first + n,) + entry in exact:
+                *state, count = exact[(first + n,) + entry]
+            else:
+                for h in range(self.phases):
+                    if (entry_pos[n][h], entry_phase[n][h]) == entry:
+                        break
+                else:
+                    h = 0
+                    guessed.append(n)
+                state = (exit_pos[n][h], exit_phase[n][h])
+                count = exit_count[n][h]
+            entry = tuple(state)
+            counts.append(count)
+            total += count
+        return entries, counts, guessed, entry
+
+    def decode_differences(self, limit):
+        """Return the first limit sample differences in scan order"""
+        out = np.zeros(limit, np.int32)
+        chunk_count = -(-self.bits // self.CHUNK_BITS)
+        entry = (0, 0)
+        decoded = 0
+        while decoded < limit:
+            first = entry[0] // self.CHUNK_BITS
+            if first >= chunk_count:
+                raise ValueError("Truncated lossless JPEG data")
+            last = min(first + self.SEGMENT_CHUNKS, chunk_count)
+            speculative = self._chunk_exits(first, last - first)
+            ends = np.minimum(
+                np.arange(first + 1, last + 1) * self.CHUNK_BITS, self.bits
+            )
+            # Decode guessed chunks from their entries until none is left, the
+            # first one has its real entry so every round resolves at least it
+            exact = {}
+            while True:
+                entries, counts, guessed, last_exit = self._chain(
+                    first, entry, speculative, exact, limit - decoded
+                )
+                if not guessed:
+                    break
+                states = np.array([entries[n] for n in guessed], np.int64)
+                for n, state, *values in zip(
+                    guessed,
+                    states.tolist(),
+                    *self._run(states[:, 0], states[:, 1], ends[guessed]),
+                ):
+                    exact[(first + n,) + tuple(state)] = values
+            entries = np.array(entries, np.int64)
+            bases = decoded + np.cumsum([0] + counts[:-1])
+            self._run(
+                entries[:, 0], entries[:, 1], ends[: len(entries)], out, bases, limit
+            )
+            entry = last_exit
+            decoded += sum(counts)
+        return out
+
+    def decode(self, limit=None):
+        """
+        Decode the samples as an uint16 array of frame rows
+
+        Rows have the samples of all components interleaved. With limit, only
+        the frame rows holding the first limit samples are decoded.
+        """
+        row = self.width * self.components
+        rows = self.height
+        if limit is not None:
+            rows = min(rows, -(-limit // row))
+        diffs = self.decode_differences(rows * row).reshape(
+            rows, self.width, self.components
+        )
+        # First samples are predicted from the one above, the rest from the left
+        diffs[0, 0] += 1 << (self.precision - self.point_transform - 1)
+        np.cumsum(diffs[:, 0], axis=0, out=diffs[:, 0])
+        np.cumsum(diffs, axis=1, out=diffs)
+        diffs &= 0xFFFF
+        diffs <<= self.point_transform
+        return diffs.reshape(rows, row).astype(np.uint16)
+
+
+def _read_raw_ifd(data):
+    """Return the SHORT and LONG values of the CR2 raw IFD tags"""
+    order = bytes(data[:2])
+    if order not in (b"II", b"MM"):
+        raise ValueError("Not a TIFF file")
+    endian = "<" if order == b"II" else ">"
+    if bytes(data[8:10]) != b"CR":
+        raise ValueError("Not a CR2 file")
+    (offset,) = struct.unpack_from(endian + "I", data, 12)
+    (count,) = struct.unpack_from(endian + "H", data, offset)
+    tags = {}
+    for n in range(count):
+        tag, kind, number, value = struct.unpack_from(
+            endian + "HHI4s", data, offset + 2 + 12 * n
+        )
+        if kind not in (3, 4):
+            continue
+        if TIFF_TYPE_SIZES[kind] * number > 4:
+            (value_offset,) = struct.unpack(endian + "I", value)
+            value = data[value_offset : value_offset + TIFF_TYPE_SIZES[kind] * number]
+        tags[tag] = struct.unpack_from(endian + "HI"[kind - 3] * number, value)
+    return tags
+
+
+def _slice_columns(samples, height, slices):
+    """Rearrange samples stored as vertical slices into rows"""
+    count, width, last_width = slices
+    if not count:
+        return samples.reshape(height, last_width)
+    columns = samples[: count * width * height].reshape(count, height, width)
+    last = samples[count * width * height :].reshape(height, last_width)
+    return np.hstack([columns.transpose(1, 0, 2).reshape(height, -1), last])
+
+
+def read_cr2(data, center=None):
+    """
+    Decode the CFA mosaic of a Canon CR2 file as an uint16 array
+
+    data is the file content, I.E. bytes or a mmap. The mosaic includes the
+    masked sensor borders. center keeps only a central crop of that fraction of
+    the width and height, starting on even rows and columns so the CFA pattern
+    is kept; decoding stops at the last sample needed.
+    """
+    tags = _read_raw_ifd(data)
+    jpeg = LosslessJPEG(data, tags[TAG_STRIP_OFFSETS][0])
+    samples = jpeg.width * jpeg.components * jpeg.height
+    slices = tags.get(TAG_SLICES)
+    if slices:
+        width = slices[0] * slices[1] + slices[2]
+    else:
+        slices = (0, 0, jpeg.width * jpeg.components)
+        width = slices[2]
+    height = samples // width
+    if height * width != samples:
+        raise ValueError("CR2 slices do not match the raw data size")
+    if center is None:
+        top, bottom, left, right = 0, height, 0, width
+        limit = None
+    else:
+        crop_height = max(2, int(height * center) // 2 * 2)
+        crop_width = max(2, int(width * center) // 2 * 2)
+        top = (height - crop_height) // 4 * 2
+        left = (width - crop_width) // 4 * 2
+        bottom = top + crop_height
+        right = left + crop_width
+        # Scan index of the bottom right sample, the last one needed
+        column = right - 1
+        index = min(column // slices[1], slices[0]) if slices[1] else 0
+        slice_width = slices[1] if index < slices[0] else slices[2]
+        limit = (
+            index * slices[1] * height
+            + (bottom - 1) * slice_width
+            + column
+            - index * slices[1]
+            + 1
+        )
+    decoded = jpeg.decode(limit).ravel()
+    stream = np.zeros(samples, np.uint16)
+    stream[: len(decoded)] = decoded
+    mosaic = _slice_columns(stream, height, slices)
+    if center is None:
+        return mosaic
+    return mosaic[top:bottom, left:right].copy()
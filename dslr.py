@@ -1,13 +1,333 @@
 # Camera control module
 
 # Python modules
-import base64
-import logging
+import json
+import os
+import re
+import threading
 import time
+from collections import deque
+from contextlib import contextmanager
 
 # GPhoto2 module
 import gphoto2 as gp
 
+# Application modules
+from logsetup import get_logger
+from settings import CAMERA_READ_MAX_AGE, DATA_DIR, data_path
+from singleflight import SingleFlight
+
+
+def file_data(camera_file):
+    """
+    Return the data of a gphoto2 CameraFile copied once to memory owned by Python
+
+    get_data_and_size() returns a view of memory owned by the CameraFile, which
+    is freed with it, so the view must not be used after the file is released.
+    """
+    return memoryview(bytearray(camera_file.get_data_and_size()))
+
+
+class ChoiceCache:
+    """Persistent per camera model choice tables
+
+    Choice lists rarely change for a given camera model and firmware, so they are
+    stored on disk and only enumerated from the camera when missing or stale.
+    Current values some cameras report outside of their own choice lists are
+    remembered, so they do not make every read enumerate the choices again.
+    """
+
+    def __init__(self, model, firmware):
+        key = re.sub(r"[^A-Za-z0-9._-]+", "_", "{}_{}".format(model, firmware))
+        self.path = data_path("choices", "{}.json".format(key))
+        self.choices = {}
+        self.unlisted = {}
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path) as fd:
+                self.choices = json.load(fd)
+        except (OSError, ValueError):
+            self.choices = {}
+
+    def save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as fd:
+            json.dump(self.choices, fd)
+        os.replace(tmp_path, self.path)
+
+    def get(self, name):
+        return self.choices.get(name)
+
+    def is_known(self, name, value):
+        """Return whether value is a cached choice or known to be unlisted"""
+        choices = self.choices.get(name)
+        if choices is None:
+            return False
+        return value in choices or value in self.unlisted.get(name, ())
+
+    def set(self, name, choices, value=None):
+        """Store enumerated choices and the current value if it is not among them"""
+        if choices != self.choices.get(name):
+            self.choices[name] = choices
+            self.unlisted.pop(name, None)
+            self.save()
+        if value is not None and value not in choices:
+            self.unlisted.setdefault(name, set()).add(value)
+
+
+class CameraLock:
+    """
+    Camera access lock giving priority to foreground operations
+
+    Foreground operations (captures, configuration) wait at most for the current
+    background step to finish. Background steps only run when no foreground
+    operation is running or waiting and the camera has been idle for a while.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.count_lock = threading.Lock()
+        self.foreground_count = 0
+        self.last_release = 0
+
+    @contextmanager
+    def foreground(self):
+        with self.count_lock:
+            self.foreground_count += 1
+        try:
+            with self.lock:
+                yield
+        finally:
+            with self.count_lock:
+                self.foreground_count -= 1
+                self.last_release = time.monotonic()
+
+    def idle(self, delay=0):
+        """Return whether no foreground operation used the camera for delay seconds"""
+        with self.count_lock:
+            return (
+                self.foreground_count == 0
+                and time.monotonic() - self.last_release >= delay
+            )
+
+    def acquire_background(self, delay=0):
+        """Acquire the camera for a background step only if it is idle"""
+        if not self.idle(delay) or not self.lock.acquire(blocking=False):
+            return False
+        if not self.idle(delay):
+            self.lock.release()
+            return False
+        return True
+
+    def release_background(self):
+        self.lock.release()
+
+
+class CardSyncStopped(Exception):
+    pass
+
+
+class CardSync:
+    """
+    Background download of the camera card
+
+    The camera filesystem is listed and files neither in the frame store (as
+    recorded in the catalog) nor in the local card copy
+    (DATA_DIR/card/<camera folder>/<file>) are downloaded in chunks. Each camera
+    call is a background step, so syncing pauses as soon as a capture or any
+    other foreground operation needs the camera and resumes when it is idle.
+    """
+
+    # Bytes read from the camera per step
+    CHUNK_SIZE = 1024 * 1024
+    # Seconds the camera must be unused before syncing resumes
+    IDLE_DELAY = 1.0
+    # Seconds between idle checks while paused
+    POLL_INTERVAL = 0.2
+    # Seconds used to compute the transfer rate
+    RATE_WINDOW = 5.0
+
+    def __init__(self, manager, root=None):
+        self.manager = manager
+        self.root = root or os.path.join(DATA_DIR, "card")
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.samples = deque()
+        self.status = self._initial_status("idle")
+
+    @staticmethod
+    def _initial_status(state):
+        return {
+            "state": state,
+            "files_total": 0,
+            "files_done": 0,
+            "files_present": 0,
+            "bytes_total": 0,
+            "bytes_done": 0,
+            "current_file": None,
+            "error": None,
+        }
+
+    @property
+    def logger(self):
+        return self.manager.logger
+
+    def is_running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self):
+        """Start syncing in background. Returns False if already running"""
+        if self.is_running():
+            return False
+        if self.manager.camera is None:
+            raise Exception("Camera is not connected")
+        self.stop_event.clear()
+        with self.lock:
+            self.status = self._initial_status("listing")
+            self.samples.clear()
+        self.thread = threading.Thread(target=self._run, name="cardsync", daemon=True)
+        self.thread.start()
+        return True
+
+    def stop(self):
+        self.stop_event.set()
+
+    def get_status(self):
+        with self.lock:
+            status = dict(self.status)
+            rate = 0.0
+            if len(self.samples) > 1:
+                (t0, b0), (t1, b1) = self.samples[0], self.samples[-1]
+                if t1 > t0:
+                    rate = (b1 - b0) / (t1 - t0)
+        status["rate"] = rate
+        remaining = status["bytes_total"] - status["bytes_done"]
+        status["eta"] = remaining / rate if rate > 0 else None
+        return status
+
+    def _set_status(self, **values):
+        with self.lock:
+            self.status.update(values)
+
+    def _step(self, func, *args):
+        """Run a camera call as soon as the camera is idle"""
+        paused = False
+        while True:
+            if self.stop_event.is_set():
+                raise CardSyncStopped()
+            camera_lock = self.manager.camera_lock
+            if camera_lock.acquire_background(self.IDLE_DELAY):
+                try:
+                    if self.manager.camera is None:
+                        raise Exception("Camera disconnected")
+                    if paused:
+                        self._set_status(state="downloading")
+                    return func(*args)
+                finally:
+                    camera_lock.release_background()
+            if not paused:
+                paused = True
+                self._set_status(state="paused")
+            self.stop_event.wait(self.POLL_INTERVAL)
+
+    def local_path(self, folder, name):
+        return os.path.join(self.root, folder.strip("/"), name)
+
+    def list_files(self, folder="/"):
+        """Return (folder, name) of all files in the camera filesystem"""
+        camera = self.manager.camera
+        files = [
+            (folder, name) for name, _ in self._step(camera.folder_list_files, folder)
+        ]
+        for name, _ in self._step(camera.folder_list_folders, folder):
+            files.extend(self.list_files(folder.rstrip("/") + "/" + name))
+        return files
+
+    def stored_files(self):
+        """Return the camera paths of the frames saved by the frame store"""
+        webapp = self.manager.webapp
+        if webapp is None:
+            return set()
+        return set(
+            camera_path
+            for camera_path, path in webapp.catalog.stored_camera_paths().items()
+            if os.path.exists(path)
+        )
+
+    def _run(self):
+        try:
+            missing = []
+            files = self.list_files()
+            stored = self.stored_files()
+            for folder, name in files:
+                if "%s/%s" % (folder, name) in stored:
+                    continue
+                if not os.path.exists(self.local_path(folder, name)):
+                    missing.append((folder, name))
+            self._set_status(
+                state="downloading",
+                files_total=len(missing),
+                files_present=len(files) - len(missing),
+            )
+            camera = self.manager.camera
+            sizes = []
+            for folder, name in missing:
+                info = self._step(camera.file_get_info, folder, name)
+                sizes.append(info.file.size)
+            self._set_status(bytes_total=sum(sizes))
+            for (folder, name), size in zip(missing, sizes):
+                self._download(camera, folder, name, size)
+                with self.lock:
+                    self.status["files_done"] += 1
+            self._set_status(state="done", current_file=None)
+            self.logger.info("Card sync finished: %d files", len(missing))
+        except CardSyncStopped:
+            self._set_status(state="stopped", current_file=None)
+            self.logger.info("Card sync stopped")
+        except Exception as e:
+            self._set_status(state="error", error=str(e), current_file=None)
+            self.logger.error("Card sync failed: %s", e)
+
+    def _download(self, camera, folder, name, size):
+        path = self.local_path(folder, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._set_status(current_file="%s/%s" % (folder, name))
+        buf = bytearray(self.CHUNK_SIZE)
+        view = memoryview(buf)
+        tmp_path = path + ".part"
+        offset = 0
+        try:
+            with open(tmp_path, "wb") as fd:
+                while offset < size:
+                    count = self._step(
+                        camera.file_read,
+                        folder,
+                        name,
+                        gp.GP_FILE_TYPE_NORMAL,
+                        offset,
+                        view,
+                    )
+                    if count <= 0:
+                        raise Exception("Short read from %s/%s" % (folder, name))
+                    fd.write(view[:count])
+                    offset += count
+                    self._add_bytes(count)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def _add_bytes(self, count):
+        now = time.monotonic()
+        with self.lock:
+            self.status["bytes_done"] += count
+            self.samples.append((now, self.status["bytes_done"]))
+            while self.samples and now - self.samples[0][0] > self.RATE_WINDOW:
+                self.samples.popleft()
+
 
 class DSLRManager:
     """DSLR manager class"""
@@ -27,32 +347,78 @@ class DSLRManager:
 
     camera = None
     config = None
+    widgets = None
+    choice_cache = None
     webapp = None
     locked = False
+    last_file = None
 
     def __init__(self, webapp=None):
         if webapp:
             self.webapp = webapp
             self.logger = webapp.logger
         else:
-            self.logger = logging.getLogger()
+            self.logger = get_logger("dslr")
+        self.camera_lock = CameraLock()
+        self.card_sync = CardSync(self)
+        # Concurrent and recent identical reads share one camera operation
+        self.reads = SingleFlight(CAMERA_READ_MAX_AGE)
 
     def _update_config(self):
-        self.locked = True
-        self.camera.set_config(self.config)
-        self.locked = False
+        with self.camera_lock.foreground():
+            self.locked = True
+            self.camera.set_config(self.config)
+            self.locked = False
 
     def _read_config(self):
-        self.locked = True
-        self.config = self.camera.get_config()
-        self.locked = False
+        with self.camera_lock.foreground():
+            self.locked = True
+            self.config = self.camera.get_config()
+            self.locked = False
+            self._index_widgets()
+
+    def _index_widgets(self):
+        """Build a name to widget index walking the configuration tree once"""
+        self.widgets = {}
+        pending = [self.config]
+        while pending:
+            widget = pending.pop()
+            self.widgets.setdefault(widget.get_name(), widget)
+            for n in range(widget.count_children()):
+                pending.append(widget.get_child(n))
+
+    def _get_widget(self, name):
+        try:
+            return self.widgets[name]
+        except KeyError:
+            raise KeyError("Camera has no configuration element %s" % name)
+
+    def _enumerate_choices(self, elem):
+        choices = []
+        for n in range(elem.count_choices()):
+            choice = elem.get_choice(n)
+            if choice:
+                choices.append(choice)
+        return choices
+
+    def _load_choice_cache(self):
+        model = self.camera.get_abilities().model
+        firmware = ""
+        if "firmwareversion" in self.widgets:
+            firmware = self.widgets["firmwareversion"].get_value()
+        self.choice_cache = ChoiceCache(model, firmware)
 
     def setup(self):
         self.camera = None
         self.config = None
+        self.widgets = None
+        self.choice_cache = None
         self.locked = False
 
     def get_camera_list(self):
+        return self.reads.do("camera_list", self._get_camera_list)
+
+    def _get_camera_list(self):
         camera_list = list(gp.Camera.autodetect())
         if camera_list:
             camera_list.sort(key=lambda x: x[0])
@@ -62,47 +428,60 @@ class DSLRManager:
         return {"choices": camera_list, "current": current}
 
     def connect_camera(self, port):
-        self.camera = gp.Camera()
-        # Search ports for camera port name
-        port_info_list = gp.PortInfoList()
-        port_info_list.load()
-        idx = port_info_list.lookup_path(port)
-        self.camera.set_port_info(port_info_list[idx])
-        self.camera.init()
-        # Get camera configuration
-        self.config = self.camera.get_config()
+        try:
+            with self.camera_lock.foreground():
+                self.camera = gp.Camera()
+                # Search ports for camera port name
+                port_info_list = gp.PortInfoList()
+                port_info_list.load()
+                idx = port_info_list.lookup_path(port)
+                self.camera.set_port_info(port_info_list[idx])
+                self.camera.init()
+                # Get camera configuration and its choice tables
+                self._read_config()
+                self._load_choice_cache()
+        finally:
+            self.reads.forget()
 
     def disconnect_camera(self):
         """Disconnect from camera"""
-        try:
-            self.camera.exit()
-        except Exception:
-            pass
-        self.setup()
+        self.card_sync.stop()
+        with self.camera_lock.foreground():
+            try:
+                self.camera.exit()
+            except Exception:
+                pass
+            self.setup()
+        self.reads.forget()
 
     def get_summary(self):
-        return self.camera.get_summary()
+        with self.camera_lock.foreground():
+            return self.camera.get_summary()
 
     def get_config(self):
+        return self.reads.do("config", self._get_config)
+
+    def _get_config(self):
         if not self.camera:
             self.logger.info("Not reading camera config. Camera is not set.")
             return None
         self.logger.info("Reading camera config")
-        self._read_config()
-        config_data = {}
-        for elem_name in self.CONFIG_ELEMS:
-            elem = self.config.get_child_by_name(elem_name)
-            choices = []
-            current = None
-            value = elem.get_value()
-            choice_count = elem.count_choices()
-            for n in range(choice_count):
-                choice = elem.get_choice(n)
-                if choice:
-                    choices.append(choice)
-                    if choice == value:
-                        current = choice
-            config_data[elem_name] = {"choices": choices, "current": current}
+        # The configuration tree is not replaced by other threads while read
+        with self.camera_lock.foreground():
+            self._read_config()
+            config_data = {}
+            for elem_name in self.CONFIG_ELEMS:
+                elem = self._get_widget(elem_name)
+                value = elem.get_value()
+                # Enumerate choices only when not cached or when the current value
+                # is unknown (I.E. a lens change modified the available apertures)
+                if not self.choice_cache.is_known(elem_name, value):
+                    self.choice_cache.set(
+                        elem_name, self._enumerate_choices(elem), value
+                    )
+                choices = self.choice_cache.get(elem_name)
+                current = value if value in choices else None
+                config_data[elem_name] = {"choices": choices, "current": current}
         self.logger.debug("Camera configuration read: %s", config_data)
         return config_data
 
@@ -110,63 +489,146 @@ class DSLRManager:
         self.logger.info("Setting camera config")
         self.logger.debug("Camera config to set: %s", config)
 
-        # Refresh configuration
-        self._read_config()
+        # Values are set and pushed on the configuration tree read, which other
+        # threads must not replace in between
+        with self.camera_lock.foreground():
+            # Refresh configuration
+            self._read_config()
 
-        # Set each value
-        for key, value in config.items():
-            self.logger.debug("Setting camera parameter: %s -> %s", key, value)
-            elem = self.config.get_child_by_name(key)
-            elem.set_value(value)
+            # Set each value
+            for key, value in config.items():
+                self.logger.debug("Setting camera parameter: %s -> %s", key, value)
+                self._get_widget(key).set_value(value)
 
-        # Apply camera configuration
-        self._update_config()
+            # Apply camera configuration
+            self._update_config()
+        self.reads.forget()
 
-    def capture_image_bulb(self, seconds):
+    def apply_config(self, config):
+        """
+        Apply configuration values diffing them against the last read camera state
+
+        Only changed values are written, all of them in a single configuration push
+        and without refreshing the configuration first. Returns the changed values.
+        """
+        if not self.camera:
+            raise Exception("Camera is not connected")
+        changes = {}
+        with self.camera_lock.foreground():
+            for key, value in config.items():
+                elem = self._get_widget(key)
+                if elem.get_value() != value:
+                    elem.set_value(value)
+                    changes[key] = value
+            if changes:
+                self.logger.info("Applying camera config changes: %s", changes)
+                self._update_config()
+        if changes:
+            self.reads.forget()
+        return changes
+
+    def capture_image_bulb(
+        self, seconds, after_release=None, after_press=None, download=True
+    ):
+        """
+        Capture a bulb exposure returning the JPEG image data if available
+
+        after_release is called once the shutter is closed, before the image is
+        written and downloaded, so it must not change the camera configuration.
+        after_press is called as soon as the shutter opens and may use the camera
+        during the exposure, its time is not added to the exposure. Without
+        download the JPEG is left on the camera for download_file and None is
+        returned, last_file still names it.
+        """
+        with self.camera_lock.foreground():
+            return self._capture_image_bulb(
+                seconds, after_release, after_press, download
+            )
+
+    def _capture_image_bulb(self, seconds, after_release, after_press, download):
         self.logger.info("Capturing bulb %s seconds", seconds)
+        # Format of this frame, read before the callbacks may use the camera
+        jpeg = self._get_widget("imageformat").get_value() != "RAW"
+
         # Set bulb mode
-        self.config.get_child_by_name("shutterspeed").set_value("bulb")
+        self._get_widget("shutterspeed").set_value("bulb")
         self._update_config()
 
         # Inmediate remote release
-        self.config.get_child_by_name("eosremoterelease").set_value("Immediate")
+        self._get_widget("eosremoterelease").set_value("Immediate")
         self._update_config()
+        opened = time.monotonic()
+        if after_press is not None:
+            after_press()
 
         # Wait the specified number of seconds
-        time.sleep(seconds)
+        time.sleep(max(0, seconds - (time.monotonic() - opened)))
 
         # Release button
-        self.config.get_child_by_name("eosremoterelease").set_value("Release 3")
+        self._get_widget("eosremoterelease").set_value("Release 3")
         self._update_config()
+        if after_release is not None:
+            after_release()
 
         # By default, data is empty
         data = None
+        self.last_file = None
 
         # Load image only if image format is JPEG or RAW + JPEG
-        if self.config.get_child_by_name("imageformat").get_value() != "RAW":
+        if jpeg:
             timeout = time.time()
             while True:
                 evtype, evdata = self.camera.wait_for_event(100)
                 if evtype == gp.GP_EVENT_FILE_ADDED:
                     path = evdata
+                    self.last_file = "%s/%s" % (path.folder, path.name)
                     if path.name.lower().endswith("jpg"):
-                        image_data = self.load_image_from_camera(path)
-                        data = base64.b64encode(image_data).decode()
+                        if download:
+                            data = self.load_image_from_camera(path)
                         break
                 # If time is greater than the number of seconds of the take + 10 we abort
                 if time.time() - timeout > seconds + 10:
                     break
         return data
 
+    def try_capture_preview(self):
+        """
+        Capture a live view frame returning its JPEG data
+
+        Returns None without waiting when a foreground operation is using or
+        waiting for the camera.
+        """
+        if not self.camera_lock.acquire_background():
+            return None
+        try:
+            if self.camera is None:
+                raise Exception("Camera is not connected")
+            # The preview camera file is released as soon as this returns
+            return file_data(self.camera.capture_preview())
+        finally:
+            self.camera_lock.release_background()
+
+    def end_preview(self):
+        """Close the viewfinder opened by live view, lowering the mirror"""
+        with self.camera_lock.foreground():
+            if self.camera is None or "viewfinder" not in self.widgets:
+                return
+            self.widgets["viewfinder"].set_value(0)
+            self._update_config()
+
     def load_image_from_camera(self, path):
-        self.locked = True
-        self.logger.info("Loading image from camera: %s %s", path.folder, path.name)
-        camera_file = self.camera.file_get(
-            path.folder, path.name, gp.GP_FILE_TYPE_NORMAL
-        )
-        file_data = camera_file.get_data_and_size()
-        self.locked = False
-        return file_data
+        return self.download_file("%s/%s" % (path.folder, path.name))
+
+    def download_file(self, camera_path):
+        """Download a file from the camera given as folder/name"""
+        folder, name = camera_path.rsplit("/", 1)
+        with self.camera_lock.foreground():
+            self.locked = True
+            self.logger.info("Loading image from camera: %s %s", folder, name)
+            camera_file = self.camera.file_get(folder, name, gp.GP_FILE_TYPE_NORMAL)
+            data = file_data(camera_file)
+            self.locked = False
+        return data
 
 
 if __name__ == "__main__":
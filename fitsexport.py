@@ -0,0 +1,209 @@
+"""FITS export"""
+
+import os
+import threading
+import time
+
+import numpy as np
+
+from imaging import decode_jpeg
+from pipeline import FrameStage
+from settings import DATA_DIR
+
+FITS_BLOCK = 2880
+FITS_CARD = 80
+
+
+def format_card(key, value=None, comment=None):
+    """Format a FITS header card"""
+    if value is None:
+        card = key.ljust(8)
+    else:
+        if isinstance(value, bool):
+            value = ("T" if value else "F").rjust(20)
+        elif isinstance(value, (int, float)):
+            value = repr(value).rjust(20)
+        else:
+            value = "'%s'" % str(value).replace("'", "''").ljust(8)
+        card = "%-8s= %s" % (key[:8], value)
+        if comment:
+            card += " / " + comment
+    return card[:FITS_CARD].ljust(FITS_CARD)
+
+
+class FitsFile:
+    """
+    Incremental FITS file writer
+
+    The header is written with a fixed number of reserved blocks so cards can be
+    added or updated in place after data has been written. Data is streamed in
+    chunks and padded to a full FITS block when the file is closed.
+    """
+
+    HEADER_BLOCKS = 2
+
+    def __init__(self, path, bitpix, axes):
+        self.path = path
+        self.cards = [
+            ("SIMPLE", True, "conforms to FITS standard"),
+            ("BITPIX", bitpix, "array data type"),
+            ("NAXIS", len(axes), "number of array dimensions"),
+        ]
+        for n, size in enumerate(axes, 1):
+            self.cards.append(("NAXIS%d" % n, size, None))
+        self.data_size = 0
+        self.fd = open(path, "wb")
+        self.write_header()
+
+    def set(self, key, value, comment=None):
+        for n, card in enumerate(self.cards):
+            if card[0] == key:
+                self.cards[n] = (key, value, comment)
+                return
+        self.cards.append((key, value, comment))
+
+    def write_header(self):
+        header = "".join(format_card(*card) for card in self.cards)
+        # Reserved space is filled with blank cards before END, as the END card
+        # must be in the last header block
+        size = self.HEADER_BLOCKS * FITS_BLOCK - FITS_CARD
+        if len(header) > size:
+            raise ValueError("FITS header does not fit in the reserved space")
+        header = header.ljust(size) + format_card("END")
+        position = self.fd.tell()
+        self.fd.seek(0)
+        self.fd.write(header.encode("ascii"))
+        if position:
+            self.fd.seek(position)
+
+    def write(self, data):
+        self.fd.write(data)
+        self.data_size += len(data)
+
+    def close(self):
+        padding = -self.data_size % FITS_BLOCK
+        self.fd.write(b"\0" * padding)
+        self.write_header()
+        self.fd.close()
+
+    def discard(self):
+        """Close and remove a partially written file"""
+        self.fd.close()
+        os.remove(self.path)
+
+
+class FitsExporter(FrameStage):
+    """
+    FITS export stage
+
+    Frames are decoded and written as 8 bit RGB cubes (NAXIS3 = 3) with exposure,
+    ISO, timestamps and guiding statistics in the header.
+    """
+
+    name = "fitsexport"
+
+    QUEUE_SIZE = 8
+
+    # Number of rows written per data block
+    CHUNK_ROWS = 64
+
+    IMAGE_TYPES = {
+        "light": "Light Frame",
+        "dark": "Dark Frame",
+        "flat": "Flat Field",
+        "bias": "Bias Frame",
+    }
+
+    def __init__(self, logger=None, enabled=False, catalog=None):
+        super().__init__(logger)
+        self.enabled = enabled
+        self.catalog = catalog
+        self.lock = threading.Lock()
+        self.exported = 0
+        self.last_path = None
+
+    def get_status(self):
+        with self.lock:
+            return {
+                "enabled": self.enabled,
+                "exported": self.exported,
+                "dropped": self.dropped,
+                "pending": self.queue.qsize(),
+                "last_path": self.last_path,
+            }
+
+    def submit(self, frame):
+        if not self.enabled:
+            return False
+        return super().submit(frame)
+
+    def frame_path(self, frame):
+        frame_type = frame.get("frame_type", "light")
+        path = os.path.join(
+            DATA_DIR,
+            "fits",
+            frame["session"],
+            "%s_%s_%05d.fits" % (frame["session"], frame_type, frame["index"]),
+        )
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
+
+    def process(self, frame):
+        image = decode_jpeg(frame["data"], dtype=np.uint8)
+        height, width, channels = image.shape
+        path = self.frame_path(frame)
+        fits = FitsFile(path, 8, (width, height, channels))
+        try:
+            self.fill_header(fits, frame)
+            fits.write_header()
+            # FITS stores planes one after the other with the first row at the
+            # bottom
+            for channel in range(channels):
+                for end in range(height, 0, -self.CHUNK_ROWS):
+                    start = max(end - self.CHUNK_ROWS, 0)
+                    fits.write(image[start:end, :, channel][::-1].tobytes())
+            fits.close()
+        except Exception:
+            fits.discard()
+            raise
+        with self.lock:
+            self.exported += 1
+            self.last_path = path
+        if self.catalog is not None:
+            self.catalog.record(frame["session"], frame["index"], fits_path=path)
+        self.logger.info("fitsexport: Exported frame %s to %s", frame["index"], path)
+
+    def fill_header(self, fits, frame):
+        frame_type = frame.get("frame_type", "light")
+        image_type = self.IMAGE_TYPES.get(frame_type, frame_type)
+        fits.set("IMAGETYP", image_type, "frame type")
+        fits.set("EXPTIME", float(frame["exposure"]), "[s] exposure time")
+        fits.set("EXPOSURE", float(frame["exposure"]), "[s] exposure time")
+        # Shutter times, unknown if the camera failed before opening or closing
+        if frame.get("shutter_opened") is not None:
+            fits.set(
+                "DATE-OBS",
+                time.strftime(
+                    "%Y-%m-%dT%H:%M:%S", time.gmtime(frame["shutter_opened"])
+                ),
+                "UTC start of exposure",
+            )
+        if frame.get("shutter_closed") is not None:
+            fits.set(
+                "DATE-END",
+                time.strftime(
+                    "%Y-%m-%dT%H:%M:%S", time.gmtime(frame["shutter_closed"])
+                ),
+                "UTC end of exposure",
+            )
+        iso = frame.get("iso")
+        if iso:
+            fits.set("ISOSPEED", int(iso) if iso.isdigit() else iso, "ISO speed")
+        stats = frame.get("guide_stats")
+        if stats:
+            fits.set("GUIDERMS", round(stats["rms_tot"], 4), "[px] guiding RMS")
+            fits.set("GUIDRARM", round(stats["rms_ra"], 4), "[px] RA guiding RMS")
+            fits.set("GUIDDERM", round(stats["rms_dec"], 4), "[px] Dec guiding RMS")
+        fits.set("FRAMENUM", frame["index"], "frame number in session")
+        fits.set("SESSION", frame["session"], "capture session")
+        fits.set("SWCREATE", "GalaxyDSLR", "capture software")
@@ -1,10 +1,53 @@
 """Web application interface"""
 
-from flask import Flask, jsonify, render_template, request, send_from_directory
+import os
+import threading
+import time
 
-from controlapp import Control
-from dslr import DSLRManager
-from guiding import GuiderHelper
+from flask import Flask, Response, abort, jsonify, render_template, request
+
+from logsetup import get_logger
+from settings import (
+    AGENT_PORT,
+    FITS_EXPORT,
+    HISTORY_DISK,
+    HISTORY_MEMORY,
+    RECORD_PATH,
+    REPLAY_PATH,
+    REPLAY_SPEED,
+    RIG_NAME,
+    RIGS,
+    SAVE_FRAMES,
+    SIMULATOR,
+    data_path,
+)
+from webassets import StaticAssets, buffer_response, compress_response
+
+
+class component:
+    """
+    Lazily built application component
+
+    The decorated factory is called the first time the attribute is accessed and
+    its result is stored in the instance, so later accesses are plain attribute
+    lookups. Heavy subsystems (gphoto2, PHD2 client, NumPy analysis) are only
+    imported when first used or when loaded in background by FrontApp.warmup.
+    """
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.name = factory.__name__
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        lock = instance.component_locks.setdefault(self.name, threading.RLock())
+        with lock:
+            if self.name not in instance.__dict__:
+                started = time.perf_counter()
+                instance.__dict__[self.name] = self.factory(instance)
+                instance.load_times[self.name] = time.perf_counter() - started
+        return instance.__dict__[self.name]
 
 
 class FrontApp(Flask):
@@ -12,14 +55,277 @@ class FrontApp(Flask):
     Frontend flask app class
     """
 
+    # Components loaded in background after the HTTP server is listening
+    WARMUP_COMPONENTS = [
+        "dslr",
+        "control",
+        "guider",
+        "profiles",
+        "calibration",
+        "stacker",
+        "fits",
+        "catalog",
+        "frames",
+        "quality",
+        "tiles",
+        "history",
+        "agent",
+        "rigs",
+    ]
+
+    # JSON responses smaller than this are not compressed
+    COMPRESS_MIN_SIZE = 1024
+    # Cache lifetime of tile pyramid images
+    TILE_MAX_AGE = 24 * 3600
+
     def __init__(self, *args, **kwargs):
+        # Static files are served by StaticAssets instead of the default route
+        kwargs.setdefault("static_folder", None)
         super().__init__(*args, **kwargs)
-        self.dslr = DSLRManager()
-        self.control = Control(self)
-        self.guider = GuiderHelper()
+        self.assets = StaticAssets(os.path.join(self.root_path, "static"))
+        self.jinja_env.globals["static_url"] = self.assets.url
+        self.after_request(self.compress_response)
+        self.component_locks = {}
+        self.warmup_lock = threading.Lock()
+        self.load_times = {}
+        self.warmup_thread = None
+        self.preview_image = None
+        # Camera state generation and monotonic time of the last read of each
+        # camera status section
+        self.camera_reads = {}
+
+    @component
+    def state(self):
+        from statetrack import StateTracker
+
+        return StateTracker()
+
+    @component
+    def recorder(self):
+        if not RECORD_PATH:
+            return None
+        from dslr import DSLRManager
+        from recording import Recorder
+
+        return Recorder(RECORD_PATH, config_elems=DSLRManager.CONFIG_ELEMS)
+
+    @component
+    def player(self):
+        if not REPLAY_PATH:
+            return None
+        from recording import Player
+
+        return Player(REPLAY_PATH, REPLAY_SPEED, get_logger("replay"))
+
+    @component
+    def dslr(self):
+        if self.player is not None:
+            return self.player.dslr()
+        if SIMULATOR:
+            from simulator import SimulatedDSLR
+
+            return SimulatedDSLR()
+        from dslr import DSLRManager
+
+        if self.recorder is not None:
+            from recording import RecordingDSLR
+
+            return RecordingDSLR(DSLRManager(), self.recorder)
+        return DSLRManager()
+
+    @component
+    def control(self):
+        from controlapp import Control
+
+        control = Control(self)
+        control.add_frame_handler(self.process_frame)
+        control.add_session_handler(self.session_ended)
+        control.recorder = self.recorder
+        if self.player is not None:
+            self.player.drive(control)
+        return control
+
+    @component
+    def guider(self):
+        from guiding import GuiderHelper
+
+        if self.player is not None:
+            return GuiderHelper(self.player.guider)
+        if self.recorder is not None:
+            from functools import partial
+
+            from recording import RecordingGuider
+
+            return GuiderHelper(partial(RecordingGuider, recorder=self.recorder))
+        return GuiderHelper()
+
+    @component
+    def profiles(self):
+        from profiles import ProfileManager
+
+        return ProfileManager(self.dslr.CONFIG_ELEMS)
+
+    @component
+    def calibration(self):
+        from calibration import CalibrationLibrary
+
+        return CalibrationLibrary(get_logger("calibration"))
+
+    @component
+    def stacker(self):
+        from livestack import LiveStacker
+
+        return LiveStacker(get_logger("stacker"), self.calibration)
+
+    @component
+    def fits(self):
+        from fitsexport import FitsExporter
+
+        return FitsExporter(get_logger("fits"), FITS_EXPORT, self.catalog)
+
+    @component
+    def catalog(self):
+        from catalog import FrameCatalog
 
-    def get_status(self):
-        """Get app status"""
+        return FrameCatalog(get_logger("catalog"))
+
+    @component
+    def quality(self):
+        from quality import QualityGate
+
+        return QualityGate(
+            get_logger("quality"), self.catalog, self.control.frame_scored
+        )
+
+    @component
+    def frames(self):
+        from framestore import FrameStore
+
+        return FrameStore(get_logger("frames"), SAVE_FRAMES, self.catalog)
+
+    @component
+    def tiles(self):
+        from tiles import TilePyramid
+
+        return TilePyramid(get_logger("tiles"))
+
+    @component
+    def history(self):
+        from history import FrameHistory
+
+        return FrameHistory(get_logger("history"), HISTORY_MEMORY, HISTORY_DISK)
+
+    @component
+    def live_view(self):
+        from liveview import LiveView
+
+        return LiveView(self.dslr, get_logger("liveview"))
+
+    @component
+    def agent(self):
+        if not AGENT_PORT:
+            return None
+        from rigs import RigAgent
+
+        agent = RigAgent(self, AGENT_PORT, RIG_NAME, get_logger("agent"))
+        agent.serve()
+        return agent
+
+    @component
+    def rigs(self):
+        from rigs import RigController
+
+        rigs = RigController(get_logger("rigs"), data_path("rigs.json"))
+        for address in RIGS.split(","):
+            if address.strip():
+                rigs.add_rig(address)
+        return rigs
+
+    def compress_response(self, response):
+        return compress_response(response, self.COMPRESS_MIN_SIZE)
+
+    def is_loaded(self, name):
+        return name in self.__dict__
+
+    def warmup(self):
+        """Load application components in a background thread"""
+        with self.warmup_lock:
+            if self.warmup_thread is None:
+                self.warmup_thread = threading.Thread(
+                    target=self._warmup, name="warmup", daemon=True
+                )
+                self.warmup_thread.start()
+
+    def _warmup(self):
+        for name in self.WARMUP_COMPONENTS:
+            try:
+                getattr(self, name)
+            except Exception as e:
+                self.logger.error("Failed loading %s: %s", name, e)
+        self.logger.info(
+            "Components loaded: %s",
+            ", ".join("%s %.3fs" % item for item in self.load_times.items()),
+        )
+
+    def last_image_url(self):
+        """Return the URL of the last captured image, unique for each capture"""
+        if self.control.last_image is None:
+            return None
+        return "/capture/last_image.jpg?frame=%s-%d" % (
+            self.control.session,
+            self.control.last_capture,
+        )
+
+    def process_frame(self, frame):
+        """Send a captured frame to the processing stages"""
+        self.catalog.submit(frame)
+        self.calibration.submit(frame)
+        self.stacker.submit(frame)
+        self.fits.submit(frame)
+        self.frames.submit(frame)
+        self.quality.submit(frame)
+        self.tiles.submit(frame)
+        self.history.submit(frame)
+        if self.agent is not None:
+            self.agent.submit(frame)
+
+    def session_ended(self, session, frame_type):
+        """Build calibration masters once their capture session ended"""
+        self.calibration.session_ended(session, frame_type)
+
+    def update_camera_section(self, name, read, since):
+        """
+        Update a camera status section reading it from the camera
+
+        Incremental status requests only read the camera again once the camera
+        state changed or the last read is older than the camera read max age, so
+        changes made on the camera itself are still seen.
+        """
+        reads = getattr(self.dslr, "reads", None)
+        generation = reads.generation if reads is not None else None
+        max_age = reads.max_age if reads is not None else 0
+        now = time.monotonic()
+        last = self.camera_reads.get(name)
+        if (
+            since is None
+            or last is None
+            or last[0] != generation
+            or now - last[1] > max_age
+        ):
+            self.camera_reads[name] = (generation, now)
+            self.state.update(name, {name: read()})
+
+    def get_status(self, since=None):
+        """
+        Get app status
+
+        Status is split in sections tracked by a state sequence number. If since is
+        given, only sections changed after that sequence number are returned.
+        """
+        if not self.is_loaded("dslr"):
+            # Camera backend is still loading
+            self.warmup()
+            return {"status": True, "locked": True}
         if self.dslr.locked:
             return {"status": True, "locked": True}
         capturing = self.control.current_status in [
@@ -29,19 +335,29 @@ class FrontApp(Flask):
         if capturing:
             camera_list = self.control.cached_camera_list
             camera_config = self.control.cached_camera_config
+            self.state.update("camera_list", {"camera_list": camera_list})
+            self.state.update("camera_config", {"camera_config": camera_config})
         else:
-            camera_list = self.dslr.get_camera_list()
-            camera_config = self.dslr.get_config()
-        return {
-            "status": True,
-            "camera_list": camera_list,
-            "camera_config": camera_config,
-            "capturing": capturing,
-            "camera_connected": self.dslr.camera is not None,
-            "guider_connected": self.guider.guider is not None,
-            "last_capture": self.control.last_capture,
-            "image_data": self.control.last_image,
-        }
+            self.update_camera_section("camera_list", self.dslr.get_camera_list, since)
+            self.update_camera_section("camera_config", self.dslr.get_config, since)
+        self.state.update(
+            "flags",
+            {
+                "capturing": capturing,
+                "camera_connected": self.dslr.camera is not None,
+                "guider_connected": self.guider.guider is not None,
+                "last_capture": self.control.last_capture,
+            },
+        )
+        self.state.update("image", {"image_url": self.last_image_url()})
+        self.state.update(
+            "capture", {"capture_status": self.control.get_capture_status()}
+        )
+        seq, sections = self.state.changes(since)
+        status = {"status": True, "seq": seq}
+        for section in sections.values():
+            status.update(section)
+        return status
 
 
 # Initialize flask app
@@ -58,15 +374,16 @@ def index():
 # Static content
 @app.route("/static/<path:path>")
 def send_js(path):
-    return send_from_directory("static", path)
+    return app.assets.response(path)
 
 
 # Internal API calls
 @app.route("/status/", methods=["GET"])
 def status():
-    """Return application status"""
+    """Return application status, only changed sections if since is given"""
     try:
-        return jsonify(app.get_status())
+        since = request.args.get("since", type=int)
+        return jsonify(app.get_status(since))
     except Exception as e:
         return jsonify({"status": False, "error": "Failed getting status: %s" % e})
 
@@ -125,11 +442,14 @@ def camera_config():
 def camera_preview():
     try:
         exposure = float(request.form["exposure"])
-        image_data = app.dslr.capture_image_bulb(exposure)
+        app.preview_image = app.dslr.capture_image_bulb(exposure)
+        image_url = None
+        if app.preview_image is not None:
+            image_url = "/camera/preview.jpg?t=%d" % (time.time() * 1000)
         return jsonify(
             {
                 "status": True,
-                "image_data": image_data,
+                "image_url": image_url,
             }
         )
     except Exception as e:
@@ -150,6 +470,8 @@ def capture_start():
         settle_px = int(request.form["settle_px"])
         settle_time = int(request.form["settle_time"])
         settle_timeout = int(request.form["settle_timeout"])
+        frame_type = request.form.get("frame_type", "light")
+        interval = float(request.form.get("interval") or 0)
         # Send capture configuration to control thread
         app.control.capture_start(
             exposure,
@@ -160,6 +482,8 @@ def capture_start():
             settle_px,
             settle_time,
             settle_timeout,
+            frame_type,
+            interval,
         )
         return jsonify({"status": True})
     except Exception as e:
@@ -168,6 +492,24 @@ def capture_start():
         )
 
 
+@app.route("/capture/sequence/", methods=["POST"])
+def capture_sequence():
+    """Start a capture sequence from a JSON plan: {"blocks": [block, ...]}"""
+    try:
+        from sequence import build_block
+
+        plan = request.get_json(force=True)
+        if not plan.get("blocks"):
+            raise ValueError("Sequence has no blocks")
+        blocks = [build_block(block, app.profiles) for block in plan["blocks"]]
+        app.control.capture_sequence(blocks)
+        return jsonify({"status": True, "blocks": len(blocks)})
+    except Exception as e:
+        return jsonify(
+            {"status": False, "error": "Failed starting capture sequence: %s" % e}
+        )
+
+
 @app.route("/capture/stop/", methods=["POST"])
 def capture_stop():
     try:
@@ -190,14 +532,84 @@ def capture_status():
         )
 
 
+@app.route("/camera/preview.jpg", methods=["GET"])
+def camera_preview_image():
+    """Return the last camera preview as JPEG"""
+    if app.preview_image is None:
+        abort(404)
+    return buffer_response(app.preview_image, "image/jpeg")
+
+
+@app.route("/camera/live.mjpg", methods=["GET"])
+def camera_live_stream():
+    """
+    Stream the camera live view as multipart MJPEG
+
+    roi crops the region given as x,y,width,height fractions of the frame, zoom
+    scales it and fps limits the frame rate.
+    """
+    try:
+        stream = app.live_view.stream(
+            app.live_view.parse_roi(request.args.get("roi")),
+            float(request.args.get("zoom", 1)),
+            float(request.args.get("fps", 0)) or None,
+        )
+    except ValueError:
+        abort(400)
+    return Response(
+        stream, mimetype=app.live_view.mimetype, headers={"Cache-Control": "no-store"}
+    )
+
+
+@app.route("/camera/live/status/", methods=["GET"])
+def camera_live_status():
+    """Return the live view state and frame rate"""
+    try:
+        return jsonify({"status": True, "live_status": app.live_view.get_status()})
+    except Exception as e:
+        return jsonify(
+            {"status": False, "error": "Failed getting live view status: %s" % e}
+        )
+
+
+@app.route("/camera/sync/start/", methods=["POST"])
+def camera_sync_start():
+    """Start downloading the camera card in background"""
+    try:
+        started = app.dslr.card_sync.start()
+        return jsonify({"status": True, "started": started})
+    except Exception as e:
+        return jsonify({"status": False, "error": "Failed starting card sync: %s" % e})
+
+
+@app.route("/camera/sync/stop/", methods=["POST"])
+def camera_sync_stop():
+    """Stop downloading the camera card"""
+    try:
+        app.dslr.card_sync.stop()
+        return jsonify({"status": True})
+    except Exception as e:
+        return jsonify({"status": False, "error": "Failed stopping card sync: %s" % e})
+
+
+@app.route("/camera/sync/status/", methods=["GET"])
+def camera_sync_status():
+    """Return card sync progress and transfer rate"""
+    try:
+        return jsonify({"status": True, "sync_status": app.dslr.card_sync.get_status()})
+    except Exception as e:
+        return jsonify(
+            {"status": False, "error": "Failed getting card sync status: %s" % e}
+        )
+
+
 @app.route("/capture/last_image/", methods=["GET"])
 def capture_get_last_image():
     try:
-        image_data = app.control.get_capture_image()
         return jsonify(
             {
                 "status": True,
-                "image_data": image_data,
+                "image_url": app.last_image_url(),
             }
         )
     except Exception as e:
@@ -206,6 +618,335 @@ def capture_get_last_image():
         )
 
 
+@app.route("/capture/last_image.jpg", methods=["GET"])
+def capture_last_image_data():
+    """Return the last captured image as JPEG, straight from the camera buffer"""
+    image_data = app.control.get_capture_image()
+    if image_data is None:
+        abort(404)
+    return buffer_response(image_data, "image/jpeg")
+
+
+# Live stacking
+@app.route("/stack/status/", methods=["GET"])
+def stack_status():
+    """Return live stack status"""
+    try:
+        return jsonify({"status": True, "stack_status": app.stacker.get_status()})
+    except Exception as e:
+        return jsonify(
+            {"status": False, "error": "Failed getting stack status: %s" % e}
+        )
+
+
+@app.route("/stack/preview/", methods=["GET"])
+def stack_preview():
+    """Return the URL of the current live stack preview"""
+    try:
+        status = app.stacker.get_status()
+        image_url = None
+        if app.stacker.get_preview() is not None:
+            image_url = "/stack/preview.jpg?frames=%s-%d" % (
+                status["session"],
+                status["frames"],
+            )
+        return jsonify({"status": True, "image_url": image_url})
+    except Exception as e:
+        return jsonify(
+            {"status": False, "error": "Failed getting stack preview: %s" % e}
+        )
+
+
+@app.route("/stack/preview.jpg", methods=["GET"])
+def stack_preview_image():
+    """Return the current live stack rendered as JPEG"""
+    image_data = app.stacker.get_preview()
+    if image_data is None:
+        abort(404)
+    return buffer_response(image_data, "image/jpeg")
+
+
+@app.route("/stack/reset/", methods=["POST"])
+def stack_reset():
+    """Discard the current live stack"""
+    try:
+        app.stacker.reset()
+        return jsonify({"status": True})
+    except Exception as e:
+        return jsonify({"status": False, "error": "Failed resetting stack: %s" % e})
+
+
+# Calibration
+@app.route("/calibration/status/", methods=["GET"])
+def calibration_status():
+    """Return calibration masters and pending calibration frames"""
+    try:
+        return jsonify(
+            {"status": True, "calibration_status": app.calibration.get_status()}
+        )
+    except Exception as e:
+        return jsonify(
+            {"status": False, "error": "Failed getting calibration status: %s" % e}
+        )
+
+
+@app.route("/calibration/build/", methods=["POST"])
+def calibration_build():
+    """Build a master frame from the calibration frames of a session"""
+    try:
+        session = request.form["session"]
+        frame_type = request.form["frame_type"]
+        method = request.form.get("method")
+        app.calibration.request_build(session, frame_type, method)
+        return jsonify({"status": True})
+    except Exception as e:
+        return jsonify(
+            {"status": False, "error": "Failed building calibration master: %s" % e}
+        )
+
+
+@app.route("/calibration/clear/", methods=["POST"])
+def calibration_clear():
+    """Remove a calibration master"""
+    try:
+        app.calibration.clear(request.form["frame_type"])
+        return jsonify({"status": True})
+    except Exception as e:
+        return jsonify(
+            {"status": False, "error": "Failed clearing calibration master: %s" % e}
+        )
+
+
+# FITS export
+@app.route("/fits/status/", methods=["GET"])
+def fits_status():
+    """Return FITS export status"""
+    try:
+        return jsonify({"status": True, "fits_status": app.fits.get_status()})
+    except Exception as e:
+        return jsonify(
+            {"status": False, "error": "Failed getting FITS export status: %s" % e}
+        )
+
+
+@app.route("/fits/enable/", methods=["POST"])
+def fits_enable():
+    """Enable or disable FITS export of captured frames"""
+    try:
+        app.fits.enabled = request.form["enabled"] == "true"
+        return jsonify({"status": True})
+    except Exception as e:
+        return jsonify({"status": False, "error": "Failed setting FITS export: %s" % e})
+
+
+@app.route("/frames/status/", methods=["GET"])
+def frames_status():
+    """Return JPEG frame storage status"""
+    try:
+        return jsonify({"status": True, "frames_status": app.frames.get_status()})
+    except Exception as e:
+        return jsonify(
+            {"status": False, "error": "Failed getting frame storage status: %s" % e}
+        )
+
+
+@app.route("/frames/enable/", methods=["POST"])
+def frames_enable():
+    """Enable or disable storage of captured JPEG frames"""
+    try:
+        app.frames.enabled = request.form["enabled"] == "true"
+        return jsonify({"status": True})
+    except Exception as e:
+        return jsonify(
+            {"status": False, "error": "Failed setting frame storage: %s" % e}
+        )
+
+
+# Captured frame history
+@app.route("/history/status/", methods=["GET"])
+def history_status():
+    """Return frame history memory and disk usage"""
+    try:
+        return jsonify({"status": True, "history_status": app.history.get_status()})
+    except Exception as e:
+        return jsonify(
+            {"status": False, "error": "Failed getting history status: %s" % e}
+        )
+
+
+@app.route("/history/frames/", methods=["GET"])
+def history_frames():
+    """Return the last frames of a session, the current one by default"""
+    try:
+        session, frames = app.history.frames(
+            request.args.get("session"), request.args.get("limit", 10, type=int)
+        )
+        return jsonify({"status": True, "session": session, "frames": frames})
+    except Exception as e:
+        return jsonify(
+            {"status": False, "error": "Failed getting frame history: %s" % e}
+        )
+
+
+@app.route("/history/<session>/<int:index>.jpg", methods=["GET"])
+def history_frame(session, index):
+    """Return a frame of the history as JPEG"""
+    data = app.history.get_data(session, index)
+    if data is None:
+        abort(404)
+    return buffer_response(data, "image/jpeg")
+
+
+# Deep zoom tile pyramids
+@app.route("/tiles/status/", methods=["GET"])
+def tiles_status():
+    """Return tile pyramid generation status and the last pyramid generated"""
+    try:
+        return jsonify({"status": True, "tiles_status": app.tiles.get_status()})
+    except Exception as e:
+        return jsonify(
+            {"status": False, "error": "Failed getting tiles status: %s" % e}
+        )
+
+
+@app.route("/tiles/<session>/<int:index>/", methods=["GET"])
+def tiles_info(session, index):
+    """Return the tile pyramid description of a frame"""
+    try:
+        pyramid = app.tiles.get_info(session, index)
+        if pyramid is None:
+            raise Exception("Frame has no tile pyramid")
+        return jsonify({"status": True, "pyramid": pyramid})
+    except Exception as e:
+        return jsonify({"status": False, "error": "Failed getting tiles: %s" % e})
+
+
+@app.route("/tiles/<session>/<int:index>/<int:level>/<int:column>_<int:row>.jpg")
+def tiles_tile(session, index, level, column, row):
+    """Return a pyramid tile, they never change so browsers may cache them"""
+    try:
+        with open(app.tiles.tile_path(session, index, level, column, row), "rb") as fd:
+            data = fd.read()
+    except (OSError, ValueError):
+        abort(404)
+    return Response(
+        data,
+        mimetype="image/jpeg",
+        headers={"Cache-Control": "private, max-age=%d" % app.TILE_MAX_AGE},
+    )
+
+
+# Frame quality gate
+@app.route("/quality/status/", methods=["GET"])
+def quality_status():
+    """Return quality gate settings and results"""
+    try:
+        return jsonify({"status": True, "quality_status": app.quality.get_status()})
+    except Exception as e:
+        return jsonify(
+            {"status": False, "error": "Failed getting quality status: %s" % e}
+        )
+
+
+@app.route("/quality/config/", methods=["POST"])
+def quality_config():
+    """Update quality gate thresholds and reshoot settings"""
+    try:
+        app.quality.configure(**request.form.to_dict())
+        return jsonify({"status": True, "settings": app.quality.settings})
+    except Exception as e:
+        return jsonify(
+            {"status": False, "error": "Failed setting quality config: %s" % e}
+        )
+
+
+# Frame catalog
+@app.route("/catalog/frames/", methods=["GET"])
+def catalog_frames():
+    """Return a page of catalogued frames matching the given filters"""
+    try:
+        result = app.catalog.query(
+            session=request.args.get("session"),
+            frame_type=request.args.get("frame_type"),
+            since=request.args.get("since", type=float),
+            until=request.args.get("until", type=float),
+            max_guide_rms=request.args.get("max_guide_rms", type=float),
+            order=request.args.get("order", "started"),
+            descending=request.args.get("descending") == "true",
+            page=request.args.get("page", 1, type=int),
+            per_page=request.args.get("per_page", 50, type=int),
+        )
+        return jsonify(dict(result, status=True))
+    except Exception as e:
+        return jsonify({"status": False, "error": "Failed querying frames: %s" % e})
+
+
+@app.route("/catalog/sessions/", methods=["GET"])
+def catalog_sessions():
+    """Return catalogued capture sessions"""
+    try:
+        return jsonify({"status": True, "sessions": app.catalog.sessions()})
+    except Exception as e:
+        return jsonify({"status": False, "error": "Failed getting sessions: %s" % e})
+
+
+# Capture profiles
+@app.route("/profiles/", methods=["GET"])
+def profiles_list():
+    """Return stored capture profiles"""
+    try:
+        return jsonify({"status": True, "profiles": app.profiles.list()})
+    except Exception as e:
+        return jsonify({"status": False, "error": "Failed getting profiles: %s" % e})
+
+
+@app.route("/profiles/save/", methods=["POST"])
+def profile_save():
+    """Store a capture profile from camera config and sequence values"""
+    try:
+        values = request.form.to_dict()
+        name = values.pop("name", "")
+        profile = app.profiles.store(name, values)
+        return jsonify({"status": True, "profile": profile})
+    except Exception as e:
+        return jsonify({"status": False, "error": "Failed saving profile: %s" % e})
+
+
+@app.route("/profiles/delete/", methods=["POST"])
+def profile_delete():
+    """Delete a capture profile"""
+    try:
+        app.profiles.delete(request.form["name"])
+        return jsonify({"status": True})
+    except Exception as e:
+        return jsonify({"status": False, "error": "Failed deleting profile: %s" % e})
+
+
+@app.route("/profiles/apply/", methods=["POST"])
+def profile_apply():
+    """Apply a capture profile writing only the changed camera values"""
+    try:
+        from sequence import build_block
+
+        profile = app.profiles.get(request.form["name"])
+        changes = app.dslr.apply_config(profile["config"])
+        app.control.update_cached_config(changes)
+        if request.form.get("start") == "true":
+            # Sequence parameters missing from the profile take their defaults
+            block = build_block({"profile": request.form["name"]}, app.profiles)
+            app.control.capture_sequence([block])
+        return jsonify(
+            {
+                "status": True,
+                "changes": changes,
+                "config": app.control.cached_camera_config,
+                "sequence": profile["sequence"],
+            }
+        )
+    except Exception as e:
+        return jsonify({"status": False, "error": "Failed applying profile: %s" % e})
+
+
 # Guider connection
 @app.route("/guider/connect/", methods=["POST"])
 def guiding_connect():
@@ -230,3 +971,88 @@ def guiding_disconnect():
         return jsonify(
             {"status": False, "error": "Failed disconnecting from guider: %s" % e}
         )
+
+
+# Multi-rig control
+@app.route("/rigs/status/", methods=["GET"])
+def rigs_status():
+    """Return the rigs changed since the given sequence, removed ones as null"""
+    try:
+        since = request.args.get("since", type=int)
+        return jsonify(dict(app.rigs.get_status(since), status=True))
+    except Exception as e:
+        return jsonify({"status": False, "error": "Failed getting rigs status: %s" % e})
+
+
+@app.route("/rigs/add/", methods=["POST"])
+def rigs_add():
+    """Add a rig agent given as host or host:port"""
+    try:
+        address = app.rigs.add_rig(request.form["address"])
+        return jsonify({"status": True, "address": address})
+    except Exception as e:
+        return jsonify({"status": False, "error": "Failed adding rig: %s" % e})
+
+
+@app.route("/rigs/remove/", methods=["POST"])
+def rigs_remove():
+    """Remove a rig agent"""
+    try:
+        app.rigs.remove_rig(request.form["address"])
+        return jsonify({"status": True})
+    except Exception as e:
+        return jsonify({"status": False, "error": "Failed removing rig: %s" % e})
+
+
+@app.route("/rigs/start/", methods=["POST"])
+def rigs_start():
+    """
+    Start a capture sequence on several rigs at once
+
+    Takes a JSON plan like /capture/sequence/ with the addresses of the rigs,
+    all connected ones by default: {"blocks": [block, ...], "rigs": [...]}
+    """
+    try:
+        plan = request.get_json(force=True)
+        if not plan.get("blocks"):
+            raise ValueError("Sequence has no blocks")
+        replies = app.rigs.start_sequence(plan["blocks"], plan.get("rigs"))
+        return jsonify({"status": True, "replies": replies})
+    except Exception as e:
+        return jsonify(
+            {"status": False, "error": "Failed starting rig sequences: %s" % e}
+        )
+
+
+@app.route("/rigs/stop/", methods=["POST"])
+def rigs_stop():
+    """Stop capturing on the given rigs, all connected ones by default"""
+    try:
+        addresses = request.form.getlist("rigs") or None
+        replies = app.rigs.stop_sequence(addresses)
+        return jsonify({"status": True, "replies": replies})
+    except Exception as e:
+        return jsonify(
+            {"status": False, "error": "Failed stopping rig sequences: %s" % e}
+        )
+
+
+@app.route("/rigs/frame.jpg", methods=["GET"])
+def rigs_frame():
+    """Return the thumbnail of the last frame of a rig"""
+    data = app.rigs.get_thumbnail(request.args.get("rig"))
+    if data is None:
+        abort(404)
+    return buffer_response(data, "image/jpeg")
+
+
+@app.route("/agent/status/", methods=["GET"])
+def agent_status():
+    """Return the agent port and the controllers connected to it"""
+    try:
+        agent_status = app.agent.get_status() if app.agent is not None else None
+        return jsonify({"status": True, "agent_status": agent_status})
+    except Exception as e:
+        return jsonify(
+            {"status": False, "error": "Failed getting agent status: %s" % e}
+        )
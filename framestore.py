@@ -0,0 +1,64 @@
+"""Captured frame storage"""
+
+import os
+import threading
+
+from pipeline import FrameStage
+from settings import DATA_DIR
+
+
+class FrameStore(FrameStage):
+    """
+    JPEG frame storage stage
+
+    Frames are written as received from the camera, straight from the gphoto2
+    buffer, to DATA_DIR/frames/<session>/ and their paths recorded in the catalog.
+    """
+
+    name = "framestore"
+
+    QUEUE_SIZE = 8
+
+    def __init__(self, logger=None, enabled=False, catalog=None):
+        super().__init__(logger)
+        self.enabled = enabled
+        self.catalog = catalog
+        self.lock = threading.Lock()
+        self.saved = 0
+        self.last_path = None
+
+    def get_status(self):
+        with self.lock:
+            return {
+                "enabled": self.enabled,
+                "saved": self.saved,
+                "dropped": self.dropped,
+                "pending": self.queue.qsize(),
+                "last_path": self.last_path,
+            }
+
+    def submit(self, frame):
+        if not self.enabled:
+            return False
+        return super().submit(frame)
+
+    def frame_path(self, frame):
+        frame_type = frame.get("frame_type", "light")
+        path = os.path.join(
+            DATA_DIR,
+            "frames",
+            frame["session"],
+            "%s_%s_%05d.jpg" % (frame["session"], frame_type, frame["index"]),
+        )
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
+
+    def process(self, frame):
+        path = self.frame_path(frame)
+        with open(path, "wb") as fd:
+            fd.write(frame["data"])
+        with self.lock:
+            self.saved += 1
+            self.last_path = path
+        if self.catalog is not None:
+            self.catalog.record(frame["session"], frame["index"], jpeg_path=path)
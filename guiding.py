@@ -2,16 +2,144 @@
 PHD2 guider helper
 """
 
+import math
+import threading
+import time
+from array import array
+
 from thirdparty.phd2guider import Guider as PHD2Guider
 
 
-class GuiderHelper:
+class GuideSeries:
+    """
+    Timestamped series of guide steps
+
+    The last CAPACITY - 1 steps are kept in a ring with the cumulative sums of the RA
+    and Dec distances and their squares, and a max tree of their absolute values,
+    so the statistics of the steps in any time window are computed in O(log n):
+    a binary search for the window bounds, sum differences and a tree query.
+    """
+
+    # Steps kept (a power of two), hours of guiding at usual rates
+    CAPACITY = 1 << 16
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        size = self.CAPACITY
+        self.times = array("d", bytes(8 * size))
+        # Cumulative sums of ra, ra², dec and dec² up to each step
+        self.sums = [array("d", bytes(8 * size)) for _ in range(4)]
+        # Max trees of |ra| and |dec|, leaves at CAPACITY + slot
+        self.peaks = [array("d", bytes(16 * size)) for _ in range(2)]
+        # Number of steps ever added and oldest step kept
+        self.count = 0
+        self.first = 0
+
+    def add(self, t, ra, dec):
+        with self.lock:
+            slot = self.count % self.CAPACITY
+            self.times[slot] = t
+            for n, value in enumerate((ra, ra * ra, dec, dec * dec)):
+                previous = self.sums[n][(slot - 1) % self.CAPACITY] if self.count else 0
+                self.sums[n][slot] = previous + value
+            for tree, value in zip(self.peaks, (abs(ra), abs(dec))):
+                node = self.CAPACITY + slot
+                tree[node] = value
+                while node > 1:
+                    node //= 2
+                    tree[node] = max(tree[2 * node], tree[2 * node + 1])
+            self.count += 1
+            # The sums of the step before the first one are needed for differences
+            self.first = max(0, self.count - self.CAPACITY + 1)
+
+    def _search(self, t):
+        """Return the first step kept taken at or after t"""
+        low, high = self.first, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.times[middle % self.CAPACITY] < t:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def _sum(self, n, first, last):
+        total = self.sums[n][last % self.CAPACITY]
+        if first > 0:
+            total -= self.sums[n][(first - 1) % self.CAPACITY]
+        return total
+
+    def _peak(self, tree, first, last):
+        """Return the maximum value of the slots of steps first to last"""
+        first %= self.CAPACITY
+        last %= self.CAPACITY
+        if first > last:
+            # The window wraps around the ring
+            return max(
+                self._peak(tree, first, self.CAPACITY - 1), self._peak(tree, 0, last)
+            )
+        peak = 0.0
+        low = first + self.CAPACITY
+        high = last + self.CAPACITY + 1
+        while low < high:
+            if low & 1:
+                peak = max(peak, tree[low])
+                low += 1
+            if high & 1:
+                high -= 1
+                peak = max(peak, tree[high])
+            low //= 2
+            high //= 2
+        return peak
+
+    def stats(self, started, finished):
+        """Return the statistics of the steps between two times, None if none"""
+        with self.lock:
+            first = self._search(started)
+            last = self._search(finished) - 1
+            steps = last - first + 1
+            if steps <= 0:
+                return None
+            ra, ra2, dec, dec2 = (self._sum(n, first, last) for n in range(4))
+            peak_ra = self._peak(self.peaks[0], first, last)
+            peak_dec = self._peak(self.peaks[1], first, last)
+        # Standard deviations, as PHD2 and Guider.Stats compute them
+        rms_ra = math.sqrt(max(0.0, ra2 / steps - (ra / steps) ** 2))
+        rms_dec = math.sqrt(max(0.0, dec2 / steps - (dec / steps) ** 2))
+        return {
+            "rms_tot": math.hypot(rms_ra, rms_dec),
+            "rms_ra": rms_ra,
+            "rms_dec": rms_dec,
+            "peak_ra": peak_ra,
+            "peak_dec": peak_dec,
+            "steps": steps,
+        }
 
+
+class SeriesGuider(PHD2Guider):
+    """PHD2 guider keeping the series of guide steps with their arrival times"""
+
+    def __init__(self, hostname="localhost", instance=1):
+        super().__init__(hostname, instance)
+        self.series = GuideSeries()
+
+    def _handle_event(self, ev):
+        if ev["Event"] == "GuideStep":
+            # Monotonic time, the clock Control times exposure windows with
+            self.series.add(time.monotonic(), ev["RADistanceRaw"], ev["DECDistanceRaw"])
+        super()._handle_event(ev)
+
+
+class GuiderHelper:
     guider = None
 
+    def __init__(self, guider_factory=None):
+        # Callable building the PHD2 client from the hostname (recording, replay)
+        self.guider_factory = guider_factory or SeriesGuider
+
     def connect(self, hostname="localhost"):
         if self.guider is None:
-            self.guider = PHD2Guider(hostname)
+            self.guider = self.guider_factory(hostname)
             self.guider.Connect()
 
     def disconnect(self):
@@ -25,6 +153,15 @@ class GuiderHelper:
         else:
             raise Exception("The guider is not connected")
 
+    def get_exposure_stats(self, started, finished):
+        """
+        Return guiding statistics of the guide steps taken during an exposure,
+        given by its time.monotonic() start and end
+        """
+        if self.guider is None:
+            return None
+        return self.guider.series.stats(started, finished)
+
     def check_settled(self):
         settling = self.guider.CheckSettling()
         if settling.Done:
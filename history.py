@@ -0,0 +1,165 @@
+"""Captured frame history"""
+
+import os
+import shutil
+import threading
+from collections import OrderedDict
+
+from pipeline import FrameStage
+from settings import DATA_DIR
+
+
+class FrameHistory(FrameStage):
+    """
+    Byte budgeted history of captured frames
+
+    Frames are kept in memory, as received from the camera, until their total
+    size exceeds memory_budget bytes. Then the least recently used ones are moved
+    to DATA_DIR/history/<session>/, where the oldest are deleted once disk_budget
+    bytes are exceeded. Frames are added as soon as they are submitted, the
+    background worker only moves them to disk.
+
+    The disk store only holds frames of the running application, it is emptied
+    on startup.
+    """
+
+    name = "history"
+
+    QUEUE_SIZE = 0
+    NEEDS_DATA = False
+
+    # Frame fields kept with the image data
+    FIELDS = ["session", "index", "frame_type", "exposure", "started", "iso"]
+
+    def __init__(self, logger=None, memory_budget=0, disk_budget=0):
+        super().__init__(logger)
+        self.memory_budget = memory_budget
+        self.disk_budget = disk_budget
+        self.root = os.path.join(DATA_DIR, "history")
+        shutil.rmtree(self.root, ignore_errors=True)
+        self.lock = threading.Lock()
+        # Entries by (session, index), least recently used or oldest first
+        self.memory = OrderedDict()
+        self.disk = OrderedDict()
+        self.memory_bytes = 0
+        self.disk_bytes = 0
+        self.evicted = 0
+        self.deleted = 0
+
+    def get_status(self):
+        with self.lock:
+            return {
+                "memory_budget": self.memory_budget,
+                "memory_bytes": self.memory_bytes,
+                "memory_frames": len(self.memory),
+                "disk_budget": self.disk_budget,
+                "disk_bytes": self.disk_bytes,
+                "disk_frames": len(self.disk),
+                "evicted": self.evicted,
+                "deleted": self.deleted,
+            }
+
+    def submit(self, frame):
+        if frame["data"] is None:
+            return False
+        entry = {name: frame.get(name) for name in self.FIELDS}
+        entry["data"] = memoryview(frame["data"]).cast("B")
+        entry["size"] = len(entry["data"])
+        key = (frame["session"], frame["index"])
+        with self.lock:
+            self._remove(key)
+            self.memory[key] = entry
+            self.memory_bytes += entry["size"]
+        # Wake the worker up to move frames over the budget to disk
+        return super().submit({"index": frame["index"]})
+
+    def _remove(self, key):
+        entry = self.memory.pop(key, None)
+        if entry is not None:
+            self.memory_bytes -= entry["size"]
+        entry = self.disk.pop(key, None)
+        if entry is not None:
+            self.disk_bytes -= entry["size"]
+            self._delete(entry)
+
+    def _delete(self, entry):
+        try:
+            os.remove(entry["path"])
+        except OSError:
+            pass
+
+    def process(self, frame):
+        while True:
+            with self.lock:
+                if self.memory_bytes <= self.memory_budget or not self.memory:
+                    break
+                key, entry = next(iter(self.memory.items()))
+            path = os.path.join(self.root, key[0], "%05d.jpg" % key[1])
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb") as fd:
+                fd.write(entry["data"])
+            with self.lock:
+                if self.memory.get(key) is not entry:
+                    # Replaced while it was written
+                    continue
+                del self.memory[key]
+                self.memory_bytes -= entry["size"]
+                del entry["data"]
+                entry["path"] = path
+                self.disk[key] = entry
+                self.disk_bytes += entry["size"]
+                self.evicted += 1
+                expired = []
+                while self.disk_bytes > self.disk_budget and self.disk:
+                    _, expired_entry = self.disk.popitem(last=False)
+                    self.disk_bytes -= expired_entry["size"]
+                    self.deleted += 1
+                    expired.append(expired_entry)
+            for expired_entry in expired:
+                self._delete(expired_entry)
+
+    def get_data(self, session, index):
+        """Return the image data of a frame, None if it is not in the history"""
+        key = (session, index)
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry is not None:
+                self.memory.move_to_end(key)
+                return entry["data"]
+            entry = self.disk.get(key)
+            if entry is None:
+                return None
+            path = entry["path"]
+        try:
+            with open(path, "rb") as fd:
+                return fd.read()
+        except OSError:
+            # Deleted meanwhile
+            return None
+
+    def frames(self, session=None, limit=10):
+        """
+        Return the last frames of a session, newest first
+
+        The session of the last frame added is used if none is given.
+        """
+        with self.lock:
+            entries = list(self.disk.values()) + list(self.memory.values())
+            frames = [
+                dict(
+                    {name: entry[name] for name in self.FIELDS},
+                    size=entry["size"],
+                    in_memory="data" in entry,
+                )
+                for entry in entries
+            ]
+        if session is None and frames:
+            session = max(frames, key=lambda frame: frame["started"] or 0)["session"]
+        frames = [frame for frame in frames if frame["session"] == session]
+        frames.sort(key=lambda frame: frame["index"], reverse=True)
+        for frame in frames:
+            frame["image_url"] = "/history/%s/%d.jpg" % (
+                frame["session"],
+                frame["index"],
+            )
+        return session, frames[:limit]
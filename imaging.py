@@ -0,0 +1,111 @@
+"""Image decoding and rendering helpers"""
+
+import io
+
+import numpy as np
+from PIL import Image
+
+
+class BufferReader(io.RawIOBase):
+    """
+    Read-only file object over a bytes-like buffer
+
+    Unlike io.BytesIO it does not copy the buffer, so camera memoryviews can be
+    decoded without duplicating the whole file in memory.
+    """
+
+    def __init__(self, data):
+        self.view = memoryview(data).cast("B")
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buf):
+        size = min(len(buf), len(self.view) - self.pos)
+        buf[:size] = self.view[self.pos : self.pos + size]
+        self.pos += size
+        return size
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.pos
+        elif whence == io.SEEK_END:
+            offset += len(self.view)
+        self.pos = max(0, offset)
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+
+def decode_jpeg(data, binning=1, dtype=np.float32):
+    """
+    Decode JPEG data into an RGB array (float32 by default)
+
+    Binning is done by the JPEG decoder itself when possible (DCT scaling), which
+    is much faster than decoding at full resolution and resizing afterwards.
+    """
+    img = Image.open(BufferReader(data))
+    if binning > 1:
+        size = (img.width // binning, img.height // binning)
+        img.draft("RGB", size)
+        if img.size != size:
+            img = img.resize(size, Image.BOX)
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+    return np.asarray(img, dtype=dtype)
+
+
+def luminance(image):
+    """Return the luminance plane of an RGB array"""
+    if image.ndim == 2:
+        return image
+    return image.mean(axis=2, dtype=np.float32)
+
+
+def stretch(image, low=0.5, high=99.9, sample=4):
+    """Linear stretch between percentiles returning an uint8 array"""
+    values = image[::sample, ::sample]
+    lo, hi = np.percentile(values, (low, high))
+    if hi <= lo:
+        hi = lo + 1
+    out = (image - lo) * (255.0 / (hi - lo))
+    return np.clip(out, 0, 255).astype(np.uint8)
+
+
+def encode_jpeg(image, quality=85):
+    """Encode an uint8 array as JPEG data"""
+    buf = io.BytesIO()
+    Image.fromarray(image).save(buf, "JPEG", quality=quality)
+    return buf.getvalue()
+
+
+def superpixel(mosaic, pattern="RGGB", binning=1):
+    """
+    Debayer a CFA mosaic into a float32 RGB array of half its size
+
+    Every 2x2 cell of the pattern (as read row by row from the top left corner)
+    becomes one pixel with the green photosites averaged, and binning averages
+    binning x binning cells more. No interpolation, so values stay linear.
+    """
+    pattern = pattern.upper()
+    if sorted(pattern) != ["B", "G", "G", "R"]:
+        raise ValueError("Invalid CFA pattern: %s" % pattern)
+    size = 2 * binning
+    height = mosaic.shape[0] // size
+    width = mosaic.shape[1] // size
+    cells = (
+        mosaic[: height * size, : width * size]
+        .reshape(height, binning, 2, width, binning, 2)
+        .sum(axis=(1, 4), dtype=np.float32)
+    )
+    image = np.empty((height, width, 3), np.float32)
+    for channel, color in enumerate("RGB"):
+        sites = [n for n, site in enumerate(pattern) if site == color]
+        image[..., channel] = sum(cells[:, n // 2, :, n % 2] for n in sites)
+        image[..., channel] /= len(sites) * binning * binning
+    return image
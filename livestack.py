@@ -0,0 +1,167 @@
+"""Live stacking"""
+
+import threading
+
+import numpy as np
+
+from imaging import decode_jpeg, encode_jpeg, luminance, stretch
+from pipeline import FrameStage
+
+
+def phase_correlation(ref_fft, image, window):
+    """
+    Return the (dy, dx) translation that aligns image with the reference
+
+    ref_fft is the conjugated FFT of the windowed reference luminance.
+    """
+    image_fft = np.fft.rfft2((image - image.mean()) * window)
+    cross = image_fft * ref_fft
+    cross /= np.abs(cross) + 1e-9
+    corr = np.fft.irfft2(cross, s=image.shape)
+    peak = np.unravel_index(np.argmax(corr), corr.shape)
+    shift = []
+    for pos, size in zip(peak, corr.shape):
+        # Peaks beyond the half size are negative shifts
+        shift.append(int(pos - size if pos > size // 2 else pos))
+    # The peak is where the reference matches the image, so negate it to move the
+    # image onto the reference
+    return -shift[0], -shift[1], float(corr[peak])
+
+
+def overlap_slices(shape, dy, dx):
+    """Return destination and source slices for a translation by (dy, dx)"""
+    h, w = shape[:2]
+    dst = (slice(max(dy, 0), min(h, h + dy)), slice(max(dx, 0), min(w, w + dx)))
+    src = (slice(max(-dy, 0), min(h, h - dy)), slice(max(-dx, 0), min(w, w - dx)))
+    return dst, src
+
+
+class LiveStacker(FrameStage):
+    """
+    Live stacking stage
+
+    Frames are registered against the first frame of the session using translation
+    only (FFT phase correlation) and accumulated in float32 arrays. Memory usage
+    only depends on the frame size, never on the number of stacked frames.
+
+    Two combination modes are supported:
+
+        mean: Streaming mean
+        sigma: Streaming mean with incremental sigma clipping (Welford variance)
+    """
+
+    name = "livestack"
+
+    # Frames are binned on decoding to bound memory and processing time
+    BINNING = 2
+    # Combination mode ("mean" or "sigma")
+    MODE = "sigma"
+    # Sigma clipping factor and number of frames needed before clipping
+    KAPPA = 3.0
+    CLIP_MIN_FRAMES = 3
+
+    def __init__(self, logger=None, calibration=None):
+        super().__init__(logger)
+        self.calibration = calibration
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self, session=None):
+        with self.lock:
+            self.session = session
+            self.window = None
+            self.ref_fft = None
+            self.mean = None
+            self.m2 = None
+            self.count = None
+            self.frames = 0
+            self.rejected_pixels = 0
+            self.last_shift = None
+            self.preview = None
+
+    def get_status(self):
+        with self.lock:
+            return {
+                "session": self.session,
+                "frames": self.frames,
+                "rejected_pixels": self.rejected_pixels,
+                "dropped": self.dropped,
+                "last_shift": self.last_shift,
+                "mode": self.MODE,
+            }
+
+    def get_preview(self):
+        with self.lock:
+            return self.preview
+
+    def process(self, frame):
+        if frame.get("frame_type", "light") != "light":
+            return
+        image = self.prepare(frame)
+        if frame["session"] != self.session:
+            self.reset(frame["session"])
+        with self.lock:
+            if self.mean is not None and self.mean.shape != image.shape:
+                self.logger.warning("livestack: Frame size changed, restarting stack")
+                self.ref_fft = None
+            if self.ref_fft is None:
+                self._set_reference(image)
+                dy, dx = 0, 0
+            else:
+                dy, dx, _ = phase_correlation(
+                    self.ref_fft, luminance(image), self.window
+                )
+            self._accumulate(image, dy, dx)
+            self.frames += 1
+            self.last_shift = (dy, dx)
+            mean = self.mean
+        preview = encode_jpeg(stretch(mean))
+        with self.lock:
+            self.preview = preview
+        self.logger.info(
+            "livestack: Stacked frame %s (shift %s, %s)",
+            frame["index"],
+            (dy, dx),
+            self.frames,
+        )
+
+    def prepare(self, frame):
+        """Decode and calibrate frame data into the array to be stacked"""
+        image = decode_jpeg(frame["data"], self.BINNING)
+        if self.calibration is not None:
+            image = self.calibration.apply(image)
+        return image
+
+    def _set_reference(self, image):
+        lum = luminance(image)
+        self.window = np.outer(
+            np.hanning(lum.shape[0]), np.hanning(lum.shape[1])
+        ).astype(np.float32)
+        self.ref_fft = np.conj(np.fft.rfft2((lum - lum.mean()) * self.window))
+        self.mean = np.zeros(image.shape, dtype=np.float32)
+        self.count = np.zeros(image.shape, dtype=np.float32)
+        self.m2 = None
+        if self.MODE == "sigma":
+            self.m2 = np.zeros(image.shape, dtype=np.float32)
+
+    def _accumulate(self, image, dy, dx):
+        dst, src = overlap_slices(image.shape, dy, dx)
+        value = image[src]
+        mean = self.mean[dst]
+        count = self.count[dst]
+        if self.MODE == "sigma":
+            m2 = self.m2[dst]
+            # Reject values further than KAPPA sigmas from the running mean once
+            # there are enough samples to estimate the deviation
+            sigma = np.sqrt(m2 / np.maximum(count - 1, 1))
+            accept = (count < self.CLIP_MIN_FRAMES) | (
+                np.abs(value - mean) <= self.KAPPA * sigma
+            )
+            self.rejected_pixels += int(value.size - np.count_nonzero(accept))
+            count += accept
+            delta = np.where(accept, value - mean, 0)
+            mean += delta / np.maximum(count, 1)
+            m2 += delta * (value - mean)
+        else:
+            count += 1
+            mean += (value - mean) / count
@@ -0,0 +1,224 @@
+"""Camera live view streaming"""
+
+import io
+import threading
+import time
+from collections import deque
+
+from PIL import Image
+
+from imaging import BufferReader
+
+
+def crop_jpeg(data, roi=None, zoom=1.0, quality=80):
+    """
+    Crop and scale JPEG data returning JPEG data
+
+    roi is the region kept as (x, y, width, height) fractions of the image. Zoomed
+    in pixels are repeated instead of interpolated so focus is judged on the
+    camera's own pixels.
+    """
+    image = Image.open(BufferReader(data))
+    if roi is not None:
+        x, y, width, height = roi
+        image = image.crop(
+            (
+                round(x * image.width),
+                round(y * image.height),
+                max(round((x + width) * image.width), round(x * image.width) + 1),
+                max(round((y + height) * image.height), round(y * image.height) + 1),
+            )
+        )
+    if zoom != 1:
+        size = (max(1, round(image.width * zoom)), max(1, round(image.height * zoom)))
+        image = image.resize(size, Image.NEAREST if zoom > 1 else Image.BOX)
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    buf = io.BytesIO()
+    image.save(buf, "JPEG", quality=quality)
+    return buf.getvalue()
+
+
+class LiveView:
+    """
+    Camera live view for focusing
+
+    While at least one client is watching, preview frames are grabbed in a
+    background thread with dslr.try_capture_preview, which returns at once
+    without a frame when a capture or another foreground operation needs the
+    camera: live view pauses during captures instead of delaying them. Frames are
+    grabbed at most MAX_FPS times per second and shared by all clients, each one
+    cropping its region of interest at its own frame rate.
+    """
+
+    MAX_FPS = 15
+    MAX_ZOOM = 8
+    QUALITY = 80
+    BOUNDARY = "frame"
+    # Seconds between camera checks while paused by foreground operations
+    POLL_INTERVAL = 0.05
+    # Seconds a client waits for a frame before ending its stream
+    FRAME_TIMEOUT = 10
+
+    def __init__(self, dslr, logger):
+        self.dslr = dslr
+        self.logger = logger
+        self.condition = threading.Condition()
+        self.thread = None
+        self.clients = 0
+        self.frame = None
+        self.seq = 0
+        self.state = "idle"
+        self.error = None
+        self.pauses = 0
+        # Grab times used to compute the frame rate
+        self.times = deque(maxlen=self.MAX_FPS * 2)
+
+    @property
+    def mimetype(self):
+        return "multipart/x-mixed-replace; boundary=%s" % self.BOUNDARY
+
+    def get_status(self):
+        with self.condition:
+            fps = 0.0
+            if len(self.times) > 1 and self.times[-1] > self.times[0]:
+                fps = (len(self.times) - 1) / (self.times[-1] - self.times[0])
+            return {
+                "state": self.state,
+                "clients": self.clients,
+                "frames": self.seq,
+                "pauses": self.pauses,
+                "fps": fps,
+                "max_fps": self.MAX_FPS,
+                "error": self.error,
+            }
+
+    @staticmethod
+    def parse_roi(text):
+        """Parse a region of interest given as x,y,width,height fractions"""
+        if not text:
+            return None
+        roi = tuple(float(value) for value in text.split(","))
+        if len(roi) != 4:
+            raise ValueError("Region of interest needs x,y,width,height: %s" % text)
+        x, y, width, height = roi
+        if not (0 <= x < 1 and 0 <= y < 1 and 0 < width and 0 < height):
+            raise ValueError("Invalid region of interest: %s" % text)
+        return (x, y, min(width, 1 - x), min(height, 1 - y))
+
+    def stream(self, roi=None, zoom=1.0, fps=None):
+        """
+        Return a generator of multipart MJPEG stream chunks
+
+        The camera is only used while the generator is being consumed.
+        """
+        if not 1.0 / self.MAX_ZOOM <= zoom <= self.MAX_ZOOM:
+            raise ValueError("Zoom out of range: %s" % zoom)
+        if fps is not None and fps <= 0:
+            raise ValueError("Invalid frame rate: %s" % fps)
+        fps = min(fps or self.MAX_FPS, self.MAX_FPS)
+        return self._stream(roi, zoom, 1.0 / fps)
+
+    def _stream(self, roi, zoom, interval):
+        self._open()
+        try:
+            seq = None
+            deadline = time.monotonic()
+            while True:
+                frame, seq = self._wait_frame(seq)
+                if frame is None:
+                    break
+                if roi is not None or zoom != 1:
+                    frame = crop_jpeg(frame, roi, zoom, self.QUALITY)
+                yield (
+                    "--%s\r\nContent-Type: image/jpeg\r\nContent-Length: %d\r\n\r\n"
+                    % (self.BOUNDARY, len(frame))
+                ).encode()
+                yield bytes(frame)
+                yield b"\r\n"
+                deadline += interval
+                delay = deadline - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                else:
+                    deadline = time.monotonic()
+        finally:
+            self._close()
+
+    def _open(self):
+        with self.condition:
+            self.clients += 1
+            if self.thread is None:
+                self.state = "starting"
+                self.error = None
+                self.thread = threading.Thread(
+                    target=self._run, name="liveview", daemon=True
+                )
+                self.thread.start()
+
+    def _close(self):
+        with self.condition:
+            self.clients -= 1
+
+    def _wait_frame(self, seq):
+        """Wait for a frame newer than seq, returning (None, seq) once stopped"""
+        with self.condition:
+            self.condition.wait_for(
+                lambda: self.thread is None
+                or (self.frame is not None and self.seq != seq),
+                self.FRAME_TIMEOUT,
+            )
+            if self.frame is None or self.seq == seq:
+                return None, seq
+            return self.frame, self.seq
+
+    def _stopped(self, state):
+        self.state = state
+        self.thread = None
+        self.frame = None
+        self.times.clear()
+        self.condition.notify_all()
+
+    def _run(self):
+        interval = 1.0 / self.MAX_FPS
+        deadline = time.monotonic()
+        paused = False
+        try:
+            while True:
+                with self.condition:
+                    if self.clients <= 0:
+                        # Later clients start a new thread
+                        self._stopped("idle")
+                        break
+                frame = self.dslr.try_capture_preview()
+                if frame is None:
+                    if not paused:
+                        paused = True
+                        with self.condition:
+                            self.state = "paused"
+                            self.pauses += 1
+                    time.sleep(self.POLL_INTERVAL)
+                    deadline = time.monotonic()
+                    continue
+                paused = False
+                with self.condition:
+                    self.frame = frame
+                    self.seq += 1
+                    self.state = "streaming"
+                    self.times.append(time.monotonic())
+                    self.condition.notify_all()
+                deadline += interval
+                delay = deadline - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                else:
+                    deadline = time.monotonic()
+        except Exception as e:
+            self.logger.error("Live view failed: %s", e)
+            with self.condition:
+                self.error = str(e)
+                self._stopped("error")
+        try:
+            self.dslr.end_preview()
+        except Exception as e:
+            self.logger.warning("Failed ending live view: %s", e)
@@ -0,0 +1,117 @@
+"""Application logging"""
+
+import atexit
+import json
+import logging
+import os
+import queue
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+# Parent logger of the application subsystems
+ROOT_LOGGER = "galaxydslr"
+
+# Attributes every LogRecord has, anything else was given in extra
+RECORD_ATTRS = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+
+def get_logger(subsystem):
+    """Return the logger of an application subsystem (control, dslr, stacker...)"""
+    return logging.getLogger("%s.%s" % (ROOT_LOGGER, subsystem))
+
+
+class LazyQueueHandler(QueueHandler):
+    """
+    Queue handler leaving all formatting to the listener thread
+
+    The standard QueueHandler formats the message in the logging thread. Records
+    are queued as they are instead, so message arguments must not be modified
+    after logging them. Records are dropped instead of blocking if the queue is
+    full.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class JsonFormatter(logging.Formatter):
+    """Format records as JSON lines with the message arguments and extra fields"""
+
+    def format(self, record):
+        data = {
+            "time": record.created,
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "message": record.getMessage(),
+        }
+        if record.args:
+            data["template"] = str(record.msg)
+            data["args"] = record.args
+        for name, value in vars(record).items():
+            if name not in RECORD_ATTRS:
+                data[name] = value
+        if record.exc_info:
+            data["exception"] = self.formatException(record.exc_info)
+        return json.dumps(data, default=str)
+
+
+def parse_levels(levels):
+    """Parse subsystem levels given as control=DEBUG,dslr=WARNING"""
+    result = {}
+    for item in (levels or "").split(","):
+        if item.strip():
+            name, _, level = item.partition("=")
+            result[name.strip()] = level.strip().upper()
+    return result
+
+
+def setup_logging(
+    level="INFO", levels=None, path=None, max_bytes=0, backups=0, queue_size=10000
+):
+    """
+    Send every log record through a queue to a background writer thread
+
+    Records go to the console as text and, if path is given, to a size rotated
+    file as JSON lines. levels maps subsystem names to their levels. Returns the
+    queue handler, the listener is stopped at exit flushing pending records.
+    """
+    log_queue = queue.Queue(queue_size)
+    console = logging.StreamHandler()
+    console.setFormatter(
+        logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s")
+    )
+    handlers = [console]
+    if path:
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        sink = RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups)
+        sink.setFormatter(JsonFormatter())
+        handlers.append(sink)
+    listener = QueueListener(log_queue, *handlers)
+    handler = LazyQueueHandler(log_queue)
+    root = logging.getLogger()
+    for old_handler in list(root.handlers):
+        root.removeHandler(old_handler)
+    root.addHandler(handler)
+    root.setLevel(level)
+    # Flask writes application logger records synchronously with its own handler
+    from flask.logging import default_handler
+
+    for logger in list(logging.root.manager.loggerDict.values()):
+        if isinstance(logger, logging.Logger):
+            logger.removeHandler(default_handler)
+    for name, subsystem_level in (levels or {}).items():
+        get_logger(name).setLevel(subsystem_level)
+    listener.start()
+    atexit.register(listener.stop)
+    return handler
@@ -2,10 +2,22 @@
 
 import threading
 
+from werkzeug.serving import make_server
+
 from flaskapp import app
+from logsetup import parse_levels, setup_logging
+from settings import LOG_BACKUPS, LOG_LEVEL, LOG_LEVELS, LOG_MAX_BYTES, LOG_PATH
 
 # Application execution
 if __name__ == "__main__":
-    control_thread = threading.Thread(target=app.control.run)
+    # Log writes happen in a background thread, never in capture or guider threads
+    setup_logging(
+        LOG_LEVEL, parse_levels(LOG_LEVELS), LOG_PATH, LOG_MAX_BYTES, LOG_BACKUPS
+    )
+    # Bind the HTTP server first so the web interface is reachable while the
+    # camera, guider and analysis subsystems are loaded in background
+    server = make_server("0.0.0.0", 5000, app, threaded=True)
+    app.warmup()
+    control_thread = threading.Thread(target=app.control.run, name="control")
     control_thread.start()
-    app.run(host="0.0.0.0", port=5000)
+    server.serve_forever()
@@ -0,0 +1,75 @@
+"""Frame processing pipeline"""
+
+import logging
+import queue
+import threading
+
+
+class FrameStage:
+    """
+    Base class for frame processing stages
+
+    Frames produced by Control are submitted to each stage, which processes them in
+    its own background thread so the capture loop never waits for processing.
+
+    Frames are dictionaries with at least these keys:
+
+        session: Capture session identifier
+        index: Frame number inside the session
+        exposure: Requested exposure in seconds
+        started: Timestamp of the shutter opening
+        finished: Timestamp of the shutter closing
+        data: JPEG image data (None if the camera only saved a RAW file)
+    """
+
+    # Maximum number of frames waiting to be processed (0 means unbounded)
+    QUEUE_SIZE = 2
+    # Stage only processes frames with image data
+    NEEDS_DATA = True
+
+    name = "stage"
+
+    def __init__(self, logger=None):
+        self.logger = logger or logging.getLogger()
+        self.queue = queue.Queue(self.QUEUE_SIZE)
+        self.thread = None
+        self.dropped = 0
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(
+                target=self._worker, name=self.name, daemon=True
+            )
+            self.thread.start()
+
+    def submit(self, frame):
+        """Queue a frame for processing without blocking. Returns False if dropped"""
+        if self.NEEDS_DATA and frame["data"] is None:
+            return False
+        self.start()
+        try:
+            self.queue.put_nowait(frame)
+            return True
+        except queue.Full:
+            self.dropped += 1
+            self.logger.warning(
+                "%s: Dropping frame %s, processing is falling behind",
+                self.name,
+                frame["index"],
+            )
+            return False
+
+    def _worker(self):
+        while True:
+            frame = self.queue.get()
+            try:
+                self.process(frame)
+            except Exception as e:
+                self.logger.exception(
+                    "%s: Failed processing frame %s: %s", self.name, frame["index"], e
+                )
+            finally:
+                self.queue.task_done()
+
+    def process(self, frame):
+        raise NotImplementedError
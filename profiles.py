@@ -0,0 +1,83 @@
+"""Capture profiles"""
+
+import json
+import os
+import threading
+
+from settings import data_path
+
+
+class ProfileManager:
+    """
+    Named capture profiles
+
+    Each profile stores a set of camera configuration values and the sequence
+    parameters used to start capturing (the arguments of Control.capture_start).
+    """
+
+    SEQUENCE_PARMS = {
+        "exposure": float,
+        "captures": int,
+        "interval": float,
+        "dither": str,
+        "dither_n": int,
+        "dither_px": int,
+        "settle_px": int,
+        "settle_time": int,
+        "settle_timeout": int,
+        "frame_type": str,
+    }
+
+    def __init__(self, config_elems):
+        self.config_elems = config_elems
+        self.path = data_path("profiles.json")
+        self.lock = threading.Lock()
+        self.profiles = {}
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path) as fd:
+                self.profiles = json.load(fd)
+        except (OSError, ValueError):
+            self.profiles = {}
+
+    def save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as fd:
+            json.dump(self.profiles, fd, indent=2)
+        os.replace(tmp_path, self.path)
+
+    def list(self):
+        with self.lock:
+            return dict(self.profiles)
+
+    def get(self, name):
+        with self.lock:
+            try:
+                return self.profiles[name]
+            except KeyError:
+                raise KeyError("Unknown profile: %s" % name)
+
+    def store(self, name, values):
+        """Store a profile from a mapping of configuration and sequence values"""
+        if not name:
+            raise ValueError("Profile name can not be empty")
+        config = {}
+        sequence = {}
+        for key, value in values.items():
+            if key in self.config_elems:
+                config[key] = value
+            elif key in self.SEQUENCE_PARMS:
+                sequence[key] = self.SEQUENCE_PARMS[key](value)
+        profile = {"config": config, "sequence": sequence}
+        with self.lock:
+            self.profiles[name] = profile
+            self.save()
+        return profile
+
+    def delete(self, name):
+        with self.lock:
+            if self.profiles.pop(name, None) is None:
+                raise KeyError("Unknown profile: %s" % name)
+            self.save()
@@ -0,0 +1,237 @@
+"""Frame quality gate"""
+
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from imaging import decode_jpeg, luminance
+
+
+def find_stars(image, sigma=5.0, radius=4, max_stars=200):
+    """
+    Detect stars returning their count and median half flux radius (HFR) in pixels
+
+    Stars are local maxima above the background by sigma times the noise (both
+    estimated with median statistics). The HFR is measured on a square stamp
+    around the brightest max_stars peaks. Single pixel peaks (hot pixels) are
+    discarded by requiring a HFR of at least half a pixel.
+    """
+    lum = luminance(image)
+    sample = lum[::4, ::4]
+    background = np.median(sample)
+    noise = max(np.median(np.abs(sample - background)) * 1.4826, 1e-3)
+    core = lum[1:-1, 1:-1]
+    # Strict comparison on one side of each direction so plateaus keep one peak
+    peaks = (
+        (core > background + sigma * noise)
+        & (core > lum[:-2, 1:-1])
+        & (core >= lum[2:, 1:-1])
+        & (core > lum[1:-1, :-2])
+        & (core >= lum[1:-1, 2:])
+        & (core > lum[:-2, :-2])
+        & (core >= lum[2:, 2:])
+        & (core > lum[:-2, 2:])
+        & (core >= lum[2:, :-2])
+    )
+    ys, xs = np.nonzero(peaks)
+    ys += 1
+    xs += 1
+    height, width = lum.shape
+    inside = (
+        (ys >= radius) & (ys < height - radius) & (xs >= radius) & (xs < width - radius)
+    )
+    ys, xs = ys[inside], xs[inside]
+    if len(ys) > max_stars:
+        brightest = np.argsort(lum[ys, xs])[-max_stars:]
+        ys, xs = ys[brightest], xs[brightest]
+    if not len(ys):
+        return 0, None
+    offsets = np.arange(-radius, radius + 1)
+    stamps = lum[
+        ys[:, None, None] + offsets[None, :, None],
+        xs[:, None, None] + offsets[None, None, :],
+    ]
+    stamps = np.clip(stamps - background, 0, None)
+    distance = np.hypot(offsets[:, None], offsets[None, :])
+    flux = stamps.sum(axis=(1, 2))
+    hfr = (stamps * distance).sum(axis=(1, 2)) / np.maximum(flux, 1e-9)
+    hfr = hfr[hfr >= 0.5]
+    if not len(hfr):
+        return 0, None
+    return int(len(hfr)), float(np.median(hfr))
+
+
+class QualityGate:
+    """
+    Frame quality gate
+
+    Light frames are scored in a worker pool so scoring never delays the capture
+    loop: star count and median HFR are measured on the frame and guide RMS is
+    taken from the guider statistics of the exposure. Frames failing any enabled
+    threshold are flagged in the catalog and reported to on_result, which lets
+    Control queue a replacement exposure. Frames are dropped unscored when scoring
+    falls behind, so no replacement is ever decided for them.
+    """
+
+    name = "quality"
+
+    # Number of scoring threads
+    WORKERS = 2
+    # Frames waiting to be scored before new ones are dropped
+    MAX_PENDING = 4
+    # Frames are binned on decoding to bound processing time
+    BINNING = 2
+    # Maximum seconds to wait for pending scores of a session
+    WAIT_TIMEOUT = 30
+
+    # Default settings. Thresholds set to 0 are disabled
+    DEFAULTS = {
+        "enabled": False,
+        "reshoot": False,
+        "max_reshoots": 10,
+        "min_stars": 10,
+        "max_hfr": 0.0,
+        "max_guide_rms": 0.0,
+    }
+
+    def __init__(self, logger=None, catalog=None, on_result=None):
+        self.logger = logger or logging.getLogger()
+        self.catalog = catalog
+        self.on_result = on_result
+        self.settings = dict(self.DEFAULTS)
+        self.executor = ThreadPoolExecutor(self.WORKERS, thread_name_prefix=self.name)
+        self.condition = threading.Condition()
+        self.pending = {}
+        self.scored = 0
+        self.rejected = 0
+        self.dropped = 0
+        self.late = 0
+        self.last_result = None
+
+    @property
+    def enabled(self):
+        return self.settings["enabled"]
+
+    def configure(self, **settings):
+        """Update settings converting values to the type of their defaults"""
+        for name, value in settings.items():
+            if name not in self.DEFAULTS:
+                raise ValueError("Unknown quality setting: %s" % name)
+            kind = type(self.DEFAULTS[name])
+            if kind is bool and isinstance(value, str):
+                value = value == "true"
+            self.settings[name] = kind(value)
+
+    def get_status(self):
+        with self.condition:
+            return {
+                "settings": dict(self.settings),
+                "scored": self.scored,
+                "rejected": self.rejected,
+                "dropped": self.dropped,
+                "late": self.late,
+                "pending": sum(self.pending.values()),
+                "last_result": self.last_result,
+            }
+
+    def submit(self, frame):
+        """Queue a light frame for scoring. Returns False if it is not scored"""
+        if (
+            not self.enabled
+            or frame["data"] is None
+            or frame.get("frame_type", "light") != "light"
+        ):
+            return False
+        with self.condition:
+            if sum(self.pending.values()) >= self.MAX_PENDING:
+                self.dropped += 1
+                self.logger.warning(
+                    "%s: Dropping frame %s unscored%s, scoring is falling behind",
+                    self.name,
+                    frame["index"],
+                    " without replacement" if self.settings["reshoot"] else "",
+                )
+                if self.catalog is not None:
+                    # Flagged by the workers, without keeping the image data
+                    self.executor.submit(
+                        self.catalog.update_metrics,
+                        frame["session"],
+                        frame["index"],
+                        {"unscored": True},
+                    )
+                return False
+            session = frame["session"]
+            self.pending[session] = self.pending.get(session, 0) + 1
+        self.executor.submit(self._score, frame, time.monotonic())
+        return True
+
+    def wait(self, sessions, timeout=None):
+        """Wait until all frames of the given sessions are scored"""
+        timeout = self.WAIT_TIMEOUT if timeout is None else timeout
+        with self.condition:
+            return self.condition.wait_for(
+                lambda: not any(self.pending.get(session) for session in sessions),
+                timeout,
+            )
+
+    def _score(self, frame, submitted):
+        try:
+            result = self.score(frame)
+            elapsed = time.monotonic() - submitted
+            result["elapsed"] = elapsed
+            with self.condition:
+                self.scored += 1
+                if not result["accepted"]:
+                    self.rejected += 1
+                # Scores must be ready before the next frame finishes
+                if elapsed > frame["exposure"]:
+                    self.late += 1
+                self.last_result = dict(
+                    result, session=frame["session"], index=frame["index"]
+                )
+            if self.catalog is not None:
+                self.catalog.update_metrics(frame["session"], frame["index"], result)
+            if self.on_result is not None:
+                self.on_result(frame, result)
+        except Exception as e:
+            self.logger.exception(
+                "%s: Failed scoring frame %s: %s", self.name, frame["index"], e
+            )
+        finally:
+            with self.condition:
+                self.pending[frame["session"]] -= 1
+                if not self.pending[frame["session"]]:
+                    del self.pending[frame["session"]]
+                self.condition.notify_all()
+
+    def score(self, frame):
+        """Measure a frame returning its metrics and the failed thresholds"""
+        image = decode_jpeg(frame["data"], self.BINNING)
+        stars, hfr = find_stars(image)
+        if hfr is not None:
+            hfr *= self.BINNING
+        guide_rms = None
+        if frame.get("guide_stats"):
+            guide_rms = frame["guide_stats"]["rms_tot"]
+        settings = self.settings
+        reasons = []
+        if settings["min_stars"] and stars < settings["min_stars"]:
+            reasons.append("stars")
+        if settings["max_hfr"] and (hfr is None or hfr > settings["max_hfr"]):
+            reasons.append("hfr")
+        if (
+            settings["max_guide_rms"]
+            and guide_rms is not None
+            and guide_rms > settings["max_guide_rms"]
+        ):
+            reasons.append("guide_rms")
+        return {
+            "stars": stars,
+            "hfr": hfr,
+            "guide_rms": guide_rms,
+            "accepted": not reasons,
+            "reasons": reasons,
+        }
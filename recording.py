@@ -0,0 +1,348 @@
+"""Session recording and replay"""
+
+import json
+import logging
+import mmap
+import threading
+import time
+
+from guiding import SeriesGuider
+from thirdparty.phd2guider import _Conn
+
+# Recording file format version
+FORMAT_VERSION = 3
+
+# Binary call results (image data) are stored as raw payloads after the record
+BINARY_TYPES = (bytes, bytearray, memoryview)
+
+# Thread name prefixes of web requests: unnamed request handler threads and the
+# replay thread issuing the recorded requests
+WEB_THREADS = ("Thread-", "replay")
+
+
+def caller_name():
+    """Return the caller of camera calls in the current thread"""
+    name = threading.current_thread().name
+    return "web" if name.startswith(WEB_THREADS) else name
+
+
+class Recorder:
+    """
+    Session recorder
+
+    Records are written to a single file as JSON lines. Records with binary data
+    declare its size and are followed by the raw bytes, so image data is stored
+    as is, without any encoding. Every record has the seconds elapsed since the
+    recording started in "t" and its source in "src":
+
+        header: Format version and camera configuration elements
+        dslr: DSLRManager call with its caller, arguments, result, duration and
+            state
+        phd2: Line read from the PHD2 connection
+        phd2_out: Line written to the PHD2 connection
+        control: Capture command received by Control
+    """
+
+    def __init__(self, path, **header):
+        self.path = path
+        self.lock = threading.Lock()
+        self.fd = open(path, "wb")
+        self.started = time.monotonic()
+        self.record("header", version=FORMAT_VERSION, created=time.time(), **header)
+
+    def now(self):
+        return time.monotonic() - self.started
+
+    def record(self, src, payload=None, t=None, **fields):
+        fields["src"] = src
+        fields["t"] = self.now() if t is None else t
+        if payload is not None:
+            payload = memoryview(payload).cast("B")
+            fields["size"] = len(payload)
+        line = json.dumps(fields, separators=(",", ":")).encode() + b"\n"
+        with self.lock:
+            self.fd.write(line)
+            if payload is not None:
+                self.fd.write(payload)
+            self.fd.flush()
+
+    def close(self):
+        with self.lock:
+            self.fd.close()
+
+
+class RecordingDSLR:
+    """DSLRManager proxy recording calls, results and timings"""
+
+    RECORDED_CALLS = [
+        "get_camera_list",
+        "connect_camera",
+        "disconnect_camera",
+        "get_summary",
+        "get_config",
+        "set_config",
+        "apply_config",
+        "capture_image_bulb",
+        "download_file",
+    ]
+
+    def __init__(self, manager, recorder):
+        self.manager = manager
+        self.recorder = recorder
+
+    def __getattr__(self, name):
+        attr = getattr(self.manager, name)
+        if name in self.RECORDED_CALLS:
+
+            def call(*args):
+                return self._call(name, attr, args)
+
+            return call
+        return attr
+
+    def _call(self, name, method, args):
+        started = self.recorder.now()
+        callback_at = []
+        call_args = []
+        for index, arg in enumerate(args):
+            # Callbacks (after_release) are recorded as the time they were called
+            if callable(arg):
+
+                def callback(arg=arg, index=index):
+                    callback_at.append((index, self.recorder.now() - started))
+                    arg()
+
+                call_args.append(callback)
+            else:
+                call_args.append(arg)
+        result = error = None
+        try:
+            result = method(*call_args)
+            return result
+        except Exception as e:
+            error = str(e)
+            raise
+        finally:
+            payload = None
+            if isinstance(result, BINARY_TYPES):
+                payload, result = result, None
+            self.recorder.record(
+                "dslr",
+                payload,
+                t=started,
+                call=name,
+                caller=caller_name(),
+                args=[None if callable(arg) else arg for arg in args],
+                result=result,
+                error=error,
+                duration=self.recorder.now() - started,
+                callbacks=callback_at,
+                state={
+                    "connected": self.manager.camera is not None,
+                    "last_file": self.manager.last_file,
+                },
+            )
+
+
+class RecordingConn(_Conn):
+    """PHD2 connection recording every line read and written"""
+
+    def __init__(self, recorder):
+        super().__init__()
+        self.recorder = recorder
+
+    def ReadLine(self):
+        line = super().ReadLine()
+        if line:
+            self.recorder.record("phd2", line=line.decode(errors="replace"))
+        return line
+
+    def WriteLine(self, s):
+        self.recorder.record("phd2_out", line=s.strip())
+        super().WriteLine(s)
+
+
+class RecordingGuider(SeriesGuider):
+    def __init__(self, hostname="localhost", recorder=None):
+        super().__init__(hostname)
+        self.recorder = recorder
+
+    def make_conn(self):
+        return RecordingConn(self.recorder)
+
+
+class Player:
+    """
+    Session player
+
+    Loads a recording (image payloads are memory mapped, not read) and replays
+    it at the given speed: recorded delays and call durations are divided by it.
+    """
+
+    def __init__(self, path, speed=1.0, logger=None):
+        self.path = path
+        self.speed = speed
+        self.logger = logger or logging.getLogger()
+        self.header = None
+        self.records = {"dslr": [], "phd2": [], "phd2_out": [], "control": []}
+        self.lock = threading.Lock()
+        self.load()
+        self.started = time.monotonic()
+        self.finished = threading.Event()
+
+    def load(self):
+        with open(self.path, "rb") as fd:
+            self.mmap = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self.mmap)
+        offset = 0
+        while offset < len(self.mmap):
+            end = self.mmap.find(b"\n", offset)
+            record = json.loads(bytes(view[offset:end]))
+            offset = end + 1
+            if "size" in record:
+                record["payload"] = view[offset : offset + record["size"]]
+                offset += record["size"]
+            if record["src"] == "header":
+                if record["version"] != FORMAT_VERSION:
+                    raise ValueError(
+                        "Unsupported recording format version %s" % record["version"]
+                    )
+                self.header = record
+            else:
+                self.records.setdefault(record["src"], []).append(record)
+
+    def elapsed(self):
+        """Return the recording time corresponding to now"""
+        return (time.monotonic() - self.started) * self.speed
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            time.sleep(seconds / self.speed)
+
+    def wait_until(self, t, stop=None):
+        """Wait until recording time t. Returns False if stop became true"""
+        while True:
+            remaining = (t - self.elapsed()) / self.speed
+            if remaining <= 0:
+                return True
+            if stop is not None and stop():
+                return False
+            time.sleep(min(remaining, 0.5))
+
+    def next_call(self, name, caller):
+        """Return the next recorded call of a DSLRManager method by caller"""
+        with self.lock:
+            for n, record in enumerate(self.records["dslr"]):
+                if record["call"] == name and record["caller"] == caller:
+                    return self.records["dslr"].pop(n)
+        raise Exception("Replay has no more %s calls from %s" % (name, caller))
+
+    def dslr(self):
+        return ReplayDSLR(self)
+
+    def guider(self, hostname="localhost"):
+        return ReplayGuider(self, hostname)
+
+    def drive(self, control):
+        """Issue the recorded capture commands to Control at their times"""
+
+        def run():
+            for record in self.records["control"]:
+                self.wait_until(record["t"])
+                self.logger.info("Replay: %s", record["call"])
+                try:
+                    getattr(control, record["call"])(*record["args"])
+                except Exception as e:
+                    self.logger.error("Replay: %s failed: %s", record["call"], e)
+            self.finished.set()
+
+        thread = threading.Thread(target=run, name="replay", daemon=True)
+        thread.start()
+        return thread
+
+
+class ReplayDSLR:
+    """DSLRManager replaying recorded calls with their results and durations"""
+
+    locked = False
+
+    def __init__(self, player):
+        self.player = player
+        self.CONFIG_ELEMS = player.header["config_elems"]
+        self.camera = None
+        self.last_file = None
+
+    def __getattr__(self, name):
+        if name not in RecordingDSLR.RECORDED_CALLS:
+            raise AttributeError(name)
+
+        def call(*args):
+            return self._call(name, args)
+
+        return call
+
+    def _call(self, name, args):
+        record = self.player.next_call(name, caller_name())
+        elapsed = 0
+        for index, at in record["callbacks"]:
+            self.player.sleep(at - elapsed)
+            elapsed = at
+            args[index]()
+        self.player.sleep(record["duration"] - elapsed)
+        state = record["state"]
+        self.camera = True if state["connected"] else None
+        self.last_file = state["last_file"]
+        if record["error"] is not None:
+            raise Exception(record["error"])
+        if "payload" in record:
+            return record["payload"]
+        return record["result"]
+
+
+class ReplayConn:
+    """PHD2 connection returning recorded lines at their recording times"""
+
+    def __init__(self, player):
+        self.player = player
+        self.lines = list(player.records["phd2"])
+        self.terminate = False
+        self.connected = False
+
+    def Connect(self, hostname, port):
+        self.connected = True
+        # Lines recorded before connecting again are not replayed
+        elapsed = self.player.elapsed()
+        while self.lines and self.lines[0]["t"] < elapsed:
+            self.lines.pop(0)
+
+    def Disconnect(self):
+        self.connected = False
+
+    def IsConnected(self):
+        return self.connected
+
+    def ReadLine(self):
+        while self.lines:
+            record = self.lines.pop(0)
+            if not self.player.wait_until(record["t"], lambda: self.terminate):
+                return ""
+            return record["line"].encode()
+        # End of the recording, wait until disconnected
+        while not self.terminate:
+            time.sleep(0.5)
+        return ""
+
+    def WriteLine(self, s):
+        pass
+
+    def Terminate(self):
+        self.terminate = True
+
+
+class ReplayGuider(SeriesGuider):
+    def __init__(self, player, hostname="localhost"):
+        super().__init__(hostname)
+        self.player = player
+
+    def make_conn(self):
+        return ReplayConn(self.player)
@@ -0,0 +1,823 @@
+"""
+Multi-rig agent and controller
+
+Every rig runs its own instance as an agent, serving its capture state on a TCP
+port. A controller instance keeps one connection to each agent and aggregates
+their status and frames in a single web interface, starting and stopping
+sequences on several rigs at once.
+
+Messages are JSON objects, one per line. A message with a "size" field is
+followed by that many bytes of payload, so frame thumbnails are sent as JPEG
+data instead of base64 encoded in the JSON. Agents send:
+
+    {"type": "hello", "name": "rig1", "version": 1}
+    {"type": "status", "seq": 1234, "sections": {"capture": {...}}}
+    {"type": "frame", "session": "...", "index": 3, ..., "size": 20480}
+    {"type": "reply", "id": 7, "status": true}
+
+Status messages only have the sections changed since the previous one sent to
+the same controller. Controllers send commands:
+
+    {"type": "command", "id": 7, "command": "capture_sequence", "blocks": [...]}
+    {"type": "command", "id": 8, "command": "capture_stop"}
+"""
+
+import copy
+import io
+import json
+import os
+import queue
+import selectors
+import socket
+import threading
+import time
+from collections import deque
+
+from PIL import Image
+
+from imaging import BufferReader
+from pipeline import FrameStage
+from statetrack import StateTracker
+
+PROTOCOL_VERSION = 1
+
+# Agent port used when rig addresses do not give one
+DEFAULT_PORT = 5001
+
+
+def parse_address(address):
+    """Return the (host, port) of a rig address given as host or host:port"""
+    host, _, port = address.strip().rpartition(":")
+    if not host:
+        host, port = port, DEFAULT_PORT
+    if not host or not str(port).isdigit():
+        raise ValueError("Invalid rig address: %s" % address)
+    return host, int(port)
+
+
+class Connection:
+    """
+    Non-blocking socket exchanging protocol messages
+
+    Outgoing messages are queued and sent as the socket accepts them, so a slow
+    peer never blocks the thread serving the others.
+    """
+
+    READ_SIZE = 65536
+    # Longest message line and payload accepted
+    MAX_LINE = 1 << 20
+    MAX_PAYLOAD = 1 << 24
+
+    def __init__(self, sock, address):
+        self.sock = sock
+        self.address = address
+        self.received = bytearray()
+        self.outgoing = deque()
+        # Bytes queued and not sent yet
+        self.backlog = 0
+        # Message waiting for its payload
+        self.message = None
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.events = 0
+
+    def send(self, message, payload=None):
+        if payload is not None:
+            message = dict(message, size=len(payload))
+        line = json.dumps(message, separators=(",", ":"), default=str).encode()
+        self.outgoing.append(memoryview(line + b"\n"))
+        self.backlog += len(line) + 1
+        if payload:
+            self.outgoing.append(memoryview(payload))
+            self.backlog += len(payload)
+
+    def flush(self):
+        """Send queued data without blocking, returning whether some is left"""
+        while self.outgoing:
+            data = self.outgoing[0]
+            try:
+                sent = self.sock.send(data)
+            except (BlockingIOError, InterruptedError):
+                return True
+            self.backlog -= sent
+            self.bytes_out += sent
+            if sent < len(data):
+                self.outgoing[0] = data[sent:]
+                return True
+            self.outgoing.popleft()
+        return False
+
+    def receive(self):
+        """Read the available data returning the complete (message, payload)s"""
+        try:
+            data = self.sock.recv(self.READ_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return []
+        if not data:
+            raise ConnectionError("Connection closed")
+        self.bytes_in += len(data)
+        self.received += data
+        messages = []
+        pos = 0
+        while True:
+            if self.message is None:
+                end = self.received.find(b"\n", pos)
+                if end < 0:
+                    if len(self.received) - pos > self.MAX_LINE:
+                        raise ValueError("Message too long")
+                    break
+                message = json.loads(self.received[pos:end].decode())
+                pos = end + 1
+                if not isinstance(message, dict):
+                    raise ValueError("Invalid message: %r" % message)
+                size = message.get("size")
+                if size is not None and (
+                    type(size) is not int or not 0 <= size <= self.MAX_PAYLOAD
+                ):
+                    raise ValueError("Invalid payload size: %r" % size)
+                self.message = message
+            size = self.message.get("size")
+            if size is None:
+                messages.append((self.message, None))
+            elif len(self.received) - pos >= size:
+                messages.append((self.message, bytes(self.received[pos : pos + size])))
+                pos += size
+            else:
+                break
+            self.message = None
+        del self.received[:pos]
+        return messages
+
+    def close(self):
+        self.sock.close()
+
+
+class ControllerConnection(Connection):
+    """Agent side connection of a controller"""
+
+    def __init__(self, sock, address):
+        super().__init__(sock, address)
+        # Status sequence and monotonic time of the last status sent
+        self.seq = None
+        self.sent = 0
+
+
+class AgentConnection(Connection):
+    """Controller side connection to an agent"""
+
+    def __init__(self, sock, address, now):
+        super().__init__(sock, address)
+        self.connecting = True
+        self.last_seen = now
+        # Ids of the commands sent waiting for their replies
+        self.commands = set()
+
+
+class SelectorThread:
+    """
+    Thread serving non-blocking connections with a selector
+
+    Other threads hand work to it with post, which wakes it up.
+    """
+
+    # Longest seconds between loop iterations
+    LOOP_INTERVAL = 0.5
+
+    def __init__(self, logger):
+        self.logger = logger
+        self.selector = selectors.DefaultSelector()
+        self.wakeup, self.waker = socket.socketpair()
+        self.wakeup.setblocking(False)
+        self.waker.setblocking(False)
+        self.selector.register(self.wakeup, selectors.EVENT_READ)
+        self.posted = deque()
+        self.connections = set()
+        self.thread = None
+
+    def start(self, name):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name=name, daemon=True)
+            self.thread.start()
+
+    def post(self, *item):
+        """Queue an item for the loop thread (see handle_posted)"""
+        self.posted.append(item)
+        try:
+            self.waker.send(b"\0")
+        except (BlockingIOError, InterruptedError):
+            # Already woken up
+            pass
+
+    def register(self, connection, events=selectors.EVENT_READ):
+        self.connections.add(connection)
+        connection.events = events
+        self.selector.register(connection.sock, events, connection)
+
+    def drop(self, connection, error):
+        if connection not in self.connections:
+            return
+        self.connections.discard(connection)
+        self.selector.unregister(connection.sock)
+        connection.close()
+        self.closed(connection, error)
+
+    def _run(self):
+        while True:
+            try:
+                events = self.selector.select(self.timeout())
+            except InterruptedError:
+                continue
+            for key, mask in events:
+                if key.fileobj is self.wakeup:
+                    try:
+                        self.wakeup.recv(4096)
+                    except (BlockingIOError, InterruptedError):
+                        pass
+                elif key.data is None:
+                    self.ready(key.fileobj)
+                elif key.data in self.connections:
+                    try:
+                        self.event(key.data, mask)
+                    except (OSError, ValueError) as e:
+                        self.drop(key.data, e)
+                    except Exception as e:
+                        self.logger.exception("Failed handling messages: %s", e)
+                        self.drop(key.data, e)
+            while self.posted:
+                item = self.posted.popleft()
+                try:
+                    self.handle_posted(*item)
+                except Exception as e:
+                    self.logger.exception("Failed handling %s: %s", item[0], e)
+            try:
+                self.tick()
+            except Exception as e:
+                self.logger.exception("Loop iteration failed: %s", e)
+            for connection in list(self.connections):
+                try:
+                    self._flush(connection)
+                except OSError as e:
+                    self.drop(connection, e)
+
+    def _flush(self, connection):
+        events = selectors.EVENT_READ
+        if connection.outgoing and connection.flush():
+            events |= selectors.EVENT_WRITE
+        if events != connection.events and not getattr(connection, "connecting", False):
+            connection.events = events
+            self.selector.modify(connection.sock, events, connection)
+
+    def timeout(self):
+        return self.LOOP_INTERVAL
+
+    def event(self, connection, mask):
+        if mask & selectors.EVENT_READ:
+            for message, payload in connection.receive():
+                self.handle(connection, message, payload)
+
+    def ready(self, sock):
+        """Handle a ready socket registered without a connection"""
+
+    def handle(self, connection, message, payload):
+        """Handle a message received"""
+
+    def handle_posted(self, *item):
+        """Handle an item posted by another thread"""
+
+    def tick(self):
+        """Run after every loop iteration"""
+
+    def closed(self, connection, error):
+        """Handle a dropped connection"""
+
+
+class RigAgent(FrameStage):
+    """
+    Serves the capture state of this instance to multi-rig controllers
+
+    Controllers connecting to the agent port get a hello message, then every
+    STATUS_INTERVAL seconds the status sections changed since the last ones sent
+    to them (see statetrack.StateTracker), at least every HEARTBEAT seconds, and
+    a thumbnail of every captured frame. Thumbnails are skipped for controllers
+    more than MAX_BACKLOG bytes behind, status messages never. Commands run one
+    at a time in the order received in a thread of their own, so a stop sent
+    while a sequence is starting runs after it, and are answered with a reply of
+    the same id.
+    """
+
+    name = "agent"
+
+    QUEUE_SIZE = 1
+    NEEDS_DATA = False
+
+    STATUS_INTERVAL = 1.0
+    HEARTBEAT = 5.0
+    THUMBNAIL_SIZE = 480
+    THUMBNAIL_QUALITY = 70
+    MAX_BACKLOG = 1 << 20
+
+    # Frame fields sent with thumbnails
+    FIELDS = ["session", "index", "captures", "frame_type", "exposure", "started"]
+
+    def __init__(self, webapp, port, rig_name, logger=None):
+        super().__init__(logger)
+        self.webapp = webapp
+        self.port = port
+        self.rig_name = rig_name
+        self.state = StateTracker()
+        self.loop = AgentLoop(self, self.logger)
+        # (connection, message) of the commands to run
+        self.pending = queue.Queue()
+        # Addresses of the controllers connected
+        self.controllers = []
+        self.frames_sent = 0
+        self.frames_skipped = 0
+        self.commands = 0
+
+    def serve(self):
+        """Listen for controllers in a background thread"""
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind(("", self.port))
+        server.listen()
+        server.setblocking(False)
+        self.port = server.getsockname()[1]
+        self.loop.selector.register(server, selectors.EVENT_READ)
+        self.loop.start("agent-server")
+        threading.Thread(
+            target=self._run_commands, name="agent-command", daemon=True
+        ).start()
+        self.logger.info("agent: Serving rig %s on port %d", self.rig_name, self.port)
+
+    def get_status(self):
+        return {
+            "name": self.rig_name,
+            "port": self.port,
+            "controllers": self.controllers,
+            "frames_sent": self.frames_sent,
+            "frames_skipped": self.frames_skipped,
+            "commands": self.commands,
+        }
+
+    def collect_status(self):
+        """Return the status sections sent to controllers"""
+        webapp = self.webapp
+        metrics = {}
+        if webapp.is_loaded("quality"):
+            quality = webapp.quality.get_status()
+            metrics["quality"] = {
+                "enabled": webapp.quality.enabled,
+                "scored": quality["scored"],
+                "rejected": quality["rejected"],
+            }
+        if webapp.is_loaded("stacker"):
+            metrics["stack_frames"] = webapp.stacker.get_status()["frames"]
+        return {
+            "rig": {
+                "camera_connected": webapp.dslr.camera is not None,
+                "guider_connected": webapp.guider.guider is not None,
+            },
+            "capture": webapp.control.get_capture_status(),
+            "metrics": metrics,
+        }
+
+    def run_command(self, message):
+        """Run a controller command returning the fields added to its reply"""
+        command = message.get("command")
+        control = self.webapp.control
+        if command == "capture_sequence":
+            from sequence import build_block
+
+            if not message.get("blocks"):
+                raise ValueError("Sequence has no blocks")
+            blocks = [
+                build_block(block, self.webapp.profiles) for block in message["blocks"]
+            ]
+            control.capture_sequence(blocks)
+            return {"blocks": len(blocks)}
+        if command == "capture_stop":
+            control.capture_stop()
+            return {}
+        raise ValueError("Unknown command: %s" % command)
+
+    def process(self, frame):
+        """Make the frame thumbnail and queue it for all controllers"""
+        message = {"type": "frame"}
+        message.update((field, frame.get(field)) for field in self.FIELDS)
+        thumbnail = None
+        if frame["data"] is not None:
+            image = Image.open(BufferReader(frame["data"]))
+            size = (self.THUMBNAIL_SIZE, self.THUMBNAIL_SIZE)
+            # Decode at a reduced scale, see imaging.decode_jpeg
+            image.draft("RGB", size)
+            image.thumbnail(size, Image.BOX)
+            buf = io.BytesIO()
+            image.convert("RGB").save(buf, "JPEG", quality=self.THUMBNAIL_QUALITY)
+            thumbnail = buf.getvalue()
+        self.loop.post("frame", message, thumbnail)
+
+    def _run_commands(self):
+        while True:
+            self._command(*self.pending.get())
+
+    def _command(self, connection, message):
+        reply = {"type": "reply", "id": message.get("id"), "status": True}
+        try:
+            reply.update(self.run_command(message))
+        except Exception as e:
+            self.logger.error("agent: Command %s failed: %s", message.get("command"), e)
+            reply.update(status=False, error="Failed running command: %s" % e)
+        self.loop.post("reply", connection, reply)
+
+
+class AgentLoop(SelectorThread):
+    """Selector thread of a RigAgent"""
+
+    def __init__(self, agent, logger):
+        super().__init__(logger)
+        self.agent = agent
+        self.next_status = 0
+
+    def timeout(self):
+        return max(0, min(self.LOOP_INTERVAL, self.next_status - time.monotonic()))
+
+    def ready(self, server):
+        try:
+            sock, address = server.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        sock.setblocking(False)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        connection = ControllerConnection(sock, address)
+        self.register(connection)
+        self._update_controllers()
+        connection.send(
+            {"type": "hello", "name": self.agent.rig_name, "version": PROTOCOL_VERSION}
+        )
+        self.agent.logger.info("agent: Controller %s:%d connected", *address[:2])
+        # New controllers get the whole status at once
+        self.next_status = 0
+
+    def _update_controllers(self):
+        self.agent.controllers = sorted(
+            "%s:%d" % connection.address[:2] for connection in self.connections
+        )
+
+    def closed(self, connection, error):
+        self._update_controllers()
+        self.agent.logger.info(
+            "agent: Controller %s:%d disconnected: %s", *connection.address[:2], error
+        )
+
+    def handle(self, connection, message, payload):
+        if message.get("type") != "command":
+            return
+        self.agent.commands += 1
+        self.agent.pending.put((connection, message))
+
+    def handle_posted(self, kind, *args):
+        if kind == "reply":
+            connection, reply = args
+            if connection in self.connections:
+                connection.send(reply)
+            # Controllers see the effect of their commands right away
+            self.next_status = 0
+        elif kind == "frame":
+            message, thumbnail = args
+            for connection in self.connections:
+                if (
+                    thumbnail is not None
+                    and connection.backlog > self.agent.MAX_BACKLOG
+                ):
+                    self.agent.frames_skipped += 1
+                    connection.send(message)
+                else:
+                    self.agent.frames_sent += 1
+                    connection.send(message, thumbnail)
+
+    def tick(self):
+        now = time.monotonic()
+        if now < self.next_status:
+            return
+        self.next_status = now + self.agent.STATUS_INTERVAL
+        state = self.agent.state
+        try:
+            for name, value in self.agent.collect_status().items():
+                state.update(name, value)
+        except Exception as e:
+            self.agent.logger.error("agent: Failed collecting status: %s", e)
+        for connection in self.connections:
+            seq, sections = state.changes(connection.seq)
+            if sections or now - connection.sent >= self.agent.HEARTBEAT:
+                connection.send({"type": "status", "seq": seq, "sections": sections})
+                connection.seq = seq
+                connection.sent = now
+
+
+class RigController(SelectorThread):
+    """
+    Aggregates the status and frames of many rig agents
+
+    Every agent gets one connection, all of them served by a single selector
+    thread reconnecting RECONNECT_DELAY seconds after failures and dropping
+    connections silent for more than STALE_TIMEOUT seconds. Each rig is a
+    StateTracker section, so web clients only fetch the rigs changed since their
+    last request. Rig addresses are stored in path.
+    """
+
+    RECONNECT_DELAY = 5
+    CONNECT_TIMEOUT = 5
+    STALE_TIMEOUT = 15
+    COMMAND_TIMEOUT = 10
+
+    def __init__(self, logger, path=None):
+        super().__init__(logger)
+        self.path = path
+        self.condition = threading.Condition()
+        self.state = StateTracker()
+        # Rig state by address, as returned to web clients
+        self.rigs = {}
+        self.thumbnails = {}
+        # Connection and next connection attempt time by address
+        self.links = {}
+        self.retry = {}
+        # Replies by address of the commands waiting for them, by command id
+        self.replies = {}
+        self.next_id = 1
+        self.messages = 0
+        self.frames = 0
+        self.bytes_in = 0
+        for address in self.load():
+            self.add_rig(address, save=False)
+
+    def load(self):
+        try:
+            with open(self.path) as fd:
+                return json.load(fd)
+        except (OSError, TypeError, ValueError):
+            return []
+
+    def save(self):
+        if self.path is None:
+            return
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as fd:
+            json.dump(sorted(self.rigs), fd, indent=2)
+        os.replace(tmp_path, self.path)
+
+    def add_rig(self, address, save=True):
+        """Add the agent at host:port, returning its normalized address"""
+        address = "%s:%d" % parse_address(address)
+        with self.condition:
+            if address in self.rigs:
+                return address
+            self.rigs[address] = {
+                "address": address,
+                "name": address,
+                "state": "connecting",
+                "error": None,
+                "since": time.time(),
+                "status": {},
+                "frame": None,
+            }
+            self._changed(address)
+            if save:
+                self.save()
+        self.post("add", address)
+        self.start("rig-controller")
+        return address
+
+    def remove_rig(self, address):
+        with self.condition:
+            if self.rigs.pop(address, None) is None:
+                raise KeyError("Unknown rig: %s" % address)
+            self.thumbnails.pop(address, None)
+            self.state.update(address, None)
+            self.save()
+        self.post("remove", address)
+
+    def get_status(self, since=None):
+        """Return the rigs changed after since, removed ones as None"""
+        with self.condition:
+            seq, rigs = self.state.changes(since)
+            states = [rig["state"] for rig in self.rigs.values()]
+            return {
+                "seq": seq,
+                "rigs": rigs,
+                "count": len(states),
+                "connected": states.count("connected"),
+                "messages": self.messages,
+                "frames": self.frames,
+                "bytes_in": self.bytes_in,
+            }
+
+    def get_thumbnail(self, address):
+        with self.condition:
+            return self.thumbnails.get(address)
+
+    def command(self, command, addresses=None, timeout=None, **args):
+        """
+        Send a command to rigs, all connected ones by default
+
+        Returns the replies by address. Rigs not connected, disconnecting or not
+        replying in time get failed replies, with timeout set for the latter.
+        """
+        with self.condition:
+            connected = [
+                address
+                for address, rig in self.rigs.items()
+                if rig["state"] == "connected"
+            ]
+            if addresses is None:
+                addresses = connected
+            command_id = self.next_id
+            self.next_id += 1
+            sent = [address for address in addresses if address in connected]
+            self.replies[command_id] = {}
+        message = dict(args, type="command", id=command_id, command=command)
+        self.post("command", sent, message)
+        with self.condition:
+            self.condition.wait_for(
+                lambda: len(self.replies[command_id]) >= len(sent),
+                timeout or self.COMMAND_TIMEOUT,
+            )
+            replies = self.replies.pop(command_id)
+        for address in addresses:
+            if address in sent and address not in replies:
+                replies[address] = {
+                    "status": False,
+                    "error": "No reply",
+                    "timeout": True,
+                }
+            elif address not in replies:
+                replies[address] = {"status": False, "error": "Rig not connected"}
+        return replies
+
+    def start_sequence(self, blocks, addresses=None):
+        """
+        Start a capture sequence on several rigs at once
+
+        Commands are sent to all the rigs in the same loop iteration. If any of
+        them fails to start, the others are stopped so rigs never run out of step,
+        including those not replying in time which may still be starting.
+        """
+        replies = self.command("capture_sequence", addresses, blocks=blocks)
+        if not replies:
+            raise ValueError("No rigs connected")
+        failed = dict(
+            (self.rigs.get(address, {}).get("name", address), reply["error"])
+            for address, reply in replies.items()
+            if not reply["status"]
+        )
+        if failed:
+            started = [
+                address
+                for address, reply in replies.items()
+                if reply["status"] or reply.get("timeout")
+            ]
+            if started:
+                self.command("capture_stop", started)
+            raise RuntimeError(
+                "; ".join("%s: %s" % item for item in sorted(failed.items()))
+            )
+        return replies
+
+    def stop_sequence(self, addresses=None):
+        return self.command("capture_stop", addresses)
+
+    def _changed(self, address):
+        # The state keeps a snapshot, as the rig is updated while status
+        # requests serialize it outside of the lock
+        self.state.update(address, copy.deepcopy(self.rigs[address]))
+
+    def _set_state(self, address, state, error=None):
+        """Update the connection state of a rig returning whether it changed"""
+        with self.condition:
+            rig = self.rigs.get(address)
+            if rig is None or (rig["state"], rig["error"]) == (state, error):
+                return False
+            rig.update(state=state, error=error, since=time.time())
+            self._changed(address)
+            return True
+
+    def handle_posted(self, kind, *args):
+        if kind == "add":
+            self.retry.setdefault(args[0], 0)
+        elif kind == "remove":
+            self.retry.pop(args[0], None)
+            link = self.links.get(args[0])
+            if link is not None:
+                self.drop(link, "Removed")
+        elif kind == "command":
+            addresses, message = args
+            for address in addresses:
+                link = self.links.get(address)
+                if link is None or link.connecting:
+                    self._reply(address, message["id"], "Rig not connected")
+                else:
+                    link.commands.add(message["id"])
+                    link.send(message)
+
+    def _reply(self, address, command_id, error=None, reply=None):
+        with self.condition:
+            if command_id in self.replies:
+                if reply is None:
+                    reply = {"status": False, "error": error}
+                self.replies[command_id][address] = dict(
+                    (name, value)
+                    for name, value in reply.items()
+                    if name not in ("type", "id")
+                )
+                self.condition.notify_all()
+
+    def tick(self):
+        now = time.monotonic()
+        for address, retry in list(self.retry.items()):
+            if address not in self.links and now >= retry:
+                self._connect(address, now)
+        for link in list(self.links.values()):
+            if link.connecting and now - link.last_seen > self.CONNECT_TIMEOUT:
+                self.drop(link, "Connection timed out")
+            elif not link.connecting and now - link.last_seen > self.STALE_TIMEOUT:
+                self.drop(link, "No data for %ds" % self.STALE_TIMEOUT)
+
+    def _connect(self, address, now):
+        self.retry[address] = now + self.RECONNECT_DELAY
+        try:
+            # Resolving the host blocks, so addresses should be IPs or local names
+            target = socket.getaddrinfo(
+                *parse_address(address), type=socket.SOCK_STREAM
+            )
+            family, kind, proto, _, sockaddr = target[0]
+            sock = socket.socket(family, kind, proto)
+        except OSError as e:
+            self._set_state(address, "disconnected", str(e))
+            return
+        sock.setblocking(False)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        link = AgentConnection(sock, address, now)
+        sock.connect_ex(sockaddr)
+        self.links[address] = link
+        self.register(link, selectors.EVENT_WRITE)
+
+    def event(self, link, mask):
+        link.last_seen = time.monotonic()
+        if link.connecting:
+            error = link.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if error:
+                raise ConnectionError(error, os.strerror(error))
+            link.connecting = False
+            self._set_state(link.address, "connected")
+            self.logger.info("rigs: Connected to %s", link.address)
+            return
+        received = link.bytes_in
+        try:
+            super().event(link, mask)
+        finally:
+            self.bytes_in += link.bytes_in - received
+
+    def handle(self, link, message, payload):
+        address = link.address
+        kind = message.get("type")
+        with self.condition:
+            self.messages += 1
+            rig = self.rigs.get(address)
+            if rig is None:
+                return
+            if kind == "hello":
+                rig["name"] = message.get("name") or address
+            elif kind == "status":
+                rig["status"].update(message.get("sections") or {})
+            elif kind == "frame":
+                self.frames += 1
+                message.pop("type")
+                message.pop("size", None)
+                rig["frame"] = message
+                if payload:
+                    self.thumbnails[address] = payload
+                    message["thumbnail_url"] = "/rigs/frame.jpg?rig=%s&frame=%s-%s" % (
+                        address,
+                        message["session"],
+                        message["index"],
+                    )
+            elif kind == "reply":
+                link.commands.discard(message.get("id"))
+                self._reply(address, message.get("id"), reply=message)
+                return
+            else:
+                return
+            self._changed(address)
+
+    def closed(self, link, error):
+        if self.links.get(link.address) is link:
+            del self.links[link.address]
+        for command_id in link.commands:
+            self._reply(link.address, command_id, "Disconnected: %s" % error)
+        # Retries failing the same way are logged once
+        if self._set_state(link.address, "disconnected", str(error)):
+            self.logger.warning(
+                "rigs: %s %s: %s",
+                "Failed connecting to" if link.connecting else "Connection lost to",
+                link.address,
+                error,
+            )
@@ -0,0 +1,46 @@
+"""Capture sequences"""
+
+from profiles import ProfileManager
+
+# Sequence parameters used when neither the block nor its profile sets them
+BLOCK_DEFAULTS = {
+    "dither": "false",
+    "dither_n": 1,
+    "dither_px": 3,
+    "settle_px": 2,
+    "settle_time": 10,
+    "settle_timeout": 100,
+    "frame_type": "light",
+    "interval": 0,
+}
+
+
+def build_block(block, profiles=None):
+    """
+    Build a sequence block from its description
+
+    A block has the same structure as a capture profile: the sequence parameters
+    of Control.capture_start and the camera configuration values to apply before
+    it starts. Blocks may name a saved profile and override any of its values:
+
+        {"profile": "lights", "captures": 60, "config": {"iso": "800"}}
+    """
+    sequence = dict(BLOCK_DEFAULTS)
+    config = {}
+    if block.get("profile"):
+        profile = profiles.get(block["profile"])
+        sequence.update(profile["sequence"])
+        config.update(profile["config"])
+    for name, kind in ProfileManager.SEQUENCE_PARMS.items():
+        if name in block:
+            sequence[name] = kind(block[name])
+    config.update(block.get("config") or {})
+    for name in ("exposure", "captures"):
+        if name not in sequence:
+            raise ValueError("Sequence block without %s" % name)
+    if sequence["captures"] < 1:
+        raise ValueError("Sequence block without captures")
+    if sequence["interval"] and sequence["interval"] <= sequence["exposure"]:
+        raise ValueError("Sequence block interval not longer than its exposure")
+    sequence["dither"] = str(sequence["dither"]).lower() == "true"
+    return {"sequence": sequence, "config": config}
@@ -0,0 +1,55 @@
+"""Application settings"""
+
+import os
+import socket
+
+# Base directory for persistent application data (caches, frames, catalogs...)
+DATA_DIR = os.environ.get(
+    "GALAXYDSLR_DATA_DIR", os.path.join(os.path.expanduser("~"), ".galaxydslr")
+)
+
+# Export captured frames as FITS files
+FITS_EXPORT = os.environ.get("GALAXYDSLR_FITS_EXPORT", "0") == "1"
+
+# Record camera calls and PHD2 traffic of the session to this file
+RECORD_PATH = os.environ.get("GALAXYDSLR_RECORD")
+
+# Replay a recorded session instead of using the camera and PHD2
+REPLAY_PATH = os.environ.get("GALAXYDSLR_REPLAY")
+REPLAY_SPEED = float(os.environ.get("GALAXYDSLR_REPLAY_SPEED", "1"))
+
+# Use a simulated camera instead of gphoto2
+SIMULATOR = os.environ.get("GALAXYDSLR_SIMULATOR", "0") == "1"
+
+# Seconds camera list and configuration reads are shared between requests
+CAMERA_READ_MAX_AGE = float(os.environ.get("GALAXYDSLR_CAMERA_READ_MAX_AGE", "1"))
+
+# Save captured JPEG frames in the data directory
+SAVE_FRAMES = os.environ.get("GALAXYDSLR_SAVE_FRAMES", "0") == "1"
+
+# Memory and disk budgets of the captured frame history
+HISTORY_MEMORY = int(os.environ.get("GALAXYDSLR_HISTORY_MEMORY_MB", "64")) << 20
+HISTORY_DISK = int(os.environ.get("GALAXYDSLR_HISTORY_DISK_MB", "1024")) << 20
+
+# Logging level, per subsystem levels as control=DEBUG,dslr=WARNING and log file
+LOG_LEVEL = os.environ.get("GALAXYDSLR_LOG_LEVEL", "INFO").upper()
+LOG_LEVELS = os.environ.get("GALAXYDSLR_LOG_LEVELS", "")
+LOG_PATH = os.environ.get(
+    "GALAXYDSLR_LOG_FILE", os.path.join(DATA_DIR, "logs", "galaxydslr.log")
+)
+LOG_MAX_BYTES = int(os.environ.get("GALAXYDSLR_LOG_MAX_MB", "5")) << 20
+LOG_BACKUPS = 3
+
+# Serve the capture state to multi-rig controllers on this TCP port (0 disables)
+AGENT_PORT = int(os.environ.get("GALAXYDSLR_AGENT_PORT", "0"))
+# Rig name reported to controllers
+RIG_NAME = os.environ.get("GALAXYDSLR_RIG_NAME") or socket.gethostname()
+# Agents aggregated by this instance as host:port,host:port, added to those stored
+RIGS = os.environ.get("GALAXYDSLR_RIGS", "")
+
+
+def data_path(*parts):
+    """Return a path inside the data directory, creating its parent directory"""
+    path = os.path.join(DATA_DIR, *parts)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
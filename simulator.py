@@ -0,0 +1,175 @@
+"""Simulated camera"""
+
+import threading
+import time
+
+import numpy as np
+
+from imaging import encode_jpeg
+from settings import CAMERA_READ_MAX_AGE
+from singleflight import SingleFlight
+
+
+def star_field(width, height, stars=150, seed=None):
+    """Render a synthetic star field as an uint8 RGB array"""
+    rng = np.random.default_rng(seed)
+    image = rng.normal(30, 4, (height, width)).astype(np.float32)
+    ys, xs = np.mgrid[-4:5, -4:5]
+    for _ in range(stars):
+        y = rng.integers(5, height - 5)
+        x = rng.integers(5, width - 5)
+        sigma = rng.uniform(0.8, 1.6)
+        flux = rng.uniform(50, 220)
+        image[y - 4 : y + 5, x - 4 : x + 5] += flux * np.exp(
+            -(ys**2 + xs**2) / (2 * sigma**2)
+        )
+    image = np.clip(image, 0, 255).astype(np.uint8)
+    return np.repeat(image[:, :, None], 3, axis=2)
+
+
+class SimulatedDSLR:
+    """
+    DSLRManager stand-in for development and load tests
+
+    Behaves like a connected camera: every camera operation holds the simulated
+    USB bus for USB_LATENCY seconds (operations are serialized as on the real
+    bus) and bulb captures return synthetic star field JPEGs after the exposure.
+    """
+
+    CHOICES = {
+        "aperture": ["4", "5.6", "8"],
+        "iso": ["100", "200", "400", "800", "1600", "3200"],
+        "shutterspeed": ["bulb", "30", "15", "1"],
+        "drivemode": ["Single"],
+        "aeb": ["off"],
+        "whitebalance": ["Auto", "Daylight"],
+        "colorspace": ["sRGB", "AdobeRGB"],
+        "picturestyle": ["Standard", "Faithful"],
+        "imageformat": ["RAW", "Large Fine JPEG", "RAW + Large Fine JPEG"],
+        "capturetarget": ["Internal RAM", "Memory card"],
+    }
+    CONFIG_ELEMS = list(CHOICES)
+
+    # Seconds each camera operation holds the USB bus
+    USB_LATENCY = 0.05
+    # Synthetic frame size and number of different frames
+    FRAME_SIZE = (1200, 800)
+    FRAMES = 4
+    # Live view frame size
+    PREVIEW_SIZE = (600, 400)
+
+    locked = False
+
+    def __init__(self):
+        self.bus = threading.RLock()
+        self.camera = None
+        self.last_file = None
+        self.count = 0
+        self.values = {name: choices[-1] for name, choices in self.CHOICES.items()}
+        self.frames = [
+            encode_jpeg(star_field(*self.FRAME_SIZE, seed=seed))
+            for seed in range(self.FRAMES)
+        ]
+        self.previews = [
+            encode_jpeg(star_field(*self.PREVIEW_SIZE, stars=40, seed=seed))
+            for seed in range(self.FRAMES)
+        ]
+        self.preview_count = 0
+        # Operation counters, I.E. to measure camera load
+        self.operations = {}
+        self.reads = SingleFlight(CAMERA_READ_MAX_AGE)
+
+    def _operation(self, name, duration=None, blocking=True):
+        """Hold the bus for an operation, returns False if busy and not blocking"""
+        if not self.bus.acquire(blocking):
+            return False
+        try:
+            self.operations[name] = self.operations.get(name, 0) + 1
+            time.sleep(self.USB_LATENCY if duration is None else duration)
+        finally:
+            self.bus.release()
+        return True
+
+    def get_camera_list(self):
+        return self.reads.do("camera_list", self._get_camera_list)
+
+    def _get_camera_list(self):
+        self._operation("autodetect")
+        current = "usb:001,001" if self.camera else None
+        return {"choices": [["Simulated DSLR", "usb:001,001"]], "current": current}
+
+    def connect_camera(self, port):
+        self._operation("connect")
+        self.camera = port
+        self.reads.forget()
+
+    def disconnect_camera(self):
+        self.camera = None
+        self.reads.forget()
+
+    def get_summary(self):
+        self._operation("summary")
+        return "Simulated DSLR"
+
+    def get_config(self):
+        return self.reads.do("config", self._get_config)
+
+    def _get_config(self):
+        if not self.camera:
+            return None
+        self._operation("get_config")
+        return {
+            name: {"choices": list(choices), "current": self.values[name]}
+            for name, choices in self.CHOICES.items()
+        }
+
+    def set_config(self, config):
+        self._operation("set_config")
+        self.values.update(config)
+        self.reads.forget()
+
+    def apply_config(self, config):
+        if not self.camera:
+            raise Exception("Camera is not connected")
+        changes = {
+            key: value for key, value in config.items() if self.values[key] != value
+        }
+        if changes:
+            self.set_config(changes)
+        return changes
+
+    def capture_image_bulb(
+        self, seconds, after_release=None, after_press=None, download=True
+    ):
+        """Capture a bulb exposure returning the JPEG image data if available"""
+        jpeg = self.values["imageformat"] != "RAW"
+        with self.bus:
+            opened = time.monotonic()
+            if after_press is not None:
+                after_press()
+            self._operation("capture", max(0, seconds - (time.monotonic() - opened)))
+        if after_release is not None:
+            after_release()
+        self.count += 1
+        self.last_file = "/store_00010001/DCIM/100SIMUL/IMG_%04d.JPG" % self.count
+        if not jpeg or not download:
+            return None
+        return self.download_file(self.last_file)
+
+    def download_file(self, camera_path):
+        self._operation("download")
+        count = int(camera_path[-8:-4])
+        return memoryview(self.frames[count % len(self.frames)])
+
+    def try_capture_preview(self):
+        """Return a live view frame, None if the bus is busy"""
+        if not self.camera:
+            raise Exception("Camera is not connected")
+        if not self._operation("preview", blocking=False):
+            return None
+        self.preview_count += 1
+        return memoryview(self.previews[self.preview_count % len(self.previews)])
+
+    def end_preview(self):
+        if self.camera:
+            self._operation("end_preview")
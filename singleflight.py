@@ -0,0 +1,84 @@
+"""Coalescing of concurrent identical calls"""
+
+import threading
+import time
+
+
+class _Call:
+    def __init__(self, generation):
+        self.generation = generation
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Single flight call group
+
+    Concurrent calls with the same key share one execution of the function: the
+    first caller runs it and the rest wait for its result or exception. Results
+    are also reused for max_age seconds after the call finished. Results are
+    shared between callers and must not be modified.
+
+    forget() must be called after changing the state the calls read: cached
+    results are dropped and calls already in flight are neither joined by later
+    callers nor cached.
+    """
+
+    def __init__(self, max_age=0.0):
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.results = {}
+        self.generation = 0
+        # Calls executed and calls served from another call or cached result
+        self.executed = 0
+        self.shared = 0
+
+    def do(self, key, function, *args):
+        with self.lock:
+            cached = self.results.get(key)
+            if cached is not None and time.monotonic() - cached[0] <= self.max_age:
+                self.shared += 1
+                return cached[1]
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = _Call(self.generation)
+                self.executed += 1
+            else:
+                self.shared += 1
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = function(*args)
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                if self.calls.get(key) is call:
+                    del self.calls[key]
+                if call.error is None and call.generation == self.generation:
+                    self.results[key] = (time.monotonic(), call.result)
+            call.done.set()
+        return call.result
+
+    def forget(self):
+        with self.lock:
+            self.generation += 1
+            self.results = {}
+            self.calls = {}
+
+    def get_status(self):
+        with self.lock:
+            return {
+                "max_age": self.max_age,
+                "executed": self.executed,
+                "shared": self.shared,
+                "in_flight": len(self.calls),
+            }
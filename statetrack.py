@@ -0,0 +1,55 @@
+"""Application state change tracking"""
+
+import hashlib
+import json
+import threading
+import time
+
+
+class StateTracker:
+    """
+    State sequence tracker
+
+    Application state is split in named sections. Every time a section changes it
+    is stamped with a new value of a monotonically increasing sequence number, so
+    clients can ask only for the sections changed since the last sequence they saw.
+
+    The sequence starts from the current time in milliseconds, so sequence numbers
+    from a previous run of the application are always older than the current ones.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.seq = int(time.time() * 1000)
+        self.sections = {}
+
+    @staticmethod
+    def fingerprint(value):
+        data = json.dumps(value, sort_keys=True, separators=(",", ":"))
+        return hashlib.sha1(data.encode()).digest()
+
+    def update(self, name, value, fingerprint=None):
+        """
+        Store the value of a section, stamping it with a new sequence number if it
+        changed. A cheap fingerprint can be given for large values.
+        """
+        if fingerprint is None:
+            fingerprint = self.fingerprint(value)
+        with self.lock:
+            current = self.sections.get(name)
+            if current is None or current[1] != fingerprint:
+                self.seq += 1
+                self.sections[name] = (self.seq, fingerprint, value)
+            return self.seq
+
+    def changes(self, since=None):
+        """Return the current sequence and the sections changed after since"""
+        with self.lock:
+            if since is None or since > self.seq:
+                since = 0
+            changed = {
+                name: value
+                for name, (seq, _, value) in self.sections.items()
+                if seq > since
+            }
+            return self.seq, changed
@@ -20,8 +20,40 @@ var FORCED_CAMERA_SETTINGS = {
 };
 
 var capture_status_interval = null;
+// Sequence number of the last application status read
+var status_seq = null;
 var last_capture = 0;
 
+// Deep zoom viewer state. Scale is screen pixels per frame pixel and x, y the
+// frame pixel at the center of the viewer
+var MAX_TILE_SCALE = 4;
+var tile_viewer = {
+  pyramid: null,
+  scale: null,
+  x: 0,
+  y: 0,
+  tiles: {},
+  pointers: {},
+};
+
+// Live view state. The region of interest is x, y, width, height fractions of
+// the frame, null for the whole frame
+var LIVE_VIEW_FPS = 10;
+var LIVE_VIEW_ROI_SIZE = 0.25;
+var live_view = {
+  roi: null,
+  image_url: null,
+};
+
+// Multi-rig controller state. Rigs are kept by address, seq is the last status
+// sequence received and the status is only polled while there are rigs
+var RIGS_STATUS_INTERVAL = 2000;
+var rigs = {
+  seq: null,
+  rigs: {},
+  interval: null,
+};
+
 // Send data to server
 function get_data(url, success_cb, error_cb) {
   $.ajax({
@@ -192,6 +224,9 @@ function setup_gui(mode) {
     $("#aperture").prop("disabled", true);
     $("#iso").prop("disabled", true);
     $("#captures").prop("disabled", true);
+    $("#interval").prop("disabled", true);
+    $("#frame_type").prop("disabled", true);
+    $("#profile_apply_button").prop("disabled", true);
     $("#guider_connection_button").prop("disabled", true);
     $("#dither").prop("disabled", true);
     $("#dither_n").prop("disabled", true);
@@ -210,6 +245,9 @@ function setup_gui(mode) {
     $("#aperture").prop("disabled", false);
     $("#iso").prop("disabled", false);
     $("#captures").prop("disabled", false);
+    $("#interval").prop("disabled", false);
+    $("#frame_type").prop("disabled", false);
+    $("#profile_apply_button").prop("disabled", false);
     $("#guider_connection_button").prop("disabled", true);
     $("#dither").prop("disabled", false);
     $("#dither_n").prop("disabled", false);
@@ -240,8 +278,214 @@ function setup_gui(mode) {
   }
 }
 
-function show_image(image_data) {
-  $("#current_image").attr("src", "data:image/jpg;base64," + image_data);
+function show_image(image_url) {
+  live_view.image_url = image_url;
+  if (!$("#live_view").prop("checked")) {
+    $("#current_image").attr("src", image_url);
+  }
+}
+
+function live_view_url() {
+  var url = "/camera/live.mjpg?fps=" + LIVE_VIEW_FPS;
+  if (live_view.roi !== null) {
+    url += "&roi=" + live_view.roi.join(",");
+  }
+  return url;
+}
+
+// Replace the image by the camera live view stream or restore it
+function toggle_live_view() {
+  var live = $("#live_view").prop("checked");
+  live_view.roi = null;
+  if (live && $("#inspect_frame").prop("checked")) {
+    $("#inspect_frame").prop("checked", false).change();
+  }
+  $("#current_image").toggleClass("live", live);
+  $("#current_image").attr("src", live ? live_view_url() : live_view.image_url);
+}
+
+// Zoom the live view on the clicked region, or back to the whole frame
+function zoom_live_view(event) {
+  if (!$("#live_view").prop("checked")) {
+    return;
+  }
+  if (live_view.roi !== null) {
+    live_view.roi = null;
+  } else {
+    var rect = event.currentTarget.getBoundingClientRect();
+    var size = LIVE_VIEW_ROI_SIZE;
+    var x = (event.clientX - rect.left) / rect.width - size / 2;
+    var y = (event.clientY - rect.top) / rect.height - size / 2;
+    x = Math.min(Math.max(x, 0), 1 - size);
+    y = Math.min(Math.max(y, 0), 1 - size);
+    live_view.roi = [x.toFixed(3), y.toFixed(3), size, size];
+  }
+  $("#current_image").attr("src", live_view_url());
+}
+
+// Load the last frame tile pyramid in the viewer if it changed
+function load_tiles() {
+  get_data("/tiles/status/", function (response) {
+    var pyramid = response.status ? response.tiles_status.last : null;
+    if (pyramid === null) {
+      return;
+    }
+    if (tile_viewer.pyramid !== null && tile_viewer.pyramid.url === pyramid.url) {
+      return;
+    }
+    var resized =
+      tile_viewer.pyramid === null ||
+      tile_viewer.pyramid.width !== pyramid.width ||
+      tile_viewer.pyramid.height !== pyramid.height;
+    tile_viewer.pyramid = pyramid;
+    $("#tile_viewer").empty();
+    tile_viewer.tiles = {};
+    if (resized) {
+      tile_viewer_fit();
+    }
+    tile_viewer_render();
+  });
+}
+
+function tile_viewer_fit_scale() {
+  var viewer = $("#tile_viewer");
+  var pyramid = tile_viewer.pyramid;
+  return Math.min(viewer.width() / pyramid.width, viewer.height() / pyramid.height);
+}
+
+function tile_viewer_fit() {
+  tile_viewer.scale = tile_viewer_fit_scale();
+  tile_viewer.x = tile_viewer.pyramid.width / 2;
+  tile_viewer.y = tile_viewer.pyramid.height / 2;
+}
+
+// Zoom keeping the frame pixel under the given viewer position in place
+function tile_viewer_zoom(scale, px, py) {
+  var viewer = $("#tile_viewer");
+  scale = Math.max(tile_viewer_fit_scale(), Math.min(MAX_TILE_SCALE, scale));
+  var dx = px - viewer.width() / 2;
+  var dy = py - viewer.height() / 2;
+  tile_viewer.x += dx / tile_viewer.scale - dx / scale;
+  tile_viewer.y += dy / tile_viewer.scale - dy / scale;
+  tile_viewer.scale = scale;
+  tile_viewer_render();
+}
+
+// Show the tiles visible at the current position, only fetching those
+function tile_viewer_render() {
+  var pyramid = tile_viewer.pyramid;
+  if (pyramid === null) {
+    return;
+  }
+  var viewer = $("#tile_viewer");
+  var width = viewer.width();
+  var height = viewer.height();
+  // Smallest level with enough resolution for the screen
+  var needed = pyramid.width * tile_viewer.scale * (window.devicePixelRatio || 1);
+  var level = pyramid.levels.length - 1;
+  while (level > 0 && pyramid.levels[level - 1].width >= needed) {
+    level--;
+  }
+  var left = width / 2 - tile_viewer.x * tile_viewer.scale;
+  var top = height / 2 - tile_viewer.y * tile_viewer.scale;
+  var visible = {};
+  // The whole frame at level 0 stays below while the detail tiles load
+  $.each(level > 0 ? [0, level] : [0], function (_, n) {
+    var info = pyramid.levels[n];
+    var size = pyramid.tile_size * (pyramid.width / info.width) * tile_viewer.scale;
+    var first_column = Math.max(0, Math.floor(-left / size));
+    var last_column = Math.min(info.columns - 1, Math.floor((width - left) / size));
+    var first_row = Math.max(0, Math.floor(-top / size));
+    var last_row = Math.min(info.rows - 1, Math.floor((height - top) / size));
+    for (var row = first_row; row <= last_row; row++) {
+      for (var column = first_column; column <= last_column; column++) {
+        var key = n + "/" + column + "_" + row;
+        var tile = tile_viewer.tiles[key];
+        if (tile === undefined) {
+          tile = $("<img>").css("z-index", n).attr("src", pyramid.url + key + ".jpg");
+          viewer.append(tile);
+          tile_viewer.tiles[key] = tile;
+        }
+        var tile_width = Math.min(
+          pyramid.tile_size,
+          info.width - column * pyramid.tile_size
+        );
+        var tile_height = Math.min(
+          pyramid.tile_size,
+          info.height - row * pyramid.tile_size
+        );
+        tile.css({
+          left: left + column * size,
+          top: top + row * size,
+          width: (size * tile_width) / pyramid.tile_size,
+          height: (size * tile_height) / pyramid.tile_size,
+        });
+        visible[key] = true;
+      }
+    }
+  });
+  $.each(Object.keys(tile_viewer.tiles), function (_, key) {
+    if (!visible[key]) {
+      tile_viewer.tiles[key].remove();
+      delete tile_viewer.tiles[key];
+    }
+  });
+}
+
+function setup_tile_viewer() {
+  var viewer = $("#tile_viewer");
+  viewer.on("wheel", function (event) {
+    event.preventDefault();
+    if (tile_viewer.pyramid === null) {
+      return;
+    }
+    var factor = event.originalEvent.deltaY < 0 ? 1.25 : 0.8;
+    tile_viewer_zoom(tile_viewer.scale * factor, event.offsetX, event.offsetY);
+  });
+  viewer.on("dblclick", function (event) {
+    if (tile_viewer.pyramid === null) {
+      return;
+    }
+    // Toggle between the whole frame and 100%
+    var scale = tile_viewer.scale < 1 ? 1 : tile_viewer_fit_scale();
+    tile_viewer_zoom(scale, event.offsetX, event.offsetY);
+  });
+  // Drag to pan, pinch to zoom
+  viewer.on("pointerdown", function (event) {
+    viewer[0].setPointerCapture(event.pointerId);
+    tile_viewer.pointers[event.pointerId] = { x: event.clientX, y: event.clientY };
+  });
+  viewer.on("pointermove", function (event) {
+    var pointers = tile_viewer.pointers;
+    var last = pointers[event.pointerId];
+    if (last === undefined || tile_viewer.pyramid === null) {
+      return;
+    }
+    var ids = Object.keys(pointers);
+    var current = { x: event.clientX, y: event.clientY };
+    if (ids.length === 2) {
+      var other = pointers[ids[0] == event.pointerId ? ids[1] : ids[0]];
+      var before = Math.hypot(last.x - other.x, last.y - other.y);
+      var after = Math.hypot(current.x - other.x, current.y - other.y);
+      var offset = viewer.offset();
+      if (before > 0) {
+        tile_viewer_zoom(
+          (tile_viewer.scale * after) / before,
+          (current.x + other.x) / 2 - offset.left,
+          (current.y + other.y) / 2 - offset.top
+        );
+      }
+    } else {
+      tile_viewer.x -= (current.x - last.x) / tile_viewer.scale;
+      tile_viewer.y -= (current.y - last.y) / tile_viewer.scale;
+      tile_viewer_render();
+    }
+    pointers[event.pointerId] = current;
+  });
+  viewer.on("pointerup pointercancel", function (event) {
+    delete tile_viewer.pointers[event.pointerId];
+  });
+  $(window).on("resize", tile_viewer_render);
 }
 
 function connect_camera() {
@@ -340,7 +584,9 @@ function get_camera_preview(cb) {
       if (response.status) {
         console.log("Got camera preview");
         log_message("Retrieved camera preview");
-        show_image(response.image_data);
+        if (response.image_url !== null) {
+          show_image(response.image_url);
+        }
       } else {
         console.log("Error getting camera preview", response);
         log_message("Error getting camera preview");
@@ -354,6 +600,100 @@ function get_camera_preview(cb) {
   });
 }
 
+// Load capture profiles
+function load_profiles() {
+  get_data("/profiles/", function (response) {
+    if (response.status) {
+      populate_configuration_choices(
+        "profile_list",
+        Object.keys(response.profiles).sort(),
+        $("#profile_list").val() || null,
+        true
+      );
+    } else {
+      log_message("Error loading profiles: " + response.error);
+    }
+  });
+}
+
+// Apply selected capture profile
+function apply_profile(cb) {
+  var name = $("#profile_list").val();
+  if (!name) {
+    log_message("No profile has been selected");
+    return;
+  }
+  log_message("Applying profile " + name);
+  send_data("/profiles/apply/", { name: name }, function (response) {
+    if (response.status) {
+      // Update camera settings and sequence parameters from the profile
+      if (response.config) {
+        $.each(CAMERA_SETTINGS, function (index, setting) {
+          if (response.config[setting]) {
+            populate_configuration_choices(
+              setting,
+              response.config[setting].choices,
+              response.config[setting].current
+            );
+          }
+        });
+      }
+      $.each(response.sequence, function (parm, value) {
+        if (parm === "dither") {
+          $("#dither").prop("checked", value === "true");
+        } else {
+          $("#" + parm).val(value);
+        }
+      });
+      var changes = Object.keys(response.changes).length;
+      log_message("Profile " + name + " applied (" + changes + " changes)");
+    } else {
+      log_message("Error applying profile: " + response.error);
+    }
+    if (typeof cb == "function") {
+      cb(response);
+    }
+  });
+}
+
+// Save current settings as a capture profile
+function save_profile(cb) {
+  var name = prompt("Profile name", $("#profile_list").val() || "");
+  if (!name) {
+    return;
+  }
+  var data = {
+    name: name,
+    exposure: $("#exposure").val(),
+    captures: $("#captures").val(),
+    interval: $("#interval").val(),
+    dither: $("#dither").prop("checked"),
+    dither_n: $("#dither_n").val(),
+    dither_px: $("#dither_px").val(),
+    settle_px: $("#settle_px").val(),
+    settle_time: $("#settle_time").val(),
+    settle_timeout: $("#settle_timeout").val(),
+    frame_type: $("#frame_type").val(),
+  };
+  $.each(CAMERA_SETTINGS, function () {
+    data[this] = $("#" + this).val();
+  });
+  $.each(FORCED_CAMERA_SETTINGS, function (elem, value) {
+    data[elem] = value;
+  });
+  send_data("/profiles/save/", data, function (response) {
+    if (response.status) {
+      log_message("Profile " + name + " saved");
+      load_profiles();
+    } else {
+      log_message("Error saving profile: " + response.error);
+    }
+    if (typeof cb == "function") {
+      cb(response);
+    }
+  });
+}
+
 // Start capturing
 function start_capturing(cb) {
   log_message("Starting capture process");
@@ -362,12 +702,14 @@ function start_capturing(cb) {
     var data = {
       exposure: $("#exposure").val(),
       captures: $("#captures").val(),
+      interval: $("#interval").val(),
       dither: $("#dither").prop("checked"),
       dither_n: $("#dither_n").val(),
       dither_px: $("#dither_px").val(),
       settle_px: $("#settle_px").val(),
       settle_time: $("#settle_time").val(),
       settle_timeout: $("#settle_timeout").val(),
+      frame_type: $("#frame_type").val(),
     };
     console.log("Capture settings", data);
     $("#capture_status").val("0 / " + data.captures);
@@ -419,8 +761,18 @@ function get_capture_status(cb) {
     STOPPING: 3,
   };
 
-  get_data("/capture/status/", function (response) {
+  // Only the status sections changed since the last poll are returned
+  get_data("/status/?since=" + status_seq, function (response) {
     if (response.status) {
+      if (response.locked) {
+        // Application busy, retry on the next poll
+        return;
+      }
+      status_seq = response.seq;
+      if (!response.capture_status) {
+        // Capture status unchanged
+        return;
+      }
       console.log("Capture status retrieved", response);
       var status = response.capture_status;
       if (
@@ -452,20 +804,39 @@ function get_capture_status(cb) {
 function update_capture_status(capture_status) {
   var status =
     capture_status.current_capture + " / " + capture_status.capture_parms.captures;
+  if (capture_status.blocks.length > 1) {
+    status +=
+      " (block " +
+      capture_status.current_block +
+      " / " +
+      capture_status.blocks.length +
+      ")";
+  }
+  var interval_status = capture_status.interval_status;
+  if (interval_status && interval_status.missed > 0) {
+    status += " (" + interval_status.missed + " missed)";
+  }
   if ($("#capture_status").val() !== status) {
     $("#capture_status").val(status);
   }
+  if ($("#inspect_frame").prop("checked")) {
+    // Pyramids are generated in background after the capture is reported
+    load_tiles();
+  }
   if (last_capture !== capture_status.last_capture) {
     // Load last image and display it
     last_capture = capture_status.last_capture;
     var image_status =
       capture_status.last_capture + " / " + capture_status.capture_parms.captures;
     log_message("Loading image " + status);
-    get_data("/capture/last_image/", function (response) {
+    var image_url = $("#show_stack").prop("checked")
+      ? "/stack/preview/"
+      : "/capture/last_image/";
+    get_data(image_url, function (response) {
       if (response.status) {
         console.log("Got image data");
-        if (response.image_data !== null) {
-          show_image(response.image_data);
+        if (response.image_url !== null) {
+          show_image(response.image_url);
           log_message("Loaded image " + image_status + " successfully");
         }
       } else {
@@ -524,6 +895,7 @@ function initialize_app() {
         log_message("Application is busy. Retrying.");
         setTimeout(initialize_app, 1000);
       } else {
+        status_seq = response.seq;
         // Populate camera list
         populate_configuration_choices(
           "camera_list",
@@ -599,6 +971,159 @@ function disconnect_guider() {
   });
 }
 
+// Load the rigs changed since the last status received
+function load_rigs() {
+  var url = "/rigs/status/";
+  if (rigs.seq !== null) {
+    url += "?since=" + rigs.seq;
+  }
+  get_data(url, function (response) {
+    if (!response.status) {
+      console.log("Error getting rigs status", response);
+      return;
+    }
+    rigs.seq = response.seq;
+    if (!$.isEmptyObject(response.rigs)) {
+      $.each(response.rigs, function (address, rig) {
+        if (rig === null) {
+          delete rigs.rigs[address];
+        } else {
+          rigs.rigs[address] = rig;
+        }
+      });
+      render_rigs();
+    }
+    if (response.count > 0 && rigs.interval === null) {
+      rigs.interval = setInterval(load_rigs, RIGS_STATUS_INTERVAL);
+    } else if (response.count === 0 && rigs.interval !== null) {
+      clearInterval(rigs.interval);
+      rigs.interval = null;
+    }
+  });
+}
+
+// Text describing the state of a rig
+function rig_state_text(rig) {
+  var capture = rig.status.capture;
+  if (rig.state !== "connected") {
+    return rig.state + (rig.error ? ": " + rig.error : "");
+  }
+  if (!capture || !capture.capture_parms || capture.current_status === 0) {
+    return "idle";
+  }
+  var text = capture.current_capture + " / " + capture.capture_parms.captures;
+  if (capture.guide_stats) {
+    text += ", guide RMS " + capture.guide_stats.rms_tot.toFixed(2);
+  }
+  return text;
+}
+
+function render_rigs() {
+  var list = $("#rig_list");
+  var addresses = Object.keys(rigs.rigs).sort();
+  list.html("");
+  $.each(addresses, function () {
+    var rig = rigs.rigs[this];
+    var item = $("<div />").addClass("rig").attr("data-address", rig.address);
+    if (rig.frame && rig.frame.thumbnail_url) {
+      item.append(
+        $("<img />").addClass("rig_thumbnail").attr("src", rig.frame.thumbnail_url)
+      );
+    }
+    item.append(
+      $("<button />")
+        .addClass("btn btn-sm btn-secondary float-right rig_remove")
+        .attr({ type: "button", title: "Remove rig" })
+        .append($("<span />").addClass("oi oi-x"))
+    );
+    item.append($("<div />").text(rig.name));
+    item.append(
+      $("<div />")
+        .addClass("rig_state")
+        .addClass(rig.state === "connected" ? "status_enabled" : "status_disabled")
+        .text(rig_state_text(rig))
+    );
+    list.append(item);
+  });
+  $("#rig_controls").collapse(addresses.length ? "show" : "hide");
+}
+
+function add_rig() {
+  var address = $("#rig_address").val().trim();
+  if (!address) {
+    return;
+  }
+  send_data("/rigs/add/", { address: address }, function (response) {
+    if (response.status) {
+      log_message("Rig " + response.address + " added");
+      $("#rig_address").val("");
+      load_rigs();
+    } else {
+      log_message("Error adding rig: " + response.error);
+    }
+  });
+}
+
+function remove_rig(address) {
+  send_data("/rigs/remove/", { address: address }, function (response) {
+    if (response.status) {
+      log_message("Rig " + address + " removed");
+      load_rigs();
+    } else {
+      log_message("Error removing rig: " + response.error);
+    }
+  });
+}
+
+// Start the capture settings on all connected rigs at once
+function start_rigs() {
+  var block = {
+    exposure: $("#exposure").val(),
+    captures: $("#captures").val(),
+    interval: $("#interval").val(),
+    dither: $("#dither").prop("checked"),
+    dither_n: $("#dither_n").val(),
+    dither_px: $("#dither_px").val(),
+    settle_px: $("#settle_px").val(),
+    settle_time: $("#settle_time").val(),
+    settle_timeout: $("#settle_timeout").val(),
+    frame_type: $("#frame_type").val(),
+  };
+  log_message("Starting capture on all rigs");
+  $.ajax({
+    type: "POST",
+    url: "/rigs/start/",
+    data: JSON.stringify({ blocks: [block] }),
+    contentType: "application/json",
+    dataType: "json",
+    success: function (response) {
+      if (response.status) {
+        log_message(
+          "Capture started on " + Object.keys(response.replies).length + " rigs"
+        );
+      } else {
+        log_message("Error starting rigs: " + response.error);
+      }
+      load_rigs();
+    },
+    error: function (err) {
+      console.log(err);
+    },
+  });
+}
+
+function stop_rigs() {
+  log_message("Stopping capture on all rigs");
+  send_data("/rigs/stop/", {}, function (response) {
+    if (response.status) {
+      log_message("Capture stopped on all rigs");
+    } else {
+      log_message("Error stopping rigs: " + response.error);
+    }
+    load_rigs();
+  });
+}
+
 $(document).ready(function () {
   // Event binding
   $("#sidebar_toggler").on("click", function () {
@@ -647,6 +1172,59 @@ $(document).ready(function () {
     set_camera_config();
   });
 
+  // Capture profile buttons
+  $("#profile_apply_button").on("click", function () {
+    apply_profile();
+  });
+  $("#profile_save_button").on("click", function () {
+    save_profile();
+  });
+
+  // Switch between live stack and last image
+  $("#show_stack").change(function () {
+    var image_url = $("#show_stack").prop("checked")
+      ? "/stack/preview/"
+      : "/capture/last_image/";
+    get_data(image_url, function (response) {
+      if (response.status && response.image_url !== null) {
+        show_image(response.image_url);
+      }
+    });
+  });
+
+  // Switch between the image and the full resolution viewer
+  $("#inspect_frame").change(function () {
+    var inspect = $("#inspect_frame").prop("checked");
+    if (inspect && $("#live_view").prop("checked")) {
+      $("#live_view").prop("checked", false).change();
+    }
+    $("#current_image").toggle(!inspect);
+    $("#tile_viewer").toggle(inspect);
+    if (inspect) {
+      if (tile_viewer.pyramid !== null) {
+        tile_viewer_render();
+      }
+      load_tiles();
+    }
+  });
+  setup_tile_viewer();
+
+  // Live view for focusing, clicking the image zooms in
+  live_view.image_url = $("#current_image").attr("src");
+  $("#live_view").change(toggle_live_view);
+  $("#current_image").on("click", zoom_live_view);
+
+  // Multi-rig controller, clicking a thumbnail shows it
+  $("#rig_add_button").on("click", add_rig);
+  $("#rigs_start_button").on("click", start_rigs);
+  $("#rigs_stop_button").on("click", stop_rigs);
+  $("#rig_list").on("click", ".rig_remove", function () {
+    remove_rig($(this).closest(".rig").attr("data-address"));
+  });
+  $("#rig_list").on("click", ".rig_thumbnail", function () {
+    show_image($(this).attr("src"));
+  });
+
   // Toggle capturing button
   $("#capture_toggle_button").on("click", function () {
     if ($("#capture_toggle_button > span.oi").hasClass("oi-media-play")) {
@@ -659,4 +1237,6 @@ $(document).ready(function () {
   // Load initial data and setup interface
   log_message("Initlializing");
   initialize_app();
+  load_profiles();
+  load_rigs();
 });
@@ -322,16 +322,20 @@ class Guider:
         """connect to PHD2 -- call Connect before calling any of the server API methods below"""
         self.Disconnect()
         try:
-            self.conn = _Conn()
+            self.conn = self.make_conn()
             self.conn.Connect(self.hostname, 4400 + self.instance - 1)
             self.terminate = False
-            self.worker = threading.Thread(target=self._worker)
+            self.worker = threading.Thread(target=self._worker, daemon=True)
             self.worker.start()
             # print("DBG: connect done")
         except Exception:
             self.Disconnect()
             raise
 
+    def make_conn(self):
+        """return the connection to PHD2, overridden to record or replay it"""
+        return _Conn()
+
     def Disconnect(self):
         """disconnect from PHD2"""
         if self.worker is not None:
@@ -0,0 +1,164 @@
+"""Deep zoom tile pyramids"""
+
+import json
+import os
+import re
+import shutil
+import threading
+from collections import deque
+
+from PIL import Image
+
+from imaging import BufferReader
+from pipeline import FrameStage
+from settings import DATA_DIR
+
+# Session names allowed in tile paths
+SESSION_RE = re.compile(r"^[\w.-]+$")
+
+
+class TilePyramid(FrameStage):
+    """
+    Tile pyramid generation stage
+
+    Each frame is cut in TILE_SIZE JPEG tiles at full resolution and at every
+    level halving it, down to a level fitting in a single tile. Pyramids are stored
+    in DATA_DIR/tiles/<session>/<index>/ as <level>/<column>_<row>.jpg, level 0
+    being the smallest, with their description in info.json. Only the pyramids of
+    the last KEEP_FRAMES frames are kept.
+    """
+
+    name = "tiles"
+
+    QUEUE_SIZE = 1
+    TILE_SIZE = 256
+    QUALITY = 85
+    KEEP_FRAMES = 10
+
+    def __init__(self, logger=None):
+        super().__init__(logger)
+        self.root = os.path.join(DATA_DIR, "tiles")
+        self.lock = threading.Lock()
+        self.generated = 0
+        self.last = None
+        # Pyramids on disk, oldest first
+        self.pyramids = deque(self._find_pyramids())
+
+    def _find_pyramids(self):
+        pyramids = []
+        if os.path.isdir(self.root):
+            for session in os.listdir(self.root):
+                session_dir = os.path.join(self.root, session)
+                for index in os.listdir(session_dir):
+                    path = os.path.join(session_dir, index)
+                    if index.endswith(".tmp"):
+                        # Interrupted generation
+                        shutil.rmtree(path, ignore_errors=True)
+                    else:
+                        pyramids.append((os.path.getmtime(path), path))
+        return [path for _, path in sorted(pyramids)]
+
+    def get_status(self):
+        with self.lock:
+            return {
+                "generated": self.generated,
+                "dropped": self.dropped,
+                "pending": self.queue.qsize(),
+                "last": self.last,
+            }
+
+    def frame_dir(self, session, index):
+        if not SESSION_RE.match(session):
+            raise ValueError("Invalid session name: %s" % session)
+        return os.path.join(self.root, session, "%d" % index)
+
+    def get_info(self, session, index):
+        """Return the description of a frame pyramid, None if not available"""
+        try:
+            with open(os.path.join(self.frame_dir(session, index), "info.json")) as fd:
+                return json.load(fd)
+        except (OSError, ValueError):
+            return None
+
+    def tile_path(self, session, index, level, column, row):
+        return os.path.join(
+            self.frame_dir(session, index), "%d" % level, "%d_%d.jpg" % (column, row)
+        )
+
+    def process(self, frame):
+        image = Image.open(BufferReader(frame["data"]))
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        path = self.frame_dir(frame["session"], frame["index"])
+        # Pyramids are built aside so requests never see partial ones
+        tmp_path = path + ".tmp"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        # Level sizes, halving the full resolution until it fits in a tile
+        sizes = [image.size]
+        while max(sizes[0]) > self.TILE_SIZE:
+            width, height = sizes[0]
+            sizes.insert(0, ((width + 1) // 2, (height + 1) // 2))
+        levels = []
+        for level in reversed(range(len(sizes))):
+            if image.size != sizes[level]:
+                image = image.resize(sizes[level], Image.BOX)
+            levels.insert(0, self._write_level(image, tmp_path, level))
+        info = {
+            "session": frame["session"],
+            "index": frame["index"],
+            "width": levels[-1]["width"],
+            "height": levels[-1]["height"],
+            "tile_size": self.TILE_SIZE,
+            "levels": levels,
+            "url": "/tiles/%s/%d/" % (frame["session"], frame["index"]),
+        }
+        with open(os.path.join(tmp_path, "info.json"), "w") as fd:
+            json.dump(info, fd)
+        shutil.rmtree(path, ignore_errors=True)
+        os.rename(tmp_path, path)
+        with self.lock:
+            self.generated += 1
+            self.last = info
+            if path in self.pyramids:
+                self.pyramids.remove(path)
+            self.pyramids.append(path)
+            expired = []
+            while len(self.pyramids) > self.KEEP_FRAMES:
+                expired.append(self.pyramids.popleft())
+        for expired_path in expired:
+            shutil.rmtree(expired_path, ignore_errors=True)
+            try:
+                # Remove the session directory once empty
+                os.rmdir(os.path.dirname(expired_path))
+            except OSError:
+                pass
+
+    def _write_level(self, image, path, level):
+        level_path = os.path.join(path, "%d" % level)
+        os.makedirs(level_path)
+        width, height = image.size
+        columns = (width + self.TILE_SIZE - 1) // self.TILE_SIZE
+        rows = (height + self.TILE_SIZE - 1) // self.TILE_SIZE
+        for row in range(rows):
+            for column in range(columns):
+                x = column * self.TILE_SIZE
+                y = row * self.TILE_SIZE
+                tile = image.crop(
+                    (
+                        x,
+                        y,
+                        min(x + self.TILE_SIZE, width),
+                        min(y + self.TILE_SIZE, height),
+                    )
+                )
+                tile.save(
+                    os.path.join(level_path, "%d_%d.jpg" % (column, row)),
+                    "JPEG",
+                    quality=self.QUALITY,
+                )
+        return {
+            "width": width,
+            "height": height,
+            "columns": columns,
+            "rows": rows,
+        }
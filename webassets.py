@@ -0,0 +1,165 @@
+"""Static assets and response compression"""
+
+import gzip
+import hashlib
+import mimetypes
+import os
+import threading
+
+from flask import Response, abort, request
+
+try:
+    import brotli
+except ImportError:  # Brotli support is optional
+    brotli = None
+
+# Cache lifetime for content hashed URLs
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+# Content types worth compressing
+COMPRESSIBLE_TYPES = (
+    "text/",
+    "application/javascript",
+    "application/json",
+    "image/svg+xml",
+    "application/vnd.ms-fontobject",
+    "font/ttf",
+    "font/otf",
+    "application/x-font-ttf",
+    "application/font-sfnt",
+)
+
+
+def is_compressible(mimetype):
+    return mimetype is not None and mimetype.startswith(COMPRESSIBLE_TYPES)
+
+
+def accepted_encoding(available):
+    """Return the preferred encoding accepted by the client among the available"""
+    best = None
+    best_quality = 0
+    for encoding in available:
+        quality = request.accept_encodings[encoding]
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+def compress(data, encoding, level=None):
+    if encoding == "br":
+        return brotli.compress(data, quality=11 if level is None else level)
+    return gzip.compress(data, 9 if level is None else level)
+
+
+class StaticAssets:
+    """
+    Static assets server
+
+    Assets are read once, hashed and precompressed with gzip (and brotli if
+    available) in memory. URLs built with url() include the content hash, so
+    responses for them can be cached forever by browsers.
+    """
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        self.lock = threading.Lock()
+        self.assets = {}
+
+    def _load(self, path):
+        full_path = os.path.abspath(os.path.join(self.root, path))
+        if not full_path.startswith(self.root + os.sep) or not os.path.isfile(
+            full_path
+        ):
+            return None
+        mtime = os.path.getmtime(full_path)
+        with self.lock:
+            asset = self.assets.get(path)
+        if asset is not None and asset["mtime"] == mtime:
+            return asset
+        with open(full_path, "rb") as fd:
+            data = fd.read()
+        mimetype = mimetypes.guess_type(full_path)[0] or "application/octet-stream"
+        asset = {
+            "mtime": mtime,
+            "mimetype": mimetype,
+            "hash": hashlib.sha1(data).hexdigest()[:12],
+            "encodings": {"identity": data},
+        }
+        if is_compressible(mimetype):
+            encodings = ["gzip", "br"] if brotli is not None else ["gzip"]
+            for encoding in encodings:
+                compressed = compress(data, encoding)
+                if len(compressed) < len(data):
+                    asset["encodings"][encoding] = compressed
+        with self.lock:
+            self.assets[path] = asset
+        return asset
+
+    def url(self, path):
+        """Return the content hashed URL of an asset"""
+        asset = self._load(path)
+        if asset is None:
+            return "/static/" + path
+        return "/static/%s?v=%s" % (path, asset["hash"])
+
+    def response(self, path):
+        asset = self._load(path)
+        if asset is None:
+            abort(404)
+        etag = asset["hash"]
+        if request.args.get("v") == asset["hash"]:
+            cache_control = "public, max-age=%d, immutable" % IMMUTABLE_MAX_AGE
+        else:
+            cache_control = "no-cache"
+        headers = {"Cache-Control": cache_control, "ETag": '"%s"' % etag}
+        if len(asset["encodings"]) > 1:
+            headers["Vary"] = "Accept-Encoding"
+        if etag in request.if_none_match:
+            return Response(status=304, headers=headers)
+        encoding = accepted_encoding(
+            [name for name in asset["encodings"] if name != "identity"]
+        )
+        if encoding:
+            headers["Content-Encoding"] = encoding
+        data = asset["encodings"][encoding or "identity"]
+        return Response(data, mimetype=asset["mimetype"], headers=headers)
+
+
+def buffer_response(data, mimetype, chunk_size=64 * 1024):
+    """
+    Stream a bytes-like buffer (e.g. a camera memoryview) as an uncached response
+
+    The buffer is sent in slices so no copy of the whole buffer is ever made.
+    """
+    view = memoryview(data).cast("B")
+
+    def generate():
+        for offset in range(0, len(view), chunk_size):
+            yield bytes(view[offset : offset + chunk_size])
+
+    return Response(
+        generate(),
+        mimetype=mimetype,
+        headers={"Content-Length": str(len(view)), "Cache-Control": "no-store"},
+    )
+
+
+def compress_response(response, min_size=1024, level=6):
+    """Compress JSON responses bigger than min_size if the client accepts it"""
+    if (
+        response.direct_passthrough
+        or response.is_streamed
+        or response.mimetype != "application/json"
+        or "Content-Encoding" in response.headers
+    ):
+        return response
+    data = response.get_data()
+    if len(data) < min_size:
+        return response
+    encoding = accepted_encoding(["br", "gzip"] if brotli is not None else ["gzip"])
+    if encoding is None:
+        return response
+    response.set_data(compress(data, encoding, 4 if encoding == "br" else level))
+    response.headers["Content-Encoding"] = encoding
+    response.vary.add("Accept-Encoding")
+    return response